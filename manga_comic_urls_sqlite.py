@@ -1,31 +1,238 @@
+import os
+import sys
+import csv
 import json
-import sqlite3
-
-# JSONファイルを読み込む
-with open('manga_comic_urls.json', 'r', encoding='utf-8') as f:
-  data = json.load(f)
-
-# SQLiteデータベースを作成（または開く）
-conn = sqlite3.connect('manga_comic_urls.db')
-
-cursor = conn.cursor() 
-# テーブルを作成（存在しない場合）
-cursor.execute('''
-  CREATE TABLE IF NOT EXISTS comics (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    url TEXT NOT NULL UNIQUE,
-    title TEXT NOT NULL
-  )
-''')
-
-# データを挿入
-for url, title in data.items():
-  cursor.execute('''
-    INSERT OR IGNORE INTO comics (url, title)
-    VALUES (?, ?)
-  ''', (url, title))
-  # コミットして閉じる
-  conn.commit()
-  conn.close()
-
-print("✅ SQLiteデータベース 'manga_comic_urls.db' が作成されました。")
+import time
+import argparse
+import logging
+
+# マンガURLリストの一括インポート
+# JSON / NDJSON / CSV / テキスト（1行1URL）のURLリストを先頭から順に読み込み、
+# /add と同じ規則でハッシュ・タイトル・拡張子を求めて、ビューアーの mangas テーブルに登録する。
+# 登録は executemany で BATCH_SIZE 行ずつ1つのトランザクションにまとめる。
+# 全文検索の索引は行ごとのトリガーで更新すると登録の数倍の時間がかかるため、
+# インポート中は更新を保留し、最後に1回だけ作り直す（--incremental-fts で従来どおり1行ずつ更新）。
+# インポート中の接続は同期書き込みを止め（synchronous = OFF）、ページキャッシュを IMPORT_CACHE_SIZE_KB に広げる。
+# OSのクラッシュや電源断ではインポート中の行が失われうるが、終了時に通常の設定に戻してから閉じる。
+# 例: python manga_comic_urls_sqlite.py manga_comic_urls.json
+#     python manga_comic_urls_sqlite.py urls.ndjson --batch-size 100000
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'manga_viwer'))
+
+import db # noqa: E402
+import library # noqa: E402
+from config import DATABASE # noqa: E402
+
+BATCH_SIZE = 50000
+IMPORT_CACHE_SIZE_KB = 256 * 1024 # インポート中の接続のページキャッシュ（mangas のハッシュのインデックスが収まる大きさ）
+CHUNK_SIZE = 1024 * 1024
+FORMATS = {'.json': 'json', '.ndjson': 'ndjson', '.jsonl': 'ndjson', '.csv': 'csv', '.txt': 'txt'}
+
+
+class JSONStream:
+    """
+    トップレベルの配列またはオブジェクトを、ファイル全体を読み込まずに要素ごとに返すリーダー。
+    各要素は json.JSONDecoder.raw_decode でデコードし、途中で切れた場合は続きを読み込んで再試行する。
+    """
+
+    def __init__(self, f):
+        self._f = f
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+        self._decoder = json.JSONDecoder()
+
+    def _fill(self):
+        chunk = self._f.read(CHUNK_SIZE)
+        if not chunk:
+            self._eof = True
+            return False
+        self._buf = self._buf[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def _peek(self):
+        """空白を読み飛ばし、次の文字を返す（終端では空文字）"""
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos].isspace():
+                self._pos += 1
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                return ''
+
+    def _expect(self, chars):
+        c = self._peek()
+        if not c or c not in chars:
+            raise ValueError(f"JSONの形式が正しくありません: '{chars}' が必要です (位置 {self._pos})")
+        self._pos += 1
+        return c
+
+    def _value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # バッファの末尾で終わった数値は、続きがある可能性がある
+            if end == len(self._buf) and isinstance(value, (int, float)) and self._fill():
+                continue
+            self._pos = end
+            return value
+
+    def __iter__(self):
+        """配列の場合は要素を、オブジェクトの場合は (キー, 値) を返す"""
+        opening = self._expect('[{')
+        closing = ']' if opening == '[' else '}'
+        if self._peek() == closing:
+            return
+        while True:
+            if opening == '[':
+                yield self._value()
+            else:
+                key = self._value()
+                self._expect(':')
+                yield key, self._value()
+            if self._expect(',' + closing) == closing:
+                return
+
+
+def _record(item):
+    """入力の1要素を (URL, 元のタイトルまたは None) にする"""
+    if isinstance(item, str):
+        return item, None
+    if isinstance(item, tuple): # {URL: タイトル} 形式のオブジェクト
+        return item[0], item[1] if isinstance(item[1], str) else None
+    if isinstance(item, dict):
+        return item.get('url'), item.get('title')
+    return None, None
+
+
+def read_records(path, fmt):
+    """URLリストを (URL, 元のタイトルまたは None) の形で順に返すジェネレーター"""
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        if fmt == 'json':
+            for item in JSONStream(f):
+                yield _record(item)
+        elif fmt == 'ndjson':
+            for line in f:
+                if line.strip():
+                    yield _record(json.loads(line))
+        elif fmt == 'csv':
+            reader = csv.reader(f)
+            url_col, title_col = 0, None
+            for n, row in enumerate(reader):
+                if not row:
+                    continue
+                # 1行目がURLでなければヘッダーとみなし、url / title 列の位置を決める
+                if n == 0 and '://' not in row[0]:
+                    header = [c.strip().lower() for c in row]
+                    url_col = header.index('url') if 'url' in header else 0
+                    title_col = header.index('title') if 'title' in header else None
+                    continue
+                yield row[url_col] if url_col < len(row) else None, \
+                    row[title_col] if title_col is not None and title_col < len(row) else None
+        else:
+            for line in f:
+                yield line, None
+
+
+def import_urls(conn, records, batch_size=BATCH_SIZE, source_titles=False, progress=None):
+    """
+    URLを検証して mangas に一括登録し、件数の集計を返す。
+    written は追加または更新した行数、unchanged は登録済みで変更のなかった行数（入力内の重複を含む）。
+    source_titles が真の場合は、入力にタイトルがあればURLから求めたタイトルの代わりに使う。
+    """
+    stats = {'read': 0, 'written': 0, 'unchanged': 0, 'invalid': 0}
+    batch = []
+
+    def flush():
+        with conn:
+            written = library.upsert_mangas(conn, batch)
+        stats['written'] += written
+        stats['unchanged'] += len(batch) - written
+        batch.clear()
+        if progress:
+            progress(stats)
+
+    for url, source_title in records:
+        stats['read'] += 1
+        url = (url or '').strip()
+        entry = library.parse_entry(url) if url else None
+        if entry is None:
+            stats['invalid'] += 1
+            continue
+        manga_hash, title, ext = entry
+        if ext not in library.SUPPORTED_EXTS:
+            stats['invalid'] += 1
+            continue
+        if source_titles and source_title:
+            title = library.INVALID_TITLE_CHARS.sub('', source_title.strip()) or title
+        batch.append((manga_hash, url, title, ext))
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='マンガURLリストを mangas テーブルに一括インポートする')
+    parser.add_argument('input', nargs='?', default='manga_comic_urls.json',
+                        help='URLリスト（.json / .ndjson / .jsonl / .csv / .txt）')
+    parser.add_argument('--format', choices=sorted(set(FORMATS.values())), help='入力形式（省略時は拡張子から判定）')
+    parser.add_argument('--db', default=DATABASE, help='インポート先のデータベース')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='1トランザクションで登録する行数')
+    parser.add_argument('--source-titles', action='store_true', help='入力にタイトルがあればそれを使う')
+    parser.add_argument('--incremental-fts', action='store_true',
+                        help='検索の索引を最後に作り直さず、1行ずつ更新する（大きなライブラリに少数を追加する場合）')
+    parser.add_argument('--rebuild-fts', action='store_true', help='インポートせずに検索の索引だけを作り直す')
+    parser.add_argument('-v', '--verbose', action='store_true', help='無効なURLの警告を表示する')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING if args.verbose else logging.ERROR,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    fmt = args.format or FORMATS.get(os.path.splitext(args.input)[1].lower())
+    if fmt is None:
+        sys.exit(f"入力形式を判定できません。--format を指定してください: {args.input}")
+
+    conn = db.connect(args.db)
+    db.migrate(conn)
+
+    start = time.perf_counter()
+    if args.rebuild_fts:
+        library.rebuild_fts(conn)
+        conn.close()
+        print(f"✅ 検索の索引を作り直しました ({time.perf_counter() - start:.1f}秒)")
+        return
+
+    def progress(stats):
+        elapsed = time.perf_counter() - start
+        print(f"  {stats['read']:,} 行読み込み, {stats['written']:,} 行追加・更新 ({stats['read'] / elapsed:,.0f} 行/秒)", file=sys.stderr)
+
+    if not args.incremental_fts:
+        library.defer_fts(conn)
+    conn.execute('PRAGMA synchronous = OFF')
+    conn.execute(f'PRAGMA cache_size = {-IMPORT_CACHE_SIZE_KB}')
+    try:
+        stats = import_urls(conn, read_records(args.input, fmt), args.batch_size, args.source_titles, progress)
+    finally:
+        # 途中で失敗した場合も、登録済みの行を索引に反映して保留を解除する
+        if library.fts_deferred(conn):
+            print("  検索の索引を作り直しています...", file=sys.stderr)
+            library.rebuild_fts(conn)
+        # 閉じる前のチェックポイントは通常の設定で書き込む
+        conn.execute('PRAGMA synchronous = NORMAL')
+    elapsed = time.perf_counter() - start
+    conn.close()
+
+    rate = stats['read'] / elapsed if elapsed else 0
+    print(f"✅ {stats['written']:,} 件を '{args.db}' に追加・更新しました "
+          f"(読み込み {stats['read']:,} 行, 変更なし {stats['unchanged']:,} 行, 無効 {stats['invalid']:,} 行, {elapsed:.1f}秒, {rate:,.0f} 行/秒)")
+
+
+if __name__ == '__main__':
+    main()
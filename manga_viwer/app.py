@@ -1,28 +1,76 @@
 from flask import Flask, request, render_template, redirect, url_for, session, send_file, abort, jsonify, g
+from werkzeug.wsgi import wrap_file
+from markupsafe import escape
 import os
 import hashlib
 import base64
 import zipfile
+import contextlib
 import subprocess
 import shutil
-from urllib.parse import urlparse, unquote
-import requests
-from PIL import Image
 import glob
 import re
 import sqlite3
 import logging # ロギングを追加
+import time
+
+import cache_index
+import library
+import metadata
+import metrics
+from library import is_valid_url, derive_entry, SUPPORTED_EXTS
+from db import get_connection, release_connection, migrate
+from converter import (
+    convert_pages, convert_page, transcode_page, direct_mime_type, PageTooLarge,
+    available_formats, mime_type, file_ext, variant_stem, FORMATS, FORMAT_BY_EXT, ZipMember
+)
+from archive import (
+    zip_image_members, rar_image_members, iter_rar_pages, zip_pool,
+    image_members, read_member, write_manifest, manifest_cache
+)
+from jobs import JobQueue, JobQueueFull
+from prefetch import Prefetcher
+from eviction import get_policy, append_trace
+from pagepack import write_pack, pack_pool, open_page, PageLocation, PACK_NAME
+from hotpages import HotPages
+from downloader import download_file
 
 # config.pyから設定をインポート
 from config import (
-    DATABASE,
     MANGA_CACHE_DIR,
     MANGA_CACHE_TEMP_DIR,
     CACHE_SIZE_LIMIT_MB,
+    ARCHIVE_CACHE_LIMIT_MB,
+    EXTRACTED_CACHE_LIMIT_MB,
+    MAX_DOWNLOAD_SIZE_MB,
+    CACHE_EVICTION_POLICY,
+    CACHE_TRACE_LOG,
     IMAGES_PER_LOAD,
-    ALLOWED_DOMAINS,
+    MAX_PAGES_PER_REQUEST,
     FLASK_SECRET_KEY,
-    MAX_DOWNLOAD_SIZE_MB
+    JOB_WORKERS,
+    JOB_QUEUE_SIZE,
+    JOB_RESULT_TTL,
+    MAX_BATCH_URLS,
+    BATCH_PREFETCH_LIMIT,
+    PREFETCH_ENABLED,
+    PREFETCH_PAGES,
+    PREFETCH_WORKERS,
+    PREFETCH_QUEUE_SIZE,
+    PREFETCH_NEXT_VOLUME_AT,
+    PREFETCH_BUDGET_MB,
+    METADATA_WORKERS,
+    METADATA_QUEUE_SIZE,
+    DIRECT_MODE,
+    LAZY_CONVERSION,
+    PACK_PAGES,
+    DROP_ARCHIVE_AFTER_CONVERSION,
+    HOT_PAGE_CACHE_SIZE,
+    PAGE_VARIANTS,
+    PAGE_MAX_SIZE,
+    PAGE_QUALITY,
+    PAGE_QUALITY_TIERS,
+    IMAGE_CACHE_MAX_AGE
 )
 
 # Flaskアプリケーションの初期化
@@ -36,125 +84,101 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 os.makedirs(MANGA_CACHE_DIR, exist_ok=True)
 os.makedirs(MANGA_CACHE_TEMP_DIR, exist_ok=True)
 
+# ダウンロード/解凍用のバックグラウンドジョブキュー
+job_queue = JobQueue(JOB_WORKERS, JOB_QUEUE_SIZE, JOB_RESULT_TTL)
+
+# キャッシュの削除ポリシー（LRU / LFU / GDSF）
+eviction_policy = get_policy(CACHE_EVICTION_POLICY)
+
+# 読んでいる位置より先のページと、次の巻の先読み
+prefetcher = Prefetcher(PREFETCH_WORKERS, PREFETCH_QUEUE_SIZE)
+
+# 巻のメタデータ（ページ数・表紙）の生成。先読みと同じく、重複を除いた上限付きのキューで行う
+metadata_queue = Prefetcher(METADATA_WORKERS, METADATA_QUEUE_SIZE)
+
+# 最近配信したページの場所
+hot_pages = HotPages(HOT_PAGE_CACHE_SIZE)
+
+# メトリクス（/metrics）
+REQUEST_SECONDS = metrics.histogram('manga_http_request_seconds', 'ルートごとの応答時間（秒）', ('endpoint', 'method', 'status'))
+CACHE_MANAGE_SECONDS = metrics.histogram('manga_cache_manage_seconds', 'manage_cache_size の実行時間（秒）')
+CACHE_EVICTIONS = metrics.counter('manga_cache_evictions_total', '予算を超えたために削除した数（archive: アーカイブのみ, volume: 巻ごと）', ('kind',))
+CACHE_EVICTED_BYTES = metrics.counter('manga_cache_evicted_bytes_total', '予算を超えたために削除したバイト数', ('kind',))
+READER_CACHE = metrics.counter('manga_reader_cache_total', '/reader_data で巻がキャッシュ済みだったか（hit）、ジョブで準備したか（miss）', ('result',))
+
+@app.before_request
+def start_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_time(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        REQUEST_SECONDS.observe(time.perf_counter() - started, request.endpoint or 'none', request.method, str(response.status_code))
+    return response
+
 # データベース接続のヘルパー関数
 def get_db():
-    """データベース接続を取得または作成する"""
+    """データベース接続を取得する（スレッドごとに1つの接続を使い回す）"""
     if 'db' not in g:
-        g.db = sqlite3.connect(DATABASE)
-        g.db.row_factory = sqlite3.Row # カラム名でアクセスできるようにする
+        g.db = get_connection()
     return g.db
 
 @app.teardown_appcontext
 def close_db(exception):
-    """リクエスト終了時にデータベース接続を閉じる"""
-    db = g.pop('db', None)
-    if db is not None:
-        db.close()
+    """リクエスト終了時に、コミットされていないトランザクションを戻す（接続は閉じない）"""
+    if g.pop('db', None) is not None:
+        release_connection()
 
 # データベース初期化
 def init_db():
-    """データベーススキーマを初期化する"""
+    """データベーススキーマを最新のバージョンに移行する"""
     with app.app_context():
         db = get_db()
-        db.execute('''
-            CREATE TABLE IF NOT EXISTS mangas (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                hash TEXT UNIQUE,
-                url TEXT,
-                title TEXT,
-                file_ext TEXT
-            )
-        ''')
-        db.commit()
-
-init_db() # アプリケーション起動時にデータベースを初期化
+        migrate(db)
 
-# ヘルパー関数: URLの安全性を検証
-def is_valid_url(url):
-    """
-    URLが有効で、許可されたドメインに属するかどうかを検証する。
-    """
-    try:
-        result = urlparse(url)
-        # スキームがHTTP/HTTPSであり、ネットロケーションが存在するか
-        if not all([result.scheme in ['http', 'https'], result.netloc]):
-            logging.warning(f"無効なURLスキームまたはネットロケーション: {url}")
-            return False
-
-        domain = result.netloc
-        # 許可されたドメインリストが設定されており、ドメインがリストにない場合
-        if ALLOWED_DOMAINS and domain not in ALLOWED_DOMAINS:
-            logging.warning(f"許可されていないドメインからのURL: {url} (ドメイン: {domain})")
-            return False
-        return True
-    except Exception as e:
-        logging.error(f"URL検証エラー: {e} (URL: {url})", exc_info=True)
-        return False
+        if library.fts_deferred(db):
+            logging.warning("一括インポートが完了していないため、検索の索引が古い可能性があります。"
+                            "インポートをやり直すか、manga_comic_urls_sqlite.py --rebuild-fts を実行してください。")
 
-# ヘルパー関数: ファイルのダウンロード
-def download_file(url, save_path):
-    """
-    指定されたURLからファイルをダウンロードする。
-    既にファイルが存在する場合はスキップする。
-    """
-    if os.path.exists(save_path):
-        logging.info(f"ファイルは既に存在します: {save_path}")
-        return
+        # インデックスが空でキャッシュが残っている場合（既存環境からの移行時など）は一度だけ同期する
+        if db.execute('SELECT COUNT(*) FROM cache_index').fetchone()[0] == 0 and os.listdir(MANGA_CACHE_DIR):
+            cache_index.rebuild()
 
-    headers = {'User-Agent': 'MangaViewer/1.0'}
-    try:
-        with requests.get(url, stream=True, headers=headers, timeout=120) as r:
-            r.raise_for_status() # HTTPエラーが発生した場合に例外を発生させる
-
-            downloaded_size = 0
-            max_bytes = MAX_DOWNLOAD_SIZE_MB * 1024 * 1024
-
-            with open(save_path, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=8192):
-                    downloaded_size += len(chunk)
-                    if downloaded_size > max_bytes:
-                        os.remove(save_path) # 中途半端なファイルを削除
-                        logging.error(f"ファイルサイズが制限を超過しました: {url}")
-                        raise Exception(f"ファイルサイズが{MAX_DOWNLOAD_SIZE_MB}MBを超過しました。")
-                    f.write(chunk)
-        logging.info(f"ファイルのダウンロードが完了しました: {url} -> {save_path}")
-    except requests.exceptions.RequestException as e:
-        logging.error(f"ファイルダウンロードエラー: {e} (URL: {url})", exc_info=True)
-        # ダウンロード失敗時にファイルを削除（部分的にダウンロードされた場合）
-        if os.path.exists(save_path):
-            os.remove(save_path)
-        raise
-    except Exception as e:
-        logging.error(f"ファイルダウンロード中の予期せぬエラー: {e} (URL: {url})", exc_info=True)
-        if os.path.exists(save_path):
-            os.remove(save_path)
-        raise
+init_db() # アプリケーション起動時にデータベースを初期化
 
+@app.cli.command('rebuild-cache-index')
+def rebuild_cache_index_command():
+    """キャッシュディレクトリを走査してキャッシュインデックスを再構築する（クラッシュ後の復旧用）"""
+    count = cache_index.rebuild()
+    print(f"キャッシュインデックスを再構築しました: {count} 件")
+
+@app.cli.command('generate-metadata')
+def generate_metadata_command():
+    """メタデータ（ページ数・表紙）がまだない巻について、まとめて生成する（既存のライブラリ用）"""
+    db = get_connection()
+    hashes = [row['hash'] for row in db.execute(
+        'SELECT m.hash FROM mangas m LEFT JOIN manga_metadata d ON d.hash = m.hash WHERE d.hash IS NULL')]
+    for manga_hash in hashes:
+        generate_metadata(manga_hash)
+    print(f"メタデータを生成しました: {len(hashes)} 件")
 
 # ヘルパー関数: ZIPファイルの解凍と画像処理
-def extract_zip(archive_path, extract_to):
+def extract_zip(archive_path, extract_to, progress=None):
     """
-    ZIP/CBZファイルを解凍し、画像をPNG形式に変換して保存する。
+    ZIP/CBZファイルを解凍し、画像を設定されたページ形式に変換して保存する。
+    progress が指定された場合は progress(処理済みページ数, 総ページ数) を呼び出す。
     """
     os.makedirs(extract_to, exist_ok=True)
     try:
         with zipfile.ZipFile(archive_path, 'r') as zip_ref:
             # 危険なパス（..など）を防ぐため、メンバーリストをチェック
-            for i, name in enumerate(zip_ref.namelist()):
-                # 画像ファイルのみを対象とし、ディレクトリトラバーサルを防ぐ
-                if not re.search(r'\.(jpe?g|png|gif|bmp)$', name, re.I):
-                    continue
-                if os.path.basename(name) != name: # サブディレクトリ内のファイルを無視
-                    continue # より厳密なセキュリティが必要な場合は、サブディレクトリ内の画像も処理対象外に
-
-                try:
-                    with zip_ref.open(name) as f:
-                        img = Image.open(f).convert('RGB')
-                        img.thumbnail((1200, 1600)) # サムネイルサイズにリサイズ
-                        # 連番でファイル名を生成し、元のファイル名を無視してセキュリティを向上
-                        img.save(os.path.join(extract_to, f'{i:04d}.png'), 'PNG')
-                except Exception as e:
-                    logging.warning(f"画像処理エラー (ZIP): {name} - {e}", exc_info=True)
+            # 画像ファイルのみを対象とし、ディレクトリトラバーサルを防ぐ
+            members = zip_image_members(zip_ref)
+            # 連番でファイル名を生成し、元のファイル名を無視してセキュリティを向上
+            # メンバーは ZipMember として渡し、変換するプロセスがアーカイブから直接ストリームで読む
+            pages = ((i, name, ZipMember(archive_path, name)) for i, name in members)
+            convert_pages(pages, extract_to, len(members), progress=progress, label='ZIP')
         logging.info(f"ZIP解凍と画像処理が完了しました: {archive_path} -> {extract_to}")
     except zipfile.BadZipFile as e:
         logging.error(f"破損したZIPファイル: {archive_path} - {e}", exc_info=True)
@@ -166,38 +190,25 @@ def extract_zip(archive_path, extract_to):
         raise
 
 # ヘルパー関数: RARファイルの解凍と画像処理
-def extract_rar(archive_path, extract_to):
+def extract_rar(archive_path, extract_to, progress=None):
     """
-    RAR/CBRファイルをunrarコマンドを使用して解凍し、画像をPNG形式に変換して保存する。
+    RAR/CBRファイルの画像メンバーを1つずつ読み出し、設定されたページ形式に変換して保存する。
+    アーカイブ全体の展開を待たず、読み出せたページから順に変換ステージへ渡す。
+    progress が指定された場合は progress(処理済みページ数, 総ページ数) を呼び出す。
     """
     temp_dir = os.path.join(MANGA_CACHE_TEMP_DIR, os.path.basename(archive_path) + '_temp')
-    os.makedirs(temp_dir, exist_ok=True)
     os.makedirs(extract_to, exist_ok=True)
 
     try:
         # unrarコマンドの引数を厳密に制御し、シェルインジェクションを防ぐ
         # `subprocess.run`はデフォルトでシェルを使用しないため、安全
-        cmd = ['unrar', 'x', '-o+', archive_path, temp_dir] # -o+ で常に上書き
-        result = subprocess.run(cmd, check=True, capture_output=True, text=True)
-        logging.info(f"UnRARコマンド出力:\n{result.stdout}")
-
-        files = glob.glob(os.path.join(temp_dir, '*'))
-        for i, path in enumerate(sorted(files)):
-            # 画像ファイルのみを対象とする
-            if not re.search(r'\.(jpe?g|png|gif|bmp)$', path, re.I):
-                continue
-            if not os.path.isfile(path): # ディレクトリをスキップ
-                continue
-
-            try:
-                img = Image.open(path).convert('RGB')
-                img.thumbnail((1200, 1600))
-                img.save(os.path.join(extract_to, f'{i:04d}.png'), 'PNG')
-            except Exception as e:
-                logging.warning(f"画像処理エラー (RAR): {os.path.basename(path)} - {e}", exc_info=True)
+        members = rar_image_members(archive_path)
+        # 一時ディレクトリはソリッドアーカイブの場合のみ使用する
+        pages = iter_rar_pages(archive_path, members, temp_dir)
+        convert_pages(pages, extract_to, len(members), progress=progress, label='RAR')
         logging.info(f"RAR解凍と画像処理が完了しました: {archive_path} -> {extract_to}")
     except subprocess.CalledProcessError as e:
-        logging.error(f"UnRARコマンド実行エラー: {e.stderr} (コマンド: {' '.join(cmd)})", exc_info=True)
+        logging.error(f"UnRARコマンド実行エラー: {e.stderr} (コマンド: {' '.join(e.cmd)})", exc_info=True)
         shutil.rmtree(extract_to, ignore_errors=True)
         raise Exception(f"RARファイルの解凍に失敗しました。unrarツールが正しくインストールされ、利用可能か確認してください。: {e.stderr}")
     except Exception as e:
@@ -211,106 +222,172 @@ def extract_rar(archive_path, extract_to):
 
 
 # ヘルパー関数: キャッシュ管理
-def manage_cache_size(current_hash=None):
+def manage_cache_size(current_hash=None, hit=False):
     """
-    キャッシュディレクトリのサイズを管理し、制限を超えた場合は古いファイルを削除する。
-    現在読み込んでいるマンガは削除対象外とする。
+    キャッシュのサイズを管理し、予算を超えた場合は削除ポリシー（CACHE_EVICTION_POLICY）の順に削除する。
+    予算は全体・アーカイブ・抽出済み画像の3つで、まずすべてのページが抽出済みの巻からアーカイブだけを削除し、
+    それでも超える場合は巻ごと削除する。現在読み込んでいるマンガ、ジョブでダウンロード・抽出中の巻、
+    先読みしてまだ開かれていない巻は削除対象外とする（書き込み中のファイルや、これから読む巻を消さないため）。
+    hit が真の場合は、巻が開かれたものとして回数を記録する。
+    サイズと最終アクセス時刻はキャッシュインデックスから取得し、ファイルシステムは走査しない。
     """
-    items = {} # {hash: {'mtime': latest_mtime, 'size': total_size_for_hash}}
-    total_cache_size = 0 # バイト単位
-    max_size_bytes = CACHE_SIZE_LIMIT_MB * 1024 * 1024
+    with CACHE_MANAGE_SECONDS.time():
+        _manage_cache_size(current_hash, hit)
 
-    # 全てのキャッシュアイテムを走査
-    for f in os.listdir(MANGA_CACHE_DIR):
-        full_path = os.path.join(MANGA_CACHE_DIR, f)
-        
-        # ファイル名からハッシュ部分を抽出
-        # 'hash.zip' または 'hash_extracted' の形式を想定
-        match = re.match(r'([0-9a-fA-F]{32})', f)
-        if not match:
-            # 期待しないファイルはスキップ、またはログを記録
-            logging.debug(f"キャッシュディレクトリ内で不明な形式のファイルを発見: {f}")
-            continue
-        
-        item_hash = match.group(1)
-
-        size = 0
-        mtime = 0
-
-        if os.path.isfile(full_path):
-            size = os.path.getsize(full_path)
-            mtime = os.path.getmtime(full_path)
-        elif os.path.isdir(full_path):
-            # ディレクトリの場合は、その中の全ファイルの合計サイズと最新のmtime
-            for r, _, files in os.walk(full_path):
-                for file in files:
-                    file_path = os.path.join(r, file)
-                    size += os.path.getsize(file_path)
-                    mtime = max(mtime, os.path.getmtime(file_path))
-        else:
-            continue # シンボリックリンクなどは無視
+def _manage_cache_size(current_hash, hit):
+    if current_hash:
+        cache_index.touch(current_hash, hit) # 最後にアクセスしたマンガとして記録
+        if hit and CACHE_TRACE_LOG:
+            append_trace(CACHE_TRACE_LOG, current_hash, cache_index.size(current_hash))
 
-        if item_hash not in items:
-            items[item_hash] = {'mtime': mtime, 'size': size}
-        else:
-            # 既存のハッシュアイテムの情報を更新
-            items[item_hash]['mtime'] = max(items[item_hash]['mtime'], mtime)
-            items[item_hash]['size'] += size
-        
-        total_cache_size += size
+    mb = 1024 * 1024
+    limits = {'total': CACHE_SIZE_LIMIT_MB * mb, 'archive': ARCHIVE_CACHE_LIMIT_MB * mb, 'extracted': EXTRACTED_CACHE_LIMIT_MB * mb}
+    sizes = cache_index.totals() # バイト単位
 
-    logging.info(f"現在のキャッシュサイズ: {total_cache_size / (1024*1024):.2f}MB / 制限: {CACHE_SIZE_LIMIT_MB}MB")
+    def over(kind):
+        return sizes[kind] > limits[kind]
 
     # キャッシュサイズが制限を超えていなければ終了
-    if total_cache_size <= max_size_bytes:
+    if not any(over(kind) for kind in limits):
         return
 
-    logging.info("キャッシュサイズが制限を超過しました。古いアイテムを削除します。")
-
-    # 最終アクセス時間が古い順にソート
-    # current_hashがあれば、それをスキップするためにlambdaでフィルタリング
-    sorted_hashes = sorted([h for h in items if h != current_hash], key=lambda h: items[h]['mtime'])
-
-    for item_hash_to_delete in sorted_hashes:
-        if total_cache_size <= max_size_bytes:
-            break # 制限内に収まったら停止
-
-        # 関連するファイルとディレクトリを削除
-        # hash.* (例: hash.zip, hash.rar) と hash_extracted ディレクトリ
-        deleted_size = items[item_hash_to_delete]['size'] # 削除されるアイテムの総サイズ
-
-        for pattern in [f'{item_hash_to_delete}.*', f'{item_hash_to_delete}_extracted']:
-            for path in glob.glob(os.path.join(MANGA_CACHE_DIR, pattern)):
-                try:
-                    if os.path.isdir(path):
-                        shutil.rmtree(path)
-                        logging.info(f"キャッシュディレクトリを削除しました: {path}")
-                    elif os.path.isfile(path):
-                        os.remove(path)
-                        logging.info(f"キャッシュファイルを削除しました: {path}")
-                except OSError as e:
-                    logging.error(f"キャッシュ削除エラー: {path} - {e}", exc_info=True)
-        
-        total_cache_size -= deleted_size
-        logging.info(f"ハッシュ {item_hash_to_delete} のキャッシュを削除しました。現在のキャッシュサイズ: {total_cache_size / (1024*1024):.2f}MB")
+    protected = job_queue.active_ids() | prefetcher.unread_volumes()
+    if current_hash:
+        protected.add(current_hash)
+
+    logging.info(f"キャッシュサイズが制限を超過しました (全体 {sizes['total'] / mb:.2f}MB / {CACHE_SIZE_LIMIT_MB}MB, "
+                 f"アーカイブ {sizes['archive'] / mb:.2f}MB / {ARCHIVE_CACHE_LIMIT_MB}MB, "
+                 f"画像 {sizes['extracted'] / mb:.2f}MB / {EXTRACTED_CACHE_LIMIT_MB}MB)。"
+                 f"{eviction_policy.name} の順に削除します。")
+
+    # 1. アーカイブか全体の予算を超えている場合は、抽出済みの巻のアーカイブだけを削除する（ページは残る）
+    dropped = []
+    if over('archive') or over('total'):
+        for item_hash, archive_size, _, _ in cache_index.eviction_candidates(eviction_policy, protected):
+            if not (over('archive') or over('total')):
+                break
+            if archive_size and archive_droppable(item_hash):
+                dropped.append(item_hash)
+                sizes['archive'] -= archive_size
+                sizes['total'] -= archive_size
+                CACHE_EVICTED_BYTES.inc('archive', amount=archive_size)
+        for item_hash in dropped:
+            if PACK_PAGES:
+                pack_volume(item_hash)
+            delete_archive(item_hash)
+            cache_index.drop_archive(item_hash)
+            logging.info(f"ハッシュ {item_hash} のアーカイブを削除しました（抽出済みのページは残します）。")
+            CACHE_EVICTIONS.inc('archive')
+
+    # 2. まだ超えている場合は、超えている予算を減らせる巻を巻ごと削除する
+    evicted = []
+    if any(over(kind) for kind in limits):
+        for item_hash, archive_size, extracted_size, priority in cache_index.eviction_candidates(eviction_policy, protected):
+            if not any(over(kind) for kind in limits):
+                break # 制限内に収まったら停止
+            if item_hash in dropped:
+                archive_size = 0
+            if not ((over('total') and archive_size + extracted_size) or (over('archive') and archive_size)
+                    or (over('extracted') and extracted_size)):
+                continue
+            evicted.append((item_hash, priority))
+            sizes['total'] -= archive_size + extracted_size
+            sizes['archive'] -= archive_size
+            sizes['extracted'] -= extracted_size
+            CACHE_EVICTED_BYTES.inc('volume', amount=archive_size + extracted_size)
+
+    for item_hash_to_delete, _ in evicted:
+        delete_cached_files(item_hash_to_delete)
+        cache_index.remove(item_hash_to_delete)
+        logging.info(f"ハッシュ {item_hash_to_delete} のキャッシュを削除しました。")
+        CACHE_EVICTIONS.inc('volume')
+    if evicted and eviction_policy.inflates:
+        cache_index.inflate(max(priority for _, priority in evicted))
+
+    logging.info(f"現在のキャッシュサイズ: {sizes['total'] / mb:.2f}MB")
+
+def delete_cached_files(item_hash):
+    """ハッシュに関連するファイルとディレクトリを削除する"""
+    zip_pool.invalidate(item_hash) # 開いたままのZIPハンドルを閉じる
+    pack_pool.invalidate(os.path.join(MANGA_CACHE_DIR, f'{item_hash}_extracted'))
+    hot_pages.invalidate(f'{item_hash}_extracted/')
+    # hash.* (例: hash.zip, hash.rar) と hash_extracted ディレクトリ
+    for pattern in [f'{item_hash}.*', f'{item_hash}_extracted']:
+        for path in glob.glob(os.path.join(MANGA_CACHE_DIR, pattern)):
+            try:
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                    logging.info(f"キャッシュディレクトリを削除しました: {path}")
+                elif os.path.isfile(path):
+                    os.remove(path)
+                    logging.info(f"キャッシュファイルを削除しました: {path}")
+            except OSError as e:
+                logging.error(f"キャッシュ削除エラー: {path} - {e}", exc_info=True)
+
+def archive_droppable(item_hash):
+    """
+    アーカイブを削除してもすべてのページを配信できるかどうか。
+    ダイレクトモードではなく、マニフェストのすべてのページがいずれかの形式で変換済みの場合に限る。
+    マニフェストのない古いキャッシュは、変換済みの画像だけで配信されている。
+    """
+    converted = {path.rsplit('/', 1)[1] for path in list_extracted_images(item_hash)}
+    manifest = manifest_cache.get(os.path.join(MANGA_CACHE_DIR, f'{item_hash}_extracted'))
+    if manifest is None:
+        return bool(converted)
+    if is_direct(manifest['ext']):
+        return False
+    return all(page['stem'] in converted for page in manifest['pages'])
+
+def delete_archive(item_hash):
+    """抽出済みの巻のアーカイブだけを削除する（ダウンロード途中のファイルは残す）"""
+    zip_pool.invalidate(item_hash)
+    for path in glob.glob(os.path.join(MANGA_CACHE_DIR, f'{item_hash}.*')):
+        if os.path.isfile(path) and not cache_index.PARTIAL_PATTERN.search(path):
+            try:
+                os.remove(path)
+            except OSError as e:
+                logging.error(f"アーカイブ削除エラー: {path} - {e}", exc_info=True)
 
 
 # --- ルート定義 ---
 
+@app.after_request
+def advertise_client_hints(response):
+    """HTMLの応答で、ページのサイズ選択に使うクライアントヒントを要求する"""
+    if response.mimetype == 'text/html':
+        response.headers['Accept-CH'] = ', '.join(CLIENT_HINT_HEADERS)
+    return response
+
 @app.route('/')
 def index():
     """トップページ: マンガリストと追加フォームを表示する"""
     # base64モジュールをテンプレートに渡す
     return render_template('index.html', base64=base64)
 
+def render_manga_list(query='', after_title=None, after_id=None):
+    """
+    マンガリストを1ページ分描画する。query があれば全文検索の結果を返す。
+    続きがある場合は、スクロールで次のページを読み込む要素を末尾に付ける。
+    """
+    db = get_db()
+    if query:
+        mangas, cursor = library.search_page(db, query, after_id)
+    else:
+        mangas, cursor = library.list_page(db, after_title, after_id)
+    next_url = url_for('manga_list', q=query or None, **cursor) if cursor else None
+    # 表紙とページ数。まだ生成されていない巻は、バックグラウンドで生成しておく（次の表示から出る）
+    meta = metadata.summaries(db, [m['hash'] for m in mangas])
+    for manga_hash in [m['hash'] for m in mangas if metadata.needs_generation(meta.get(m['hash']))]:
+        schedule_metadata(manga_hash)
+    return render_template('manga_list.html', mangas=mangas, meta=meta, base64=base64, query=query,
+                           next_url=next_url, partial=after_id is not None)
+
 @app.route('/manga_list')
 def manga_list():
-    """マンガリストをHTMXリクエスト用に返す"""
-    db = get_db()
-    cur = db.cursor()
-    cur.execute('SELECT * FROM mangas ORDER BY title')
-    mangas = cur.fetchall()
-    return render_template('manga_list.html', mangas=mangas, base64=base64)
+    """マンガリストをHTMXリクエスト用に返す（q: 検索語、after_title/after_id: 次のページのカーソル）"""
+    return render_manga_list(request.args.get('q', '').strip(),
+                             request.args.get('after_title'),
+                             request.args.get('after_id', type=int))
 
 @app.route('/add', methods=['POST'])
 def add_manga():
@@ -323,22 +400,10 @@ def add_manga():
     if not is_valid_url(url):
         return '<p class="text-red-600">無効なURL、または許可されていないドメインです。</p>'
     
-    # URLから一意のハッシュを生成
-    manga_hash = hashlib.md5(url.encode()).hexdigest()
-    
-    # ファイル名と拡張子を安全に抽出
-    # werkzeug.utils.secure_filename を使用するのがより堅牢ですが、
-    # ここでは basename と splitext で簡単なサニタイズを行います。
-    # 完全にパストラバーサルを防ぐには、外部からのファイル名を信用しないことが重要です。
-    title_raw = os.path.splitext(os.path.basename(unquote(urlparse(url).path)))[0]
-    # タイトルからパス区切り文字や無効な文字を削除
-    title = re.sub(r'[\\/:\*?"<>|]', '', title_raw)
-    if not title: # タイトルが空になる場合に対応
-        title = manga_hash[:8] # ハッシュの一部をタイトルとして使用
-
-    ext = os.path.splitext(url)[1][1:].lower() # 拡張子から'.'を除去
-
-    if ext not in ['zip', 'cbz', 'rar', 'cbr']:
+    # URLから一意のハッシュ、タイトル、拡張子を求める（一括インポートと同じ規則）
+    manga_hash, title, ext = derive_entry(url)
+
+    if ext not in SUPPORTED_EXTS:
         return '<p class="text-red-600">無効なファイル形式です。ZIP, CBZ, RAR, CBRのみがサポートされています。</p>'
 
     db = get_db()
@@ -353,6 +418,7 @@ def add_manga():
                     (manga_hash, url, title, ext))
         db.commit()
         logging.info(f"マンガが追加されました: {title} ({url})")
+        schedule_metadata(manga_hash)
     except sqlite3.IntegrityError: # UNIQUE制約違反の場合
         logging.warning(f"マンガの追加中に整合性エラーが発生しました (重複): {url}")
         return '<p class="text-red-600">このURLは既に追加済みです。</p>'
@@ -363,6 +429,77 @@ def add_manga():
 
     return '<p class="text-green-600">マンガが正常に追加されました。</p>'
 
+BATCH_STATUS_MESSAGES = {
+    'added': '追加しました',
+    'exists': '既に追加済みです',
+    'duplicate': 'リスト内で重複しています',
+    'invalid': '無効なURL、または許可されていないドメインです',
+    'unsupported': '無効なファイル形式です',
+}
+
+@app.route('/add_batch', methods=['POST'])
+def add_manga_batch():
+    """
+    複数のマンガを1つのトランザクションでデータベースに追加する。
+    JSON（{"urls": [...], "prefetch": true}）の場合はURLごとの結果をJSONで返し、
+    フォーム（manga_urls: 1行1URL, prefetch）の場合は結果の概要をHTMLで返す。
+    prefetch を指定すると、新しく追加したマンガのダウンロードと抽出をバックグラウンドで開始する。
+    """
+    if request.is_json:
+        data = request.get_json(silent=True) or {}
+        urls = data.get('urls')
+        prefetch = bool(data.get('prefetch'))
+        if not isinstance(urls, list) or not all(isinstance(u, str) for u in urls):
+            return jsonify({'error': 'urls にはURLの配列を指定してください。'}), 400
+    else:
+        urls = request.form.get('manga_urls', '').splitlines()
+        prefetch = bool(request.form.get('prefetch'))
+    urls = [u for u in urls if u.strip()]
+
+    if not urls:
+        message = 'URLを入力してください。'
+        return (jsonify({'error': message}), 400) if request.is_json else f'<p class="text-red-600">{message}</p>'
+    if len(urls) > MAX_BATCH_URLS:
+        message = f'一度に追加できるURLは{MAX_BATCH_URLS}件までです。'
+        return (jsonify({'error': message}), 400) if request.is_json else f'<p class="text-red-600">{message}</p>'
+
+    try:
+        results = library.add_batch(get_db(), urls)
+    except Exception as e:
+        logging.error(f"マンガの一括追加中にデータベースエラーが発生しました: {e}", exc_info=True)
+        message = 'マンガの追加中にエラーが発生しました。'
+        return (jsonify({'error': message}), 500) if request.is_json else f'<p class="text-red-600">{message}</p>'
+
+    added = [r for r in results if r['status'] == 'added']
+    logging.info(f"マンガを一括追加しました: {len(added)} / {len(results)} 件")
+    for r in added:
+        schedule_metadata(r['hash'])
+
+    if prefetch:
+        # 閲覧用のジョブの枠を残すため、先読みは BATCH_PREFETCH_LIMIT 件まで
+        for r in added:
+            r['prefetch'] = 'skipped'
+        for r in added[:BATCH_PREFETCH_LIMIT]:
+            try:
+                job_queue.submit(r['hash'], lambda job, r=r: prepare_manga(r['hash'], r['url'], r['ext'], r['title'], job))
+                r['prefetch'] = 'queued'
+            except JobQueueFull:
+                logging.warning(f"ジョブキューが満杯のため、先読みを中断しました: {r['title']} (hash: {r['hash']})")
+                break
+
+    counts = {status: sum(1 for r in results if r['status'] == status) for status in BATCH_STATUS_MESSAGES}
+    if request.is_json:
+        return jsonify({'results': results, 'counts': counts})
+
+    summary = '、'.join(f'{BATCH_STATUS_MESSAGES[s]}: {n}件' for s, n in counts.items() if n)
+    failures = ''.join(f'<li>{escape(r["url"])} — {BATCH_STATUS_MESSAGES[r["status"]]}</li>'
+                       for r in results if r['status'] not in ('added', 'exists'))
+    color = 'text-green-600' if added else 'text-red-600'
+    html = f'<p class="{color}">{summary}</p>'
+    if failures:
+        html += f'<ul class="text-sm text-red-600 text-left mt-2">{failures}</ul>'
+    return html
+
 @app.route('/remove', methods=['POST'])
 def remove_manga():
     """マンガをデータベースから削除する"""
@@ -383,11 +520,8 @@ def remove_manga():
         logging.error(f"マンガ削除中にデータベースエラーが発生しました: {e}", exc_info=True)
         return '<p class="text-red-600">マンガの削除中にエラーが発生しました。</p>'
 
-    # 削除後、最新のリストを返す
-    cur = db.cursor()
-    cur.execute('SELECT * FROM mangas ORDER BY title')
-    mangas = cur.fetchall()
-    return render_template('manga_list.html', mangas=mangas, base64=base64) # base64を渡す
+    # 削除後、最新のリスト（検索中なら検索結果）の最初のページを返す
+    return render_manga_list(request.form.get('q', '').strip())
 
 @app.route('/read')
 def read_manga():
@@ -462,85 +596,610 @@ def reader_data():
     title = row['title']
     ext = row['file_ext']
 
-    archive_path = os.path.join(MANGA_CACHE_DIR, f'{manga_hash}.{ext}')
-    extract_path = os.path.join(MANGA_CACHE_DIR, f'{manga_hash}_extracted')
-
     # キャッシュサイズの管理（現在読み込んでいるマンガは削除対象外）
-    manage_cache_size(manga_hash)
+    manage_cache_size(manga_hash, hit=True)
+
+    # ページ一覧はサーバー側のマニフェストから /manga/<hash>/pages で返すため、セッションには保存しない
+    session['current_manga_hash'] = manga_hash
+    session.pop('current_manga_images', None) # 以前のバージョンで保存された一覧を削除
+    prefetcher.volume_opened(manga_hash)
 
-    # 抽出ディレクトリが存在しない、または画像が一つもない場合のみ処理
-    if not os.path.isdir(extract_path) or len(glob.glob(f'{extract_path}/*.png')) == 0:
+    job = job_queue.get(manga_hash)
+    # 抽出ディレクトリが存在しない、または画像が一つもない場合はジョブで処理
+    if (job is not None and job.active) or not list_page_paths(manga_hash, ext):
         logging.info(f"マンガをダウンロード/抽出します: {title} (hash: {manga_hash})")
+        READER_CACHE.inc('miss')
         try:
-            download_file(url, archive_path)
-            # 既に抽出ディレクトリが存在する場合は、古い内容を削除して再抽出
-            if os.path.exists(extract_path):
-                shutil.rmtree(extract_path)
-            
-            if ext in ['zip', 'cbz']:
-                extract_zip(archive_path, extract_path)
-            elif ext in ['rar', 'cbr']:
-                extract_rar(archive_path, extract_path)
-            else:
-                logging.error(f"未対応のファイル拡張子: {ext}")
-                abort(500, "未対応のファイル形式です。")
-        except Exception as e:
-            logging.error(f"マンガのダウンロードまたは抽出に失敗しました: {title} - {e}", exc_info=True)
-            # エラー発生時は、不完全なキャッシュをクリーンアップ
-            if os.path.exists(archive_path):
-                os.remove(archive_path)
-            if os.path.exists(extract_path):
-                shutil.rmtree(extract_path)
-            abort(500, f"マンガの読み込み中にエラーが発生しました: {e}")
-    else:
-        logging.info(f"キャッシュからマンガをロードします: {title} (hash: {manga_hash})")
+            job = job_queue.submit(manga_hash, lambda job: prepare_manga(manga_hash, url, ext, title, job))
+        except JobQueueFull:
+            logging.warning(f"ジョブキューが満杯のため受け付けできません: {title} (hash: {manga_hash})")
+            abort(503, "サーバーが混雑しています。しばらくしてから再度お試しください。")
+        return render_template('reader_content.html', title=title, manga_hash=manga_hash,
+                               total_pages=job.total_pages, offset=0, job_id=job.id)
+
+    READER_CACHE.inc('hit')
+    logging.debug(f"キャッシュからマンガをロードします: {title} (hash: {manga_hash})")
+    total_pages = len(list_page_paths(manga_hash, ext))
+    logging.debug(f"reader_content.htmlをレンダリングします。総ページ数: {total_pages}")
+    return render_template('reader_content.html', title=title, manga_hash=manga_hash,
+                           total_pages=total_pages, offset=0, job_id=None)
+
+# 変換済みページのファイル名（連番[_バリアント].拡張子）。一時ファイル（*.tmp）は含まない
+PAGE_FILE_PATTERN = re.compile(r'(\d{4})(?:_[a-z]+)?\.(avif|webp|jpg|png)$')
+
+def list_extracted_images(manga_hash):
+    """
+    抽出済みのページを '<hash>_extracted/<連番>' の形式（MANGA_CACHE_DIRからの相対パス）でページ順に返す。
+    保存形式は /image で Accept ヘッダーに応じて選ばれるため、パスには拡張子を含めない。
+    """
+    extract_path = os.path.join(MANGA_CACHE_DIR, f'{manga_hash}_extracted')
+    try:
+        names = os.listdir(extract_path)
+    except FileNotFoundError:
+        return []
+    if PACK_NAME in names:
+        names += pack_pool.names(extract_path)
+    stems = sorted({m.group(1) for m in map(PAGE_FILE_PATTERN.match, names) if m})
+    return [f'{manga_hash}_extracted/{stem}' for stem in stems]
+
+def pack_volume(manga_hash):
+    """
+    抽出済みのページを巻ごとの1つのページパックにまとめ、まとめたファイルを削除する。
+    抽出済みサイズの増減をキャッシュインデックスに反映する（最終アクセス時刻は変えない）。
+    アーカイブのバージョンをパックに記録し、アーカイブを削除した後もインデックスを作り直せるようにする。
+    """
+    extract_path = os.path.join(MANGA_CACHE_DIR, f'{manga_hash}_extracted')
+    names = [n for n in os.listdir(extract_path) if PAGE_FILE_PATTERN.match(n)]
+    if not names:
+        return
+    before = cache_index.dir_size(extract_path)
+    write_pack(extract_path, names, cache_index.version(manga_hash))
+    for name in names:
+        os.remove(os.path.join(extract_path, name))
+    cache_index.add_extracted_size(manga_hash, cache_index.dir_size(extract_path) - before)
+    logging.info(f"ページをページパックにまとめました: {manga_hash} ({len(names)} ファイル)")
+
+def page_stored(extract_path, name):
+    """変換済みのページが、個別のファイルかページパックとして保存されているかどうか"""
+    return os.path.isfile(os.path.join(extract_path, name)) or pack_pool.contains(extract_path, name)
+
+def is_direct(ext):
+    """ダイレクトモード（アーカイブから直接配信）で扱う形式かどうか"""
+    return DIRECT_MODE and ext in ['zip', 'cbz']
+
+def list_page_paths(manga_hash, ext):
+    """
+    ページのパスをMANGA_CACHE_DIRからの相対パスでページ順に返す。
+    ダイレクトモードでは '<hash>/direct/<ページ番号>' の形式になる。
+    それ以外ではページマニフェスト（メモリにキャッシュ）から、未変換のページも含めて返す。
+    マニフェストがない古いキャッシュは、変換済みのファイルを列挙する。
+    """
+    if is_direct(ext):
+        archive_path = os.path.join(MANGA_CACHE_DIR, f'{manga_hash}.{ext}')
+        if not os.path.isfile(archive_path):
+            return []
+        return [f'{manga_hash}/direct/{n}' for n in range(zip_pool.page_count(manga_hash, archive_path))]
+    manifest = manifest_cache.get(os.path.join(MANGA_CACHE_DIR, f'{manga_hash}_extracted'))
+    if manifest:
+        return [f"{manga_hash}_extracted/{page['stem']}" for page in manifest['pages']]
+    return list_extracted_images(manga_hash)
+
+def converted_prefix(manga_hash, ext):
+    """
+    変換中の巻で、先頭から途切れずに変換済みになっているページのパスを返す。
+    ページは並列に変換されて順不同に完了するため、変換済みのページだけを並べると offset がページ番号とずれる。
+    先頭から続く部分だけを返せば、クライアントは offset を進めながら続きを読み込める。
+    """
+    ready = set(list_extracted_images(manga_hash))
+    pages = []
+    for path in list_page_paths(manga_hash, ext):
+        if path not in ready:
+            break
+        pages.append(path)
+    return pages
+
+def render_page(manga_hash, stem, fmt, variant='full'):
+    """
+    ページを指定の形式で変換し、全サイズのバリアントをキャッシュに保存して、要求されたバリアントのパスを返す。
+    遅延変換では初めて要求されたページを、それ以外では未保存の形式をここで作成する。
+    変換元はページマニフェストが指すアーカイブのメンバーで、アーカイブがない場合は
+    既に別の形式で保存されたページを使う。変換できない場合は None を返す。
+    """
+    extract_path = os.path.join(MANGA_CACHE_DIR, f'{manga_hash}_extracted')
+    dest_stem = os.path.join(extract_path, stem)
+    manifest = manifest_cache.get(extract_path)
+    page = manifest['by_stem'].get(stem) if manifest else None
 
+    try:
+        with contextlib.ExitStack() as stack:
+            source = None
+            if page is not None:
+                ext = manifest['ext']
+                archive_path = os.path.join(MANGA_CACHE_DIR, f'{manga_hash}.{ext}')
+                if os.path.isfile(archive_path):
+                    if ext in ['zip', 'cbz']:
+                        # プールのハンドルからストリームで読み、メンバー全体をメモリに読み込まない
+                        source = stack.enter_context(zip_pool.open_member(manga_hash, archive_path, page['member']))
+                    else:
+                        source = read_member(archive_path, ext, page['member'])
+            if source is None:
+                source = next((f'{dest_stem}.{file_ext(other)}' for other in FORMATS
+                               if os.path.isfile(f'{dest_stem}.{file_ext(other)}')), None)
+            if source is None:
+                # アーカイブを削除した巻は、ページパックに保存された別の形式から変換する
+                source = next((data for data in (pack_pool.read(extract_path, f'{stem}.{file_ext(other)}') for other in FORMATS)
+                               if data is not None), None)
+            if source is None:
+                return None
+            paths = convert_page(source, dest_stem, fmt)
+    except Exception as e:
+        logging.warning(f"画像処理エラー (ページ変換): {manga_hash}/{stem} - {e}", exc_info=True)
+        return None
+    cache_index.add_extracted_size(manga_hash, sum(os.path.getsize(p) for p in paths.values()))
+    logging.debug(f"ページを変換しました: {dest_stem} ({fmt})")
+    return paths[variant]
 
-    images = sorted(glob.glob(f'{extract_path}/*.png'))
-    if not images:
-        logging.error(f"抽出された画像が見つかりません: {extract_path}")
-        # 画像がない場合、キャッシュをクリーンアップして再試行を促す
+# ページのサイズ選択に使うクライアントヒント
+CLIENT_HINT_HEADERS = ('Sec-CH-Width', 'Sec-CH-Viewport-Width', 'Sec-CH-DPR')
+
+# ページの応答の Vary（クエリで variant を指定した場合はクライアントヒントに依存しない）
+PAGE_VARY = 'Accept'
+PAGE_VARY_WITH_HINTS = ', '.join(('Accept',) + CLIENT_HINT_HEADERS)
+
+def add_page_vary(response):
+    """ページの応答が依存するリクエストヘッダーを Vary に設定する"""
+    response.headers['Vary'] = PAGE_VARY if 'variant' in request.args else PAGE_VARY_WITH_HINTS
+
+# ページの内容に影響する設定。変更するとETagも変わる
+PAGE_SETTINGS_FINGERPRINT = repr((PAGE_MAX_SIZE, sorted(PAGE_VARIANTS.items()), PAGE_QUALITY_TIERS[PAGE_QUALITY]))
+
+def page_etag(manga_hash, page, variant, fmt, cached_only=False):
+    """
+    ページの強いETagを作成する。キャッシュインデックスのアーカイブのバージョンと、
+    ページ・サイズ・形式・設定から決まるため、ファイルシステムを見ずに計算できる。
+    インデックスにない場合（cached_only ではバージョンがメモリにない場合も）は None。
+    """
+    version = cache_index.version(manga_hash, cached_only)
+    if version is None:
+        return None
+    key = f'{manga_hash}:{version}:{page}:{variant}:{fmt}:{PAGE_SETTINGS_FINGERPRINT}'
+    return hashlib.md5(key.encode()).hexdigest()
+
+PAGE_CACHE_CONTROL = f'public, max-age={IMAGE_CACHE_MAX_AGE}, immutable'
+
+def set_page_cache_headers(response, etag):
+    """ページの応答にETagと長期キャッシュ用のヘッダーを設定する"""
+    if etag:
+        response.set_etag(etag)
+    # send_file が付ける no-cache を置き換える（cache_control の属性を1つずつ設定すると、そのたびにヘッダーを作り直す）
+    response.headers['Cache-Control'] = PAGE_CACHE_CONTROL
+    add_page_vary(response)
+    return response
+
+def not_modified(etag):
+    """If-None-Match がETagと一致する場合に返す304応答（一致しなければ None）"""
+    if etag and request.if_none_match.contains(etag):
+        return set_page_cache_headers(app.response_class(status=304), etag)
+    return None
+
+def select_variant():
+    """
+    ページのサイズバリアントを選ぶ。
+    クエリパラメーター variant を優先し、なければクライアントヒント（表示幅、またはビューポート幅×DPR）から、
+    その幅を満たす最小のバリアントを選ぶ。どちらもなければ 'full'。
+    """
+    variant = request.args.get('variant')
+    if variant in PAGE_VARIANTS:
+        return variant
+
+    width = request.headers.get('Sec-CH-Width') or request.headers.get('Width')
+    if not width:
+        viewport = request.headers.get('Sec-CH-Viewport-Width') or request.headers.get('Viewport-Width')
+        dpr = request.headers.get('Sec-CH-DPR') or request.headers.get('DPR') or '1'
+        try:
+            width = float(viewport) * float(dpr) if viewport else None
+        except ValueError:
+            width = None
+    try:
+        width = float(width) if width else None
+    except ValueError:
+        width = None
+    if not width:
+        return 'full'
+    for name, size in sorted(PAGE_VARIANTS.items(), key=lambda v: v[1][0]):
+        if size[0] >= width:
+            return name
+    return 'full'
+
+def srcset_for(url):
+    """ページURLの srcset 文字列（'<URL>?variant=<名前> <幅>w, ...'）を作成する"""
+    return ', '.join(f'{url}?variant={name} {size[0]}w'
+                     for name, size in sorted(PAGE_VARIANTS.items(), key=lambda v: v[1][0]))
+
+def negotiate_format():
+    """Accept ヘッダーから、クライアントが対応するページ形式を優先順に選ぶ"""
+    # image/* や */* だけでは WebP/AVIF に対応しているとは限らないため、明示されたものだけを見る
+    accepted = {mime for mime, quality in request.accept_mimetypes if quality > 0}
+    for fmt in available_formats():
+        if fmt in ('jpeg', 'png') or mime_type(fmt) in accepted:
+            return fmt
+    return 'jpeg'
+
+def prepare_manga(manga_hash, url, ext, title, job=None):
+    """
+    マンガをダウンロードして抽出する（バックグラウンドジョブから実行される）。
+    失敗した場合は不完全なキャッシュをクリーンアップして例外を送出する。
+    """
+    archive_path = os.path.join(MANGA_CACHE_DIR, f'{manga_hash}.{ext}')
+    extract_path = os.path.join(MANGA_CACHE_DIR, f'{manga_hash}_extracted')
+    try:
+        if job:
+            job.set_state('downloading')
+        download_file(url, archive_path, progress=job.download_progress if job else None)
+        cache_index.record(manga_hash, archive_size=os.path.getsize(archive_path), version=os.path.getmtime(archive_path))
+        # RAR やダウンロード前に生成できなかった巻は、アーカイブがあるうちにメタデータを生成する
+        summary = metadata.summaries(get_connection(), [manga_hash]).get(manga_hash)
+        if summary is None or summary['error'] is not None:
+            generate_metadata(manga_hash, archive_path)
+        if is_direct(ext):
+            # ダイレクトモードでは抽出せず、アーカイブ内の画像を確認するだけ
+            page_count = zip_pool.page_count(manga_hash, archive_path)
+            if job:
+                job.extract_progress(page_count, page_count)
+            if not page_count:
+                raise Exception("マンガの画像が見つかりませんでした。再度追加してみてください。")
+            return
+
+        # 既に抽出ディレクトリが存在する場合は、古い内容を削除して再抽出
+        if os.path.exists(extract_path):
+            shutil.rmtree(extract_path)
+
+        if job:
+            job.set_state('extracting')
+        # メンバー一覧からページマニフェストを作成する（遅延変換や別形式への変換の元になる）
+        members = image_members(archive_path, ext)
+        if not members:
+            raise Exception("マンガの画像が見つかりませんでした。再度追加してみてください。")
+        write_manifest(extract_path, ext, members)
+
+        if LAZY_CONVERSION:
+            # 遅延変換ではページマニフェストだけを作成し、ページは配信時に変換する
+            if job:
+                job.extract_progress(0, len(members))
+            cache_index.record(manga_hash, extracted_size=cache_index.dir_size(extract_path))
+            return
+
+        if ext in ['zip', 'cbz']:
+            extract_zip(archive_path, extract_path, progress=job.extract_progress if job else None)
+        elif ext in ['rar', 'cbr']:
+            extract_rar(archive_path, extract_path, progress=job.extract_progress if job else None)
+        else:
+            logging.error(f"未対応のファイル拡張子: {ext}")
+            raise Exception("未対応のファイル形式です。")
+        cache_index.record(manga_hash, extracted_size=cache_index.dir_size(extract_path))
+
+        if not list_extracted_images(manga_hash):
+            logging.error(f"抽出された画像が見つかりません: {extract_path}")
+            raise Exception("マンガの画像が見つかりませんでした。再度追加してみてください。")
+
+        # 変換が完了した巻は、ページを1つのファイルにまとめ、元のアーカイブを削除する
+        if PACK_PAGES:
+            pack_volume(manga_hash)
+        if DROP_ARCHIVE_AFTER_CONVERSION:
+            delete_archive(manga_hash)
+            cache_index.drop_archive(manga_hash)
+    except Exception as e:
+        logging.error(f"マンガのダウンロードまたは抽出に失敗しました: {title} - {e}", exc_info=True)
+        # エラー発生時は、不完全なキャッシュをクリーンアップ
+        zip_pool.invalidate(manga_hash)
         if os.path.exists(archive_path):
             os.remove(archive_path)
         if os.path.exists(extract_path):
             shutil.rmtree(extract_path)
-        abort(404, "マンガの画像が見つかりませんでした。再度追加してみてください。")
+        cache_index.remove(manga_hash)
+        raise
 
-    session['current_manga_images'] = [os.path.relpath(p, MANGA_CACHE_DIR) for p in images]
-    session['current_manga_hash'] = manga_hash # 現在読み込んでいるマンガのハッシュをセッションに保存
-    logging.info(f"reader_content.htmlをレンダリングします。総ページ数: {len(images)}")
-    return render_template('reader_content.html', title=title, total_pages=len(images), offset=0)
+def schedule_read_ahead(manga_hash, ext, paths, position, fmt):
+    """
+    読み込まれたページの位置（position）から、先のページの変換と次の巻のダウンロードを先読みに登録する。
+    ページは PREFETCH_PAGES 枚先まで、まだ fmt で保存されていないものだけを変換する。
+    巻の PREFETCH_NEXT_VOLUME_AT まで読んだら、次の巻を先読みする（登録できるまで、ページを読み込むたびに試す）。
+    """
+    if not is_direct(ext):
+        extract_path = os.path.join(MANGA_CACHE_DIR, f'{manga_hash}_extracted')
+        stems = [p.rsplit('/', 1)[1] for p in paths[position:position + PREFETCH_PAGES]]
+        missing = [s for s in stems if not page_stored(extract_path, f'{s}.{file_ext(fmt)}')]
+        if missing:
+            prefetcher.submit(('pages', manga_hash, missing[0], fmt), lambda: warm_pages(manga_hash, missing, fmt))
+    key = ('volume', manga_hash)
+    if paths and position >= len(paths) * PREFETCH_NEXT_VOLUME_AT and not prefetcher.is_done(key):
+        prefetcher.submit(key, lambda: prefetch_next_volume(manga_hash))
+
+def warm_pages(manga_hash, stems, fmt):
+    """先読み: ページを変換してキャッシュに保存する（既に保存されたページは飛ばす）"""
+    extract_path = os.path.join(MANGA_CACHE_DIR, f'{manga_hash}_extracted')
+    for stem in stems:
+        if not page_stored(extract_path, f'{stem}.{file_ext(fmt)}'):
+            render_page(manga_hash, stem, fmt)
+    logging.debug(f"ページを先読みしました: {manga_hash} {stems[0]}〜{stems[-1]} ({fmt})")
 
-@app.route('/get_images')
-def get_images():
-    """マンガ画像をチャンクで返す（AJAX用）"""
-    images_relative_paths = session.get('current_manga_images', [])
-    manga_hash = session.get('current_manga_hash') # キャッシュ管理のためにハッシュも取得
+def prefetch_next_volume(manga_hash):
+    """
+    先読み: 同じシリーズの次の巻をバックグラウンドジョブでダウンロード・抽出する。
+    まだ開かれていない先読み済みの巻が PREFETCH_BUDGET_MB を超える場合や、
+    次の巻を加えるとキャッシュの予算（アーカイブ・全体、事前変換では抽出済み画像も）を超える場合は行わない。
+    予算を超えると、次に manage_cache_size が呼ばれたときに先読みした巻（一度も開かれていない）が削除されるため。
+    次の巻のサイズはメタデータのアーカイブのサイズを使い、分からない場合は MAX_DOWNLOAD_SIZE_MB とみなす。
+    ジョブを登録したか、先読みが不要な場合（次の巻がない、既にある）だけ完了とし、
+    予算やキューの都合で見送った場合は、次にページを読み込んだときに改めて試す。
+    """
+    key = ('volume', manga_hash)
+    row = library.next_volume(get_connection(), manga_hash)
+    if row is None:
+        prefetcher.done(key)
+        return
+    next_hash = row['hash']
+    job = job_queue.get(next_hash)
+    if (job is not None and job.active) or list_page_paths(next_hash, row['file_ext']):
+        prefetcher.done(key)
+        return
+    mb = 1024 * 1024
+    unread_bytes = sum(cache_index.size(h) for h in prefetcher.unread_volumes())
+    if unread_bytes >= PREFETCH_BUDGET_MB * mb:
+        logging.debug(f"先読みの予算に達したため、次の巻を先読みしません: {row['title']}")
+        return
+    summary = metadata.summaries(get_connection(), [next_hash]).get(next_hash)
+    expected = (summary and summary['archive_size']) or MAX_DOWNLOAD_SIZE_MB * mb
+    sizes = cache_index.totals()
+    # 事前変換では、変換したページ（アーカイブと同程度のサイズ）も加わる
+    extracted = 0 if LAZY_CONVERSION or is_direct(row['file_ext']) else expected
+    if (sizes['archive'] + expected > ARCHIVE_CACHE_LIMIT_MB * mb
+            or sizes['extracted'] + extracted > EXTRACTED_CACHE_LIMIT_MB * mb
+            or sizes['total'] + expected + extracted > CACHE_SIZE_LIMIT_MB * mb):
+        logging.debug(f"次の巻（{expected / mb:.1f}MB）がキャッシュの予算に収まらないため、先読みしません: {row['title']}")
+        return
+    try:
+        job_queue.submit(next_hash, lambda job: prepare_manga(next_hash, row['url'], row['file_ext'], row['title'], job))
+    except JobQueueFull:
+        logging.debug(f"ジョブキューが満杯のため、次の巻を先読みしません: {row['title']}")
+        return
+    prefetcher.done(key)
+    prefetcher.add_volume(next_hash)
+    logging.info(f"次の巻を先読みします: {row['title']} (hash: {next_hash})")
 
-    if not images_relative_paths or not manga_hash:
-        logging.warning("get_imagesリクエストでセッションデータが見つかりません。")
-        return jsonify({'images': [], 'current_offset': 0, 'total_pages': 0}), 404
+@app.route('/job_status/<job_id>')
+def job_status(job_id):
+    """
+    バックグラウンドジョブの進捗をJSONで返す（リーダーがポーリングする）。
+    ASGI で配信する場合は、?wait=<秒> を指定すると state と pages_done が変わるまで待ってから返す（asgi.py）。
+    """
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'job_id': job_id, 'state': 'unknown'}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/manga/<manga_hash>/pages')
+def manga_pages(manga_hash):
+    """
+    ページのURLを offset から limit 枚ずつ返す（AJAX用）。
+    ページ一覧はサーバー側のページマニフェストから作るため、セッションに依存しない。
+    """
+    if not re.fullmatch(r'[0-9a-f]{32}', manga_hash):
+        abort(404)
+    row = get_db().execute('SELECT file_ext FROM mangas WHERE hash=?', (manga_hash,)).fetchone()
+    if not row:
+        logging.warning(f"データベースに存在しないマンガのページ一覧リクエスト: {manga_hash}")
+        abort(404)
+
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    limit = min(max(request.args.get('limit', IMAGES_PER_LOAD, type=int), 1), MAX_PAGES_PER_REQUEST)
+
+    job = job_queue.get(manga_hash)
+    if job and job.active:
+        # ジョブ実行中は、先頭から続けて変換済みのページだけを返す
+        images_relative_paths = converted_prefix(manga_hash, row['file_ext'])
+    else:
+        images_relative_paths = list_page_paths(manga_hash, row['file_ext'])
+        if not images_relative_paths:
+            logging.warning(f"ページ一覧リクエストで画像が見つかりません: {manga_hash}")
+            return jsonify({'images': [], 'current_offset': offset, 'total_pages': 0}), 404
 
-    offset = int(request.args.get('offset', 0))
-    
     # 最後にアクセスしたマンガとしてキャッシュ管理に反映
     manage_cache_size(manga_hash)
 
-    slice_ = images_relative_paths[offset:offset+IMAGES_PER_LOAD]
-    
-    # 画像のURLを生成
+    slice_ = images_relative_paths[offset:offset+limit]
+
+    # 画像のURLを生成（サイズバリアントを選べるよう srcset も返す）
     image_urls = [f'/image/{p}' for p in slice_]
+    srcsets = [srcset_for(u) for u in image_urls]
 
+    if PREFETCH_ENABLED and not (job and job.active):
+        schedule_read_ahead(manga_hash, row['file_ext'], images_relative_paths, offset + len(slice_), negotiate_format())
+
+    total_pages = job.total_pages if job and job.active else len(images_relative_paths)
     logging.debug(f"画像を提供中: オフセット {offset}, 取得枚数 {len(slice_)}")
     return jsonify({
         'images': image_urls,
+        'srcsets': srcsets,
         'current_offset': offset,
-        'total_pages': len(images_relative_paths)
+        'total_pages': total_pages
     })
 
+@app.route('/get_images')
+def get_images():
+    """以前のリーダー用: セッションのマンガについて /manga/<hash>/pages と同じ結果を返す"""
+    manga_hash = session.get('current_manga_hash')
+    if not manga_hash:
+        logging.warning("get_imagesリクエストでセッションデータが見つかりません。")
+        return jsonify({'images': [], 'current_offset': 0, 'total_pages': 0}), 404
+    return manga_pages(manga_hash)
+
+@app.route('/image/<manga_hash>/direct/<int:page>')
+def serve_direct_page(manga_hash, page):
+    """ダイレクトモード: キャッシュ済みZIPからページを直接配信する（必要な場合のみ変換）"""
+    if not re.fullmatch(r'[0-9a-f]{32}', manga_hash):
+        abort(404)
+
+    fmt = negotiate_format()
+    variant = select_variant()
+    etag = page_etag(manga_hash, page, variant, fmt)
+    response = not_modified(etag)
+    if response:
+        return response
+
+    db = get_db()
+    row = db.execute('SELECT file_ext FROM mangas WHERE hash=?', (manga_hash,)).fetchone()
+    if not row or not is_direct(row['file_ext']):
+        abort(404)
+    archive_path = os.path.join(MANGA_CACHE_DIR, f"{manga_hash}.{row['file_ext']}")
+
+    try:
+        info, fp = zip_pool.open_page(manga_hash, archive_path, page)
+    except (IndexError, FileNotFoundError):
+        logging.warning(f"ページが見つかりません: {manga_hash}/{page}")
+        abort(404)
+
+    page_mime_type = direct_mime_type(fp) if variant == 'full' else None
+    if page_mime_type is None:
+        # サイズ上限を超えるページ、未対応形式のページ、縮小バリアントの要求のみ変換する
+        try:
+            with fp:
+                data = transcode_page(fp, fmt, PAGE_VARIANTS[variant])
+        except PageTooLarge as e:
+            logging.warning(f"画像処理エラー (ページ変換): {manga_hash}/{page} - {e}")
+            abort(404)
+        response = app.response_class(data, mimetype=mime_type(fmt))
+        length = len(data)
+    else:
+        # そのまま配信できるページは、メンバーをバイト列に読み込まずにストリームで返す
+        response = app.response_class(wrap_file(request.environ, fp), mimetype=page_mime_type, direct_passthrough=True)
+        response.content_length = length = info.file_size
+    response = set_page_cache_headers(response, etag)
+    # Range リクエストにも対応する
+    return response.make_conditional(request, accept_ranges=True, complete_length=length)
+
+def generate_metadata(manga_hash, archive_path=None):
+    """
+    巻のメタデータを生成して保存する（バックグラウンドのスレッドやジョブから呼ぶ）。
+    ダウンロード済みのアーカイブがあればそれを、なければURLから Range で先頭の画像だけを読む。
+    失敗した場合は理由を記録し、METADATA_RETRY_AFTER 秒が経つまで再試行しない。
+    """
+    db = get_connection()
+    row = db.execute('SELECT url, file_ext FROM mangas WHERE hash = ?', (manga_hash,)).fetchone()
+    if row is None:
+        return
+    if archive_path is None:
+        local_path = os.path.join(MANGA_CACHE_DIR, f'{manga_hash}.{row["file_ext"]}')
+        archive_path = local_path if os.path.isfile(local_path) else None
+    try:
+        meta = metadata.generate(row['url'], row['file_ext'], archive_path)
+    except metadata.RangeNotSupported as e:
+        logging.info(f"メタデータはダウンロード後に生成します: {manga_hash} - {e}")
+        metadata.save(db, manga_hash, error=str(e))
+        return
+    except Exception as e:
+        # 通信エラー（requests の例外は OSError）はトレースバックを出さない
+        logging.warning(f"メタデータの生成に失敗しました: {manga_hash} - {e}", exc_info=not isinstance(e, OSError))
+        metadata.save(db, manga_hash, error=str(e) or type(e).__name__)
+        return
+    metadata.save(db, manga_hash, meta)
+
+def schedule_metadata(manga_hash):
+    """メタデータの生成をバックグラウンドのキューに登録する（登録済み、または満杯なら何もしない）"""
+    metadata_queue.submit(('metadata', manga_hash), lambda: generate_metadata(manga_hash))
+
+@app.route('/cover/<manga_hash>')
+def serve_cover(manga_hash):
+    """
+    巻の表紙のサムネイルを返す。内容は生成後に変わらないため、長期間キャッシュさせる
+    （一覧では更新時刻をクエリに付けて参照する）。まだない場合は生成を登録して404を返す。
+    """
+    if not re.fullmatch(r'[0-9a-f]{32}', manga_hash):
+        abort(404)
+    result = metadata.cover(get_db(), manga_hash)
+    if result is None:
+        schedule_metadata(manga_hash)
+        abort(404)
+    data, updated_at = result
+    response = app.response_class(data, mimetype=metadata.COVER_MIME)
+    response.set_etag(hashlib.md5(f'{manga_hash}:{updated_at}'.encode()).hexdigest())
+    response.headers['Cache-Control'] = f'public, max-age={IMAGE_CACHE_MAX_AGE}'
+    return response.make_conditional(request)
+
+def send_page_slice(page, fmt, etag=None):
+    """
+    ページパック内のページ（PageSlice）の応答。Range リクエストにも対応する。
+    send_file と同じく wsgi.file_wrapper で返すため、gunicorn では os.sendfile でページの範囲だけを送信する。
+    """
+    response = app.response_class(wrap_file(request.environ, page), mimetype=mime_type(fmt), direct_passthrough=True)
+    response.content_length = page.length
+    if etag:
+        response.set_etag(etag) # If-Range の判定に使うため、make_conditional の前に設定する
+    return response.make_conditional(request, accept_ranges=True, complete_length=page.length)
+
+def send_page_location(location, fmt, etag):
+    """ページの場所からの応答。ファイルが削除されたか、パックが作り直された場合は None"""
+    if location.stamp is None:
+        try:
+            response = send_file(location.path, mimetype=mime_type(fmt), etag=etag, conditional=True)
+        except FileNotFoundError:
+            return None
+    else:
+        page = open_page(location)
+        if page is None:
+            return None
+        response = send_page_slice(page, fmt, etag)
+    return set_page_cache_headers(response, etag)
+
+PAGE_PATH = re.compile(r'([0-9a-f]{32})_extracted/(\d{4})')
+
+def cached_page_response(match, fmt, variant, etag):
+    """
+    ファイルシステムを確認せずに返せるページの応答（304、またはホットページ）。どちらでもなければ None。
+    （パスは正規表現で検証済み。ETagがない場合は内容を特定できないため使わない）
+    """
+    # 条件付きリクエストは、ファイルシステムを確認する前に304で返す
+    response = not_modified(etag)
+    if response:
+        return response
+    # 最近配信したページは、保持している場所から返す
+    key = (match.group(0), variant, fmt, etag)
+    location = hot_pages.get(key) if etag and hot_pages.enabled else None
+    if location is not None:
+        response = send_page_location(location, fmt, etag)
+        if response:
+            return response
+        hot_pages.discard(key)
+    return None
+
+def serve_cached_page(path):
+    """
+    ASGI のイベントループから呼ぶ: メモリだけで返せるページの応答（ETagがプロセス内にあるページの304）。
+    ホットページを含め、ファイルやデータベースを読む必要がある場合は None を返し、
+    呼び出し側が serve_image をスレッドで実行する（open や stat でイベントループを止めない）。
+    """
+    match = PAGE_PATH.fullmatch(path)
+    if not match:
+        return None
+    fmt = negotiate_format()
+    variant = select_variant()
+    etag = page_etag(match.group(1), match.group(2), variant, fmt, cached_only=True)
+    return not_modified(etag)
+
 @app.route('/image/<path:path>')
 def serve_image(path):
     """キャッシュディレクトリから画像ファイルを安全に提供する"""
+    match = PAGE_PATH.fullmatch(path)
+    if match:
+        # ページ: Accept ヘッダーに応じて形式を、クエリ/クライアントヒントに応じてサイズを選ぶ
+        fmt = negotiate_format()
+        variant = select_variant()
+        etag = page_etag(match.group(1), match.group(2), variant, fmt)
+        response = cached_page_response(match, fmt, variant, etag)
+        if response:
+            return response
+        hot_key = (path, variant, fmt, etag)
+
     # pathはMANGA_CACHE_DIRからの相対パスとして解釈される
     full_path = os.path.join(MANGA_CACHE_DIR, path)
 
@@ -550,15 +1209,47 @@ def serve_image(path):
         logging.warning(f"不正な画像パスアクセス試行: {path}")
         abort(403) # Forbidden
 
-    if not os.path.exists(full_path) or not os.path.isfile(full_path):
+    if match:
+        # ページごとに保存されたファイルを返す
+        page_path = f'{variant_stem(full_path, variant)}.{file_ext(fmt)}'
+        if not os.path.isfile(page_path):
+            # ページパックにまとめた巻は、パック内のページの範囲を返す
+            location = pack_pool.locate(os.path.dirname(full_path), os.path.basename(page_path))
+            page = open_page(location) if location else None
+            if page is not None:
+                if etag:
+                    hot_pages.put(hot_key, location)
+                return set_page_cache_headers(send_page_slice(page, fmt, etag), etag)
+            # 遅延変換、またはこの形式がまだ保存されていない場合はここで変換する
+            page_path = render_page(match.group(1), match.group(2), fmt, variant)
+            if page_path is None:
+                logging.warning(f"画像ファイルが見つかりません: {full_path}")
+                abort(404)
+        if etag:
+            hot_pages.put(hot_key, PageLocation(page_path, None, 0, None))
+        # send_file が Range リクエストと（ETagがない場合の）条件付きリクエストを処理する
+        response = send_file(page_path, mimetype=mime_type(fmt), etag=etag or True, conditional=True)
+        return set_page_cache_headers(response, etag)
+
+    # 拡張子付きのパス: 保存形式は拡張子から判定する
+    fmt = FORMAT_BY_EXT.get(os.path.splitext(path)[1][1:].lower())
+    if fmt is not None and not os.path.isfile(full_path):
+        location = pack_pool.locate(os.path.dirname(full_path), os.path.basename(full_path))
+        page = open_page(location) if location else None
+        if page is not None:
+            return send_page_slice(page, fmt)
+    if fmt is None or not os.path.isfile(full_path):
         logging.warning(f"画像ファイルが見つかりません: {full_path}")
         abort(404)
-    
-    # MIMEタイプを適切に推測する (例: image/webp)
-    # python-magicを使っていればより正確ですが、ここでは拡張子から推測
-    mime_type = "image/png" # 現状はすべてpngで保存されるため固定
-    
-    return send_file(full_path, mimetype=mime_type)
+    return send_file(full_path, mimetype=mime_type(fmt))
+
+@app.route('/metrics')
+def serve_metrics():
+    """Prometheus のテキスト形式のメトリクス（全ワーカーの合計）と、キャッシュの現在のサイズ"""
+    totals = cache_index.totals()
+    gauges = [('manga_cache_bytes', 'キャッシュの現在のサイズ（バイト）', ('kind',),
+               {(kind,): totals[kind] for kind in ('archive', 'extracted', 'total')})]
+    return app.response_class(metrics.render(gauges), mimetype='text/plain; version=0.0.4')
 
 @app.route('/clear_cache', methods=['POST'])
 def clear_cache():
@@ -575,6 +1266,11 @@ def clear_cache():
                 shutil.rmtree(path)
                 logging.info(f"キャッシュディレクトリを削除しました: {path}")
         
+        zip_pool.clear()
+        pack_pool.clear()
+        hot_pages.clear()
+        cache_index.clear()
+
         # MANGA_CACHE_TEMP_DIRもクリア
         if os.path.exists(MANGA_CACHE_TEMP_DIR):
             shutil.rmtree(MANGA_CACHE_TEMP_DIR)
@@ -0,0 +1,288 @@
+import os
+import re
+import json
+import zipfile
+import time
+import tempfile
+import subprocess
+import threading
+import logging
+from collections import OrderedDict
+
+from config import ZIP_HANDLE_POOL_SIZE, MANIFEST_CACHE_SIZE
+
+# アーカイブのメンバー操作
+# 画像メンバーの列挙、ページマニフェストの読み書き、キャッシュ済みアーカイブから
+# 直接ページを読み出すためのプロセス内の ZipFile ハンドルプールを提供する。
+# RAR は一時ディレクトリへの一括展開を待たず、メンバーを1つずつ変換ステージへ流す。
+# ページマニフェストはプロセス内にキャッシュし、ページ一覧の要求ごとにJSONを読み直さない。
+
+IMAGE_PATTERN = re.compile(r'\.(jpe?g|png|gif|bmp)$', re.I)
+MANIFEST_NAME = 'manifest.json'
+
+
+def zip_image_members(zip_ref):
+    """
+    ZIP内の画像メンバーを (連番, 名前) のリストで返す。
+    連番は namelist() 上の位置で、抽出時の出力ファイル名 '{i:04d}' に対応する。
+    危険なパス（..など）を防ぐため、サブディレクトリ内のファイルは無視する。
+    """
+    return [(i, name) for i, name in enumerate(zip_ref.namelist())
+            if IMAGE_PATTERN.search(name) and os.path.basename(name) == name]
+
+
+def rar_image_members(archive_path):
+    """
+    RAR内の画像メンバーを (連番, 名前) のリストで返す。
+    unrar でメンバー名だけを列挙するため、アーカイブは展開しない。
+    サブディレクトリ内のファイルは無視し、連番は名前順の位置とする。
+    """
+    cmd = ['unrar', 'lb', archive_path]
+    result = subprocess.run(cmd, check=True, capture_output=True, text=True)
+    names = sorted(n for n in result.stdout.splitlines() if n and '/' not in n and '\\' not in n)
+    return [(i, name) for i, name in enumerate(names) if IMAGE_PATTERN.search(name)]
+
+
+def image_members(archive_path, ext):
+    """アーカイブの形式に応じて画像メンバーを (連番, 名前) のリストで返す"""
+    if ext in ['zip', 'cbz']:
+        with zipfile.ZipFile(archive_path, 'r') as zip_ref:
+            return zip_image_members(zip_ref)
+    if ext in ['rar', 'cbr']:
+        return rar_image_members(archive_path)
+    raise ValueError(f"未対応のファイル形式です: {ext}")
+
+
+class MemberTooLarge(ValueError):
+    """メンバーが読み出すサイズの上限を超えている"""
+
+
+def read_member(archive_path, ext, name, limit=None):
+    """
+    アーカイブから1つのメンバーを読み出してバイト列で返す。
+    limit を指定した場合は、それを超えるメンバーを読み込まずに MemberTooLarge を送出する
+    （ZIPは記録された圧縮前後のサイズで判定し、RARは limit バイトを超えた時点で unrar を止める）。
+    """
+    if ext in ['zip', 'cbz']:
+        with zipfile.ZipFile(archive_path, 'r') as zip_ref:
+            info = zip_ref.getinfo(name)
+            if limit is not None and max(info.file_size, info.compress_size) > limit:
+                raise MemberTooLarge(f"メンバーが大きすぎます: {name} ({info.file_size} バイト)")
+            return zip_ref.read(info)
+    if ext in ['rar', 'cbr']:
+        # 'p' でメンバーを標準出力に書き出す（一時ディレクトリを使わない）
+        cmd = ['unrar', 'p', '-inul', archive_path, name]
+        if limit is None:
+            return subprocess.run(cmd, check=True, capture_output=True).stdout
+        with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL) as proc:
+            data = proc.stdout.read(limit + 1)
+            if len(data) > limit:
+                proc.kill()
+                raise MemberTooLarge(f"メンバーが大きすぎます: {name} ({limit} バイト超)")
+            proc.stdout.close()
+            if proc.wait() != 0:
+                raise subprocess.CalledProcessError(proc.returncode, cmd)
+        return data
+    raise ValueError(f"未対応のファイル形式です: {ext}")
+
+
+def rar_is_solid(archive_path):
+    """
+    ソリッドアーカイブかどうかを返す。
+    ソリッドアーカイブはメンバーごとの読み出しが先頭からの展開になるため、まとめて展開する必要がある。
+    """
+    cmd = ['unrar', 'l', archive_path]
+    result = subprocess.run(cmd, check=True, capture_output=True, text=True)
+    for line in result.stdout.splitlines():
+        # 例: 'Details: RAR 5, solid'
+        if line.startswith('Details:'):
+            return 'solid' in [t.strip().lower() for t in line.split(':', 1)[1].split(',')]
+    return False
+
+
+def iter_rar_pages(archive_path, members, temp_dir):
+    """
+    RAR内の画像メンバーを (連番, 名前, バイト列) の形で、読み出せた順に返すジェネレーター。
+    非ソリッドアーカイブは 'unrar p' でメンバーを1つずつ標準出力から読み出し、ディスクに書き出さない。
+    ソリッドアーカイブは 'unrar x' を1回だけ実行し、展開が終わったメンバーから順に読み出して一時ファイルを削除する。
+    """
+    if not rar_is_solid(archive_path):
+        for i, name in members:
+            yield i, name, read_member(archive_path, 'rar', name)
+        return
+    yield from _iter_solid_rar_pages(archive_path, members, temp_dir)
+
+
+def _iter_solid_rar_pages(archive_path, members, temp_dir):
+    # unrar はアーカイブ内の格納順に展開するため、次のエントリが現れた時点で前のメンバーは書き込み済み
+    cmd = ['unrar', 'lb', archive_path]
+    order = [n for n in subprocess.run(cmd, check=True, capture_output=True, text=True).stdout.splitlines() if n]
+    index = {name: i for i, name in members}
+    os.makedirs(temp_dir, exist_ok=True)
+
+    cmd = ['unrar', 'x', '-o+', '-idq', archive_path, temp_dir + os.sep] # -o+ で常に上書き
+    with tempfile.TemporaryFile() as stderr:
+        proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=stderr)
+        try:
+            for k, name in enumerate(order):
+                if name not in index:
+                    continue
+                path = os.path.join(temp_dir, name)
+                following = [os.path.join(temp_dir, n) for n in order[k + 1:k + 2]]
+                while proc.poll() is None and not any(os.path.exists(p) for p in following):
+                    time.sleep(0.01)
+                if not os.path.exists(path):
+                    continue # 展開に失敗した（終了コードで判定する）
+                with open(path, 'rb') as f:
+                    data = f.read()
+                os.remove(path) # 読み出したページはすぐに削除し、一時ディスク使用量を抑える
+                yield index[name], name, data
+            if proc.wait() != 0:
+                stderr.seek(0)
+                raise subprocess.CalledProcessError(proc.returncode, cmd, stderr=stderr.read().decode(errors='replace'))
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+
+
+def write_manifest(extract_path, ext, members):
+    """
+    ページマニフェストを '<hash>_extracted/manifest.json' に保存する。
+    各ページは出力ファイル名の連番部分 '{i:04d}'（拡張子は保存形式ごとに付く）と、元のメンバー名を持つ。
+    """
+    os.makedirs(extract_path, exist_ok=True)
+    manifest = {
+        'ext': ext,
+        'pages': [{'stem': f'{i:04d}', 'member': name} for i, name in members],
+    }
+    tmp_path = os.path.join(extract_path, MANIFEST_NAME + '.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    os.replace(tmp_path, os.path.join(extract_path, MANIFEST_NAME))
+    return manifest
+
+
+def load_manifest(extract_path):
+    """ページマニフェストを読み込む。存在しない場合は None を返す"""
+    try:
+        with open(os.path.join(extract_path, MANIFEST_NAME), encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+class ManifestCache:
+    """
+    ページマニフェストのプロセス内LRUキャッシュ。
+    manifest.json の mtime を確認し、書き換えや削除があった場合は読み直す（明示的な無効化は不要）。
+    """
+
+    def __init__(self, size):
+        self._size = size
+        self._manifests = OrderedDict() # {抽出ディレクトリ: ((mtime_ns, inode), マニフェスト)}
+        self._lock = threading.Lock()
+
+    def get(self, extract_path):
+        """ページマニフェストを返す。存在しない場合は None を返す"""
+        try:
+            st = os.stat(os.path.join(extract_path, MANIFEST_NAME))
+        except FileNotFoundError:
+            with self._lock:
+                self._manifests.pop(extract_path, None)
+            return None
+        # 書き込みは一時ファイルからの置き換えなので、inode も比較する
+        mtime = (st.st_mtime_ns, st.st_ino)
+        with self._lock:
+            entry = self._manifests.get(extract_path)
+            if entry is not None and entry[0] == mtime:
+                self._manifests.move_to_end(extract_path)
+                return entry[1]
+        manifest = load_manifest(extract_path)
+        if manifest is None:
+            return None
+        # 連番からページを引くための索引（遅延変換で使用）
+        manifest['by_stem'] = {page['stem']: page for page in manifest['pages']}
+        with self._lock:
+            self._manifests[extract_path] = (mtime, manifest)
+            self._manifests.move_to_end(extract_path)
+            while len(self._manifests) > self._size:
+                self._manifests.popitem(last=False)
+        return manifest
+
+    def clear(self):
+        with self._lock:
+            self._manifests.clear()
+
+
+class ZipHandlePool:
+    """
+    開いたままの ZipFile ハンドルをハッシュごとに保持するLRUプール。
+    ページを読むたびにアーカイブを開き直し、セントラルディレクトリを解析するコストを避ける。
+    メンバーはバイト列に読み込まず、ストリームとして開いて返す。ZipFile は読み出しのたびに
+    共有のファイルの位置を合わせるため、同じハンドルから複数のスレッドが同時に読める。
+    プールから外したハンドルは、開いているメンバーがすべて閉じられた時点でファイルが閉じられる。
+    """
+
+    def __init__(self, size):
+        self._size = size
+        self._handles = OrderedDict() # {hash: (ZipFile, 画像メンバー)}
+        self._lock = threading.Lock()
+
+    def _get(self, manga_hash, archive_path):
+        with self._lock:
+            entry = self._handles.get(manga_hash)
+            if entry is not None:
+                self._handles.move_to_end(manga_hash)
+                return entry
+        zip_ref = zipfile.ZipFile(archive_path, 'r')
+        entry = (zip_ref, zip_image_members(zip_ref))
+        with self._lock:
+            existing = self._handles.get(manga_hash)
+            if existing is not None:
+                # 他のスレッドが先に開いた場合はそちらを使う
+                zip_ref.close()
+                return existing
+            self._handles[manga_hash] = entry
+            while len(self._handles) > self._size:
+                _, (old_ref, _) = self._handles.popitem(last=False)
+                old_ref.close()
+        return entry
+
+    def page_count(self, manga_hash, archive_path):
+        """アーカイブ内の画像ページ数を返す"""
+        return len(self._get(manga_hash, archive_path)[1])
+
+    def open_page(self, manga_hash, archive_path, page):
+        """
+        ページ番号（0始まり）の画像メンバーを開き、(ZipInfo, ファイルオブジェクト) を返す（ダイレクトモードで使用）。
+        範囲外の場合は IndexError を送出する。ファイルオブジェクトは呼び出し側が閉じる。
+        """
+        zip_ref, members = self._get(manga_hash, archive_path)
+        _, name = members[page]
+        info = zip_ref.getinfo(name)
+        return info, zip_ref.open(info)
+
+    def open_member(self, manga_hash, archive_path, name):
+        """メンバー名を指定してファイルオブジェクトとして開く（遅延変換で使用）"""
+        zip_ref, _ = self._get(manga_hash, archive_path)
+        return zip_ref.open(name)
+
+    def invalidate(self, manga_hash):
+        """キャッシュ削除時などにハンドルを閉じる"""
+        with self._lock:
+            entry = self._handles.pop(manga_hash, None)
+        if entry is not None:
+            entry[0].close()
+            logging.debug(f"ZIPハンドルを閉じました: {manga_hash}")
+
+    def clear(self):
+        with self._lock:
+            entries = list(self._handles.values())
+            self._handles.clear()
+        for zip_ref, _ in entries:
+            zip_ref.close()
+
+
+zip_pool = ZipHandlePool(ZIP_HANDLE_POOL_SIZE)
+manifest_cache = ManifestCache(MANIFEST_CACHE_SIZE)
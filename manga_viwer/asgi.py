@@ -0,0 +1,250 @@
+import io
+import sys
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import request
+
+import metrics
+from app import app, job_queue, job_status, serve_cached_page
+from config import ASGI_THREADS, ASGI_CHUNK_SIZE, JOB_STATUS_MAX_WAIT
+
+# ASGI での配信
+# 既存の Flask アプリをそのまま ASGI サーバー（uvicorn など）で動かすためのアダプター。
+#   uvicorn asgi:application --host 0.0.0.0 --port 8000
+#   gunicorn -k uvicorn.workers.UvicornWorker asgi:application
+# 同期ワーカーでは1つの接続（遅いクライアントへの送信も含む）がワーカーを占有するが、ここでは
+# 接続の受信と送信をイベントループで行い、Flask のルートの実行だけを ASGI_THREADS 個のスレッドで行う。
+# - ページの304は、Flask のルートを通さずにイベントループで応答を作る（ETagはプロセス内のキャッシュから作る）。
+#   ファイルを開く必要がある応答（ホットページも含む）は、ほかの応答と同じくスレッドで作る。
+# - /job_status は ?wait=<秒> を指定すると、進捗が変わるまでイベントループで待ってから返す（ロングポーリング）。
+# - send_file の応答（ページのファイル）は ASGI_CHUNK_SIZE ずつスレッドで読み出し、送信はイベントループで行う。
+# ダウンロードと解凍は従来どおりジョブキュー（jobs.py）のスレッドで行うため、リクエストを待たせない。
+
+JOB_POLL_INTERVAL = 0.1 # ジョブの進捗を確認する間隔（秒）
+DOWNLOAD_PROGRESS_INTERVAL = 1 # ダウンロード中は、この秒数ごとに進捗を返す
+
+ASGI_REQUESTS = metrics.counter('manga_asgi_requests_total', 'ASGI で処理したリクエスト（executor が loop: イベントループ, thread: スレッド）', ('executor',))
+
+# Flask のルートとファイルの読み出しに使うスレッド
+executor = ThreadPoolExecutor(max_workers=ASGI_THREADS, thread_name_prefix='asgi')
+
+
+class FileWrapper:
+    """wsgi.file_wrapper: send_file のファイルを ASGI_CHUNK_SIZE ずつ読み出す（イベントループからはスレッドで呼ぶ）"""
+
+    def __init__(self, file, block_size=None):
+        self.file = file
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        data = self.file.read(ASGI_CHUNK_SIZE)
+        if data:
+            return data
+        raise StopIteration
+
+    def close(self):
+        self.file.close()
+
+
+def build_environ(scope, body):
+    """ASGI の HTTP スコープとリクエストの本文から WSGI の environ を作る"""
+    root_path = scope.get('root_path', '')
+    path = scope['path']
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path):]
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': root_path.encode().decode('latin-1'),
+        'PATH_INFO': path.encode().decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+        'wsgi.file_wrapper': FileWrapper,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        key = name if name in ('CONTENT_TYPE', 'CONTENT_LENGTH') else f'HTTP_{name}'
+        if key in environ:
+            value = f"{environ[key]}{'; ' if key == 'HTTP_COOKIE' else ','}{value}"
+        environ[key] = value
+    # 本文は読み込み済みのため、長さを設定する（chunked で送られた本文は Content-Length がなく、Flask が読まない）
+    environ['CONTENT_LENGTH'] = str(len(body))
+    environ.pop('HTTP_TRANSFER_ENCODING', None)
+    return environ
+
+
+def call_wsgi(wsgi_app, environ):
+    """WSGI アプリ（または Response）を呼び、(ステータス, ヘッダー, 応答の iterable) を返す"""
+    started = []
+    written = []
+
+    def start_response(status, headers, exc_info=None):
+        started[:] = [int(status.split(' ', 1)[0]), headers]
+        return written.append
+
+    result = wsgi_app(environ, start_response)
+    if written: # 古い write() を使うアプリ（Flask は使わない）
+        result = written + list(result)
+    return started[0], started[1], result
+
+
+async def wait_for_job(job_id):
+    """
+    ?wait=<秒> の間、ジョブの state と pages_done がクエリの値（クライアントが最後に見た値）から変わるまで待つ。
+    ダウンロード中はバイト数を表示するため、DOWNLOAD_PROGRESS_INTERVAL 秒ごとに返す。
+    """
+    wait = min(request.args.get('wait', 0, type=float), JOB_STATUS_MAX_WAIT)
+    if wait <= 0:
+        return
+    seen = (request.args.get('state'), request.args.get('pages_done', type=int))
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    while True:
+        job = job_queue.get(job_id)
+        if job is None or not job.active or (job.state, job.pages_done) != seen:
+            return
+        elapsed = loop.time() - started
+        if elapsed >= wait or (job.state == 'downloading' and elapsed >= DOWNLOAD_PROGRESS_INTERVAL):
+            return
+        await asyncio.sleep(JOB_POLL_INTERVAL)
+
+
+# イベントループで実行できる（ファイルやデータベースを読まず、メモリ上の応答を返す）ルート: {エンドポイント: 処理}
+# 処理が None を返した場合は、通常のルートをスレッドで実行する
+NONBLOCKING_ROUTES = {
+    'serve_image': lambda view_args: serve_cached_page(view_args['path']),
+    'job_status': lambda view_args: job_status(**view_args),
+}
+
+
+async def dispatch_nonblocking(environ):
+    """イベントループで返せるリクエストなら Flask の Response を返す（スレッドが必要な場合は None）"""
+    with app.request_context(environ):
+        handler = NONBLOCKING_ROUTES.get(request.endpoint)
+        if handler is None:
+            return None
+        try:
+            if request.endpoint == 'job_status':
+                await wait_for_job(request.view_args['job_id'])
+            response = app.preprocess_request()
+            if response is None:
+                response = handler(request.view_args)
+                if response is None:
+                    return None
+            # after_request（メトリクスの記録など）は通常のルートと同じように実行する
+            return app.process_response(app.make_response(response))
+        except Exception as e:
+            logging.warning(f"イベントループでの処理に失敗したため、スレッドで処理します: {request.path} - {e}", exc_info=True)
+            return None
+
+
+async def read_body(receive):
+    """リクエストの本文を読み込む（クライアントが切断した場合は None）"""
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body', False):
+            return b''.join(chunks)
+
+
+def read_head(result, limit):
+    """
+    応答の iterable から limit バイトまでを読み出し、(読み出したチャンク, 残りの iterator) を返す。
+    読み切った場合は応答を閉じ、残りの iterator を None とする。
+    """
+    chunks = []
+    size = 0
+    iterator = iter(result)
+    for chunk in iterator:
+        chunks.append(chunk)
+        size += len(chunk)
+        if size >= limit:
+            return chunks, iterator
+    if hasattr(result, 'close'):
+        result.close()
+    return chunks, None
+
+
+def run_app(environ):
+    """スレッドで Flask を実行する。小さな応答（多くのページ）はここで読み切り、送信時にスレッドを使わない"""
+    status, headers, result = call_wsgi(app, environ)
+    head, rest = read_head(result, ASGI_CHUNK_SIZE)
+    return status, headers, head, rest, result
+
+
+async def send_response(send, status, headers, head, rest=None, result=None):
+    """応答を送る。残り（rest）があれば ASGI_CHUNK_SIZE ずつスレッドで読み出し、送信はイベントループで行う"""
+    loop = asyncio.get_running_loop()
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers],
+    })
+    try:
+        for chunk in head:
+            if chunk:
+                await send({'type': 'http.response.body', 'body': bytes(chunk), 'more_body': True})
+        while rest is not None:
+            chunk = await loop.run_in_executor(executor, next, rest, None)
+            if chunk is None:
+                break
+            if chunk:
+                await send({'type': 'http.response.body', 'body': bytes(chunk), 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+    finally:
+        if rest is not None and hasattr(result, 'close'):
+            await loop.run_in_executor(executor, result.close)
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            executor.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    """ASGI アプリケーション"""
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        raise ValueError(f"未対応の ASGI スコープです: {scope['type']}")
+
+    body = await read_body(receive)
+    if body is None:
+        return
+    environ = build_environ(scope, body)
+    response = await dispatch_nonblocking(environ)
+    if response is not None:
+        ASGI_REQUESTS.inc('loop')
+        status, headers, result = call_wsgi(response, environ)
+        # メモリ上の応答（304 や /job_status）なので、イベントループで読み切る
+        head, _ = read_head(result, float('inf'))
+        await send_response(send, status, headers, head)
+    else:
+        ASGI_REQUESTS.inc('thread')
+        await send_response(send, *await asyncio.get_running_loop().run_in_executor(executor, run_app, environ))
@@ -0,0 +1,921 @@
+import os
+import io
+import sys
+import time
+import json
+import zipfile
+import argparse
+import glob
+import tempfile
+import shutil
+import sqlite3
+import random
+import base64
+import hashlib
+import resource
+import functools
+import socket
+import threading
+import subprocess
+import http.server
+
+from PIL import Image
+
+# ベンチマーク
+# 合成アーカイブを生成し、マンガビューアーの処理時間を計測する。
+# 例: python benchmark.py convert --pages 200 --workers 1,2,4
+#     python benchmark.py codecs --pages 20
+#     python benchmark.py rar --archive large.cbr
+#     python benchmark.py db --rows 5000
+#     python benchmark.py eviction --trace access.log --capacity-mb 2000
+#     python benchmark.py pack --pages 200
+#     python benchmark.py serve --requests 5000
+#     python benchmark.py load --volumes 4 --concurrency 4 > load.json
+#     python benchmark.py load --server asgi --idle-clients 1000 --baseline load.json
+#     python benchmark.py memory --width 6000 --height 9000
+
+
+def make_page(i, size):
+    """ページ番号ごとに異なる内容の合成ページ（JPEG）を生成する"""
+    img = Image.new('RGB', size, (255, 255, 255))
+    # 単色だと圧縮・変換が速すぎるため、縞模様とノイズを重ねて実際のスキャンに近づける
+    step = max(1, size[0] // 64)
+    for x in range(0, size[0], step * 2):
+        img.paste((i * 37 % 256, x % 256, 128), (x, 0, x + step, size[1]))
+    noise = Image.effect_noise(size, 40).convert('RGB')
+    img = Image.blend(img, noise, 0.3)
+    buf = io.BytesIO()
+    img.save(buf, 'JPEG', quality=90)
+    return buf.getvalue()
+
+
+def make_cbz(path, pages, size):
+    """合成CBZを作成する（JPEGは既に圧縮済みなので無圧縮で格納）"""
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED) as z:
+        for i in range(pages):
+            z.writestr(f'page_{i:04d}.jpg', make_page(i, size))
+    return path
+
+
+def bench_convert(args):
+    """extract_zip 相当の変換をワーカー数ごとに実行し、経過時間を計測する"""
+    import converter
+
+    work_dir = tempfile.mkdtemp(prefix='manga_bench_')
+    try:
+        archive = make_cbz(os.path.join(work_dir, 'bench.cbz'), args.pages, (args.width, args.height))
+        results = []
+        for workers in [int(w) for w in args.workers.split(',')]:
+            out_dir = os.path.join(work_dir, f'out_{workers}')
+            os.makedirs(out_dir)
+            with zipfile.ZipFile(archive) as z:
+                names = z.namelist()
+                pages = ((i, name, z.read(name)) for i, name in enumerate(names))
+                start = time.perf_counter()
+                converter.convert_pages(pages, out_dir, len(names), workers=workers, label='bench')
+                elapsed = time.perf_counter() - start
+            results.append({
+                'workers': workers,
+                'seconds': round(elapsed, 3),
+                'pages_per_second': round(len(names) / elapsed, 1),
+            })
+            print(f"workers={workers}: {elapsed:.2f}秒 ({len(names) / elapsed:.1f} ページ/秒)", file=sys.stderr)
+        base = results[0]['seconds']
+        for r in results:
+            r['speedup'] = round(base / r['seconds'], 2)
+        print(json.dumps({'benchmark': 'convert', 'pages': args.pages, 'cpu_count': os.cpu_count(), 'results': results}, indent=2))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def bench_codecs(args):
+    """ページ形式と品質ごとに、1ページあたりのエンコード時間とバイト数を計測する"""
+    import converter
+
+    sources = [make_page(i, (args.width, args.height)) for i in range(args.pages)]
+    # デコードとリサイズは形式によらず共通なので、エンコードだけを計測する
+    pages = [converter.resize_page(src) for src in sources]
+    results = []
+    for fmt in args.formats.split(','):
+        if fmt not in converter.FORMATS or (fmt in ('webp', 'avif') and not converter.features.check(fmt)):
+            print(f"{fmt}: このPillowでは使用できません", file=sys.stderr)
+            continue
+        tiers = converter.PAGE_QUALITY_TIERS.items() if fmt != 'png' else [('lossless', None)]
+        for tier, quality in tiers:
+            total_bytes = 0
+            start = time.perf_counter()
+            for img in pages:
+                buf = io.BytesIO()
+                converter.encode_page(img, fmt, buf, quality)
+                total_bytes += buf.tell()
+            elapsed = time.perf_counter() - start
+            results.append({
+                'format': fmt,
+                'tier': tier,
+                'quality': quality,
+                'encode_ms_per_page': round(elapsed * 1000 / len(pages), 2),
+                'bytes_per_page': total_bytes // len(pages),
+            })
+            print(f"{fmt}/{tier}: {elapsed * 1000 / len(pages):.1f}ms/ページ, {total_bytes // len(pages) / 1024:.1f}KB/ページ", file=sys.stderr)
+    print(json.dumps({'benchmark': 'codecs', 'pages': args.pages, 'results': results}, indent=2))
+
+
+def make_cbr(path, pages, size, solid=False):
+    """合成CBRを作成する（rar コマンドが必要）"""
+    src_dir = tempfile.mkdtemp(prefix='manga_bench_src_')
+    try:
+        for i in range(pages):
+            with open(os.path.join(src_dir, f'page_{i:04d}.jpg'), 'wb') as f:
+                f.write(make_page(i, size))
+        cmd = ['rar', 'a', '-ep', '-m0', '-idq'] + (['-s'] if solid else []) + [path] + sorted(glob.glob(os.path.join(src_dir, '*.jpg')))
+        subprocess.run(cmd, check=True)
+    finally:
+        shutil.rmtree(src_dir, ignore_errors=True)
+    return path
+
+
+def bench_rar(args):
+    """
+    RAR/CBRの抽出を、一時ディレクトリへ一括展開してから変換する従来の方法と、
+    メンバーを1つずつ変換ステージへ流す方法で比較する（最初のページまでの時間と全体の時間）。
+    """
+    import archive
+    import converter
+
+    work_dir = tempfile.mkdtemp(prefix='manga_bench_')
+    try:
+        if args.archive:
+            cbr = args.archive
+        elif shutil.which('rar'):
+            cbr = make_cbr(os.path.join(work_dir, 'bench.cbr'), args.pages, (args.width, args.height), args.solid)
+        else:
+            sys.exit("rar コマンドが見つかりません。--archive で既存のCBRを指定してください。")
+        members = archive.rar_image_members(cbr)
+
+        def temp_dir_pages(temp_dir):
+            # 従来の方法: 'unrar x' で全体を展開し終えてから、ファイルを読み込む
+            os.makedirs(temp_dir, exist_ok=True)
+            subprocess.run(['unrar', 'x', '-o+', '-idq', cbr, temp_dir + os.sep], check=True)
+            for i, name in members:
+                with open(os.path.join(temp_dir, name), 'rb') as f:
+                    yield i, name, f.read()
+
+        methods = {
+            'temp_dir': temp_dir_pages,
+            'streaming': lambda temp_dir: archive.iter_rar_pages(cbr, members, temp_dir),
+        }
+        results = []
+        for method, pages_for in methods.items():
+            out_dir = os.path.join(work_dir, f'out_{method}')
+            temp_dir = os.path.join(work_dir, f'temp_{method}')
+            os.makedirs(out_dir)
+            first = []
+            start = time.perf_counter()
+            converter.convert_pages(pages_for(temp_dir), out_dir, len(members), workers=args.workers,
+                                    progress=lambda done, total: first or first.append(time.perf_counter() - start),
+                                    label='bench')
+            elapsed = time.perf_counter() - start
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            results.append({
+                'method': method,
+                'first_page_seconds': round(first[0], 3) if first else None,
+                'seconds': round(elapsed, 3),
+            })
+            print(f"{method}: 最初のページ {first[0] if first else 0:.2f}秒, 全体 {elapsed:.2f}秒", file=sys.stderr)
+        print(json.dumps({
+            'benchmark': 'rar',
+            'pages': len(members),
+            'archive_bytes': os.path.getsize(cbr),
+            'solid': archive.rar_is_solid(cbr),
+            'results': results,
+        }, indent=2))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def bench_db(args):
+    """
+    /manga_list（全件をタイトル順）と /reader_data（ハッシュで1件）相当のクエリを、
+    リクエストごとに接続を開く従来の方法（インデックスなし）と、
+    スレッドごとの接続を使い回す db.py の方法（WAL・title インデックス付き）で比較する。
+    """
+    import db
+
+    work_dir = tempfile.mkdtemp(prefix='manga_bench_')
+    try:
+        rows = []
+        for i in range(args.rows):
+            url = f'https://example.com/library/{i:06d}/volume_{(i * 7919) % args.rows:06d}.cbz'
+            rows.append((hashlib.md5(url.encode()).hexdigest(), url, f'volume_{(i * 7919) % args.rows:06d}', 'cbz'))
+        hashes = [r[0] for r in rows]
+        schema = 'CREATE TABLE mangas (id INTEGER PRIMARY KEY AUTOINCREMENT, hash TEXT UNIQUE, url TEXT, title TEXT, file_ext TEXT)'
+
+        before_path = os.path.join(work_dir, 'before.db')
+        conn = sqlite3.connect(before_path)
+        conn.execute(schema)
+        conn.executemany('INSERT INTO mangas (hash, url, title, file_ext) VALUES (?, ?, ?, ?)', rows)
+        conn.commit()
+        conn.close()
+
+        after_path = os.path.join(work_dir, 'after.db')
+        conn = db.connect(after_path)
+        db.migrate(conn)
+        conn.executemany('INSERT INTO mangas (hash, url, title, file_ext) VALUES (?, ?, ?, ?)', rows)
+        conn.commit()
+
+        def per_request(query):
+            def run(params):
+                c = sqlite3.connect(before_path)
+                c.row_factory = sqlite3.Row
+                try:
+                    return c.execute(query, params).fetchall()
+                finally:
+                    c.close()
+            return run
+
+        def persistent(query):
+            return lambda params: conn.execute(query, params).fetchall()
+
+        queries = {
+            'list': ('SELECT * FROM mangas ORDER BY title', lambda i: ()),
+            'read': ('SELECT url, title, file_ext FROM mangas WHERE hash=?', lambda i: (hashes[i % len(hashes)],)),
+        }
+        results = []
+        for name, (query, params) in queries.items():
+            iterations = args.list_iterations if name == 'list' else args.read_iterations
+            for method, make in (('per_request', per_request), ('persistent', persistent)):
+                run = make(query)
+                start = time.perf_counter()
+                for i in range(iterations):
+                    run(params(i))
+                elapsed = time.perf_counter() - start
+                results.append({
+                    'query': name,
+                    'method': method,
+                    'requests_per_second': round(iterations / elapsed, 1),
+                })
+                print(f"{name}/{method}: {iterations / elapsed:.1f} 回/秒", file=sys.stderr)
+        conn.close()
+        print(json.dumps({'benchmark': 'db', 'rows': args.rows, 'results': results}, indent=2))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def synthetic_trace(volumes, requests, skew, seed):
+    """
+    人気がZipf分布に従う合成アクセス列 [(ハッシュ, サイズ)] を作る。
+    巻のサイズは対数正規分布（中央値 約60MB）で、人気とは無関係に決める。
+    """
+    rng = random.Random(seed)
+    sizes = [int(min(max(rng.lognormvariate(4.1, 0.6), 5), 400) * 1024 * 1024) for _ in range(volumes)]
+    weights = [1 / (rank + 1) ** skew for rank in range(volumes)]
+    picks = rng.choices(range(volumes), weights=weights, k=requests)
+    return [(f'{i:032x}', sizes[i]) for i in picks]
+
+
+def bench_eviction(args):
+    """アクセスログ（CACHE_TRACE_LOG）または合成アクセス列を、削除ポリシーごとに再生して比較する"""
+    import eviction
+
+    if args.trace:
+        trace = eviction.read_trace(args.trace, default_size=args.default_size_mb * 1024 * 1024)
+    else:
+        trace = synthetic_trace(args.volumes, args.requests, args.skew, args.seed)
+    capacity = args.capacity_mb * 1024 * 1024
+    results = []
+    for name in args.policies.split(','):
+        start = time.perf_counter()
+        result = eviction.simulate(trace, eviction.get_policy(name), capacity)
+        result['policy'] = name
+        result['seconds'] = round(time.perf_counter() - start, 3)
+        results.append(result)
+        print(f"{name}: ヒット率 {result['hit_ratio']:.1%}, 取得 {result['bytes_fetched'] / 1024 ** 3:.2f}GB", file=sys.stderr)
+    print(json.dumps({
+        'benchmark': 'eviction',
+        'trace': args.trace or 'synthetic',
+        'requests': len(trace),
+        'volumes': len({h for h, _ in trace}),
+        'capacity_mb': args.capacity_mb,
+        'results': results,
+    }, indent=2))
+
+
+def _disk_usage(path):
+    """ディレクトリ内のファイルの数と、実際に割り当てられたバイト数（st_blocks）"""
+    files = 0
+    used = 0
+    for entry in os.scandir(path):
+        if entry.is_file():
+            files += 1
+            used += entry.stat().st_blocks * 512
+    return files, used
+
+
+def bench_pack(args):
+    """抽出済みのページを個別のファイルで置く場合と、ページパックにまとめた場合の容量と読み出し時間を比較する"""
+    import pagepack
+
+    work_dir = tempfile.mkdtemp(prefix='manga_bench_pack_')
+    try:
+        extract_path = os.path.join(work_dir, 'volume_extracted')
+        os.makedirs(extract_path)
+        names = []
+        for i in range(args.pages):
+            data = make_page(i, (args.width, args.height))
+            for variant in ('', '_thumb', '_mobile'):
+                name = f'{i:04d}{variant}.jpg'
+                with open(os.path.join(extract_path, name), 'wb') as f:
+                    f.write(data if not variant else data[:len(data) // 4])
+                names.append(name)
+        loose_files, loose_bytes = _disk_usage(extract_path)
+
+        rng = random.Random(args.seed)
+        reads = [rng.choice(names) for _ in range(args.reads)]
+        start = time.perf_counter()
+        for name in reads:
+            with open(os.path.join(extract_path, name), 'rb') as f:
+                f.read()
+        loose_seconds = time.perf_counter() - start
+
+        pagepack.write_pack(extract_path, names)
+        for name in names:
+            os.remove(os.path.join(extract_path, name))
+        pack_files, pack_bytes = _disk_usage(extract_path)
+        pool = pagepack.PackPool(4)
+        start = time.perf_counter()
+        for name in reads:
+            pool.read(extract_path, name)
+        pack_seconds = time.perf_counter() - start
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(f"ファイル {loose_files} -> {pack_files}, 使用量 {loose_bytes / 1024 ** 2:.1f}MB -> {pack_bytes / 1024 ** 2:.1f}MB", file=sys.stderr)
+    print(json.dumps({
+        'benchmark': 'pack',
+        'pages': args.pages,
+        'reads': args.reads,
+        'loose': {'files': loose_files, 'disk_bytes': loose_bytes, 'read_us': round(loose_seconds / args.reads * 1e6, 1)},
+        'pack': {'files': pack_files, 'disk_bytes': pack_bytes, 'read_us': round(pack_seconds / args.reads * 1e6, 1)},
+    }, indent=2))
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def bench_serve(args):
+    """
+    /image のページ配信を、ページのファイルを send_file で返す方法（HOT_PAGE_CACHE_SIZE = 0）と、
+    ホットページ（保持しているページの場所）で返す方法で比較する。ページパックにまとめた巻も同様に比較する。
+    Flask のテストクライアントで1スレッドから要求し、1リクエストあたりのアプリ内の処理時間を計測する。
+    """
+    import config
+
+    work_dir = tempfile.mkdtemp(prefix='manga_bench_serve_')
+    try:
+        # app の読み込み前に、データベースとキャッシュを作業ディレクトリに向ける
+        config.DATABASE = os.path.join(work_dir, 'manga.db')
+        config.MANGA_CACHE_DIR = os.path.join(work_dir, 'cache')
+        config.MANGA_CACHE_TEMP_DIR = os.path.join(work_dir, 'temp')
+        import app as manga_app
+        import cache_index
+        from hotpages import HotPages
+        from pagepack import write_pack
+
+        volumes = {}
+        for layout in ('loose', 'pack'):
+            manga_hash = hashlib.md5(layout.encode()).hexdigest()
+            extract_path = os.path.join(config.MANGA_CACHE_DIR, f'{manga_hash}_extracted')
+            os.makedirs(extract_path)
+            names = []
+            for i in range(args.pages):
+                names.append(f'{i:04d}.jpg')
+                with open(os.path.join(extract_path, names[-1]), 'wb') as f:
+                    f.write(make_page(i, (args.width, args.height)))
+            if layout == 'pack':
+                write_pack(extract_path, names)
+                for name in names:
+                    os.remove(os.path.join(extract_path, name))
+            cache_index.record(manga_hash, archive_size=0, version=1.0)
+            volumes[layout] = manga_hash
+
+        client = manga_app.app.test_client()
+        headers = {'Accept': 'image/jpeg'}
+        rng = random.Random(args.seed)
+        pages = [rng.randrange(args.pages) for _ in range(args.requests)]
+        results = []
+        for layout, manga_hash in volumes.items():
+            for method, size in (('send_file', 0), ('hot', args.hot_size)):
+                manga_app.hot_pages = HotPages(size)
+                urls = [f'/image/{manga_hash}_extracted/{page:04d}' for page in pages]
+                for url in urls[:args.pages]: # ウォームアップ
+                    client.get(url, headers=headers)
+                latencies = []
+                start = time.perf_counter()
+                for url in urls:
+                    t = time.perf_counter()
+                    response = client.get(url, headers=headers)
+                    latencies.append(time.perf_counter() - t)
+                    if response.status_code != 200:
+                        raise RuntimeError(f'{url}: {response.status_code}')
+                elapsed = time.perf_counter() - start
+                result = {
+                    'layout': layout,
+                    'method': method,
+                    'p50_ms': round(_percentile(latencies, 0.5) * 1000, 3),
+                    'p99_ms': round(_percentile(latencies, 0.99) * 1000, 3),
+                    'requests_per_second': round(len(urls) / elapsed, 1),
+                }
+                results.append(result)
+                print(f"{layout}/{method}: p50 {result['p50_ms']}ms, p99 {result['p99_ms']}ms, {result['requests_per_second']} 回/秒", file=sys.stderr)
+        print(json.dumps({'benchmark': 'serve', 'pages': args.pages, 'requests': args.requests, 'results': results}, indent=2))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+class RangeRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """アーカイブの配信元の代わりに使う静的ファイルサーバー（Range リクエストに対応し、ログは出さない）"""
+
+    def log_message(self, *args):
+        pass
+
+    def send_head(self):
+        byte_range = self.headers.get('Range')
+        path = self.translate_path(self.path)
+        if not byte_range or not os.path.isfile(path):
+            return super().send_head()
+        size = os.path.getsize(path)
+        start, _, end = byte_range.replace('bytes=', '', 1).partition('-')
+        if start:
+            start, end = int(start), min(int(end) if end else size - 1, size - 1)
+        else:
+            start, end = max(size - int(end), 0), size - 1
+        with open(path, 'rb') as f:
+            f.seek(start)
+            data = f.read(end - start + 1)
+        self.send_response(206)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+        return io.BytesIO(data)
+
+
+def _rss_mb():
+    """(現在のRSS, 最大RSS, 子プロセスの最大RSS) をMB単位で返す"""
+    with open('/proc/self/statm') as f:
+        current = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 # Linux では KB 単位
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+    return {'current': round(current / 1024 ** 2, 1), 'peak': round(peak / 1024 ** 2, 1), 'children_peak': round(children / 1024 ** 2, 1)}
+
+
+def _latency_summary(latencies):
+    return {
+        'p50_ms': round(_percentile(latencies, 0.5) * 1000, 2),
+        'p99_ms': round(_percentile(latencies, 0.99) * 1000, 2),
+        'max_ms': round(max(latencies) * 1000, 2),
+    }
+
+
+class _TestClientDriver:
+    """Flask のテストクライアントで要求する（サーバーとネットワークを通さない）"""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def get(self, path):
+        r = self.client.get(path)
+        return r.status_code, r.data
+
+    def post(self, path, data):
+        r = self.client.post(path, data=data)
+        return r.status_code, r.data
+
+
+class _HTTPDriver:
+    """実際のWSGIサーバーに HTTP で要求する（クライアントごとに keep-alive の接続とクッキーを持つ）"""
+
+    def __init__(self, base_url):
+        import requests
+        self.base_url = base_url
+        self.session = requests.Session()
+
+    def get(self, path):
+        r = self.session.get(self.base_url + path, allow_redirects=False)
+        return r.status_code, r.content
+
+    def post(self, path, data):
+        r = self.session.post(self.base_url + path, data=data, allow_redirects=False)
+        return r.status_code, r.content
+
+
+def _open_volume(driver, url, timeout):
+    """
+    /add → /read → /reader_data → （ジョブの完了を待つ）→ /get_images → /image の順に巻を開き、
+    (最初のページまでの時間, ページのURLのリスト, 全ページを初めて取得し終えるまでの時間) を返す。
+    """
+    manga_hash = hashlib.md5(url.encode()).hexdigest()
+    url_b64 = base64.b64encode(url.encode()).decode().replace('+', '-').replace('/', '_')
+    driver.post('/add', {'manga_url': url})
+    driver.get(f'/read?url_b64={url_b64}')
+    start = time.perf_counter()
+    status, _ = driver.get('/reader_data')
+    if status != 200:
+        raise RuntimeError(f'/reader_data: {status}')
+    deadline = start + timeout
+    while True:
+        status, body = driver.get(f'/job_status/{manga_hash}')
+        state = json.loads(body).get('state') if status == 200 else 'done'
+        if state == 'error':
+            raise RuntimeError(f'ジョブが失敗しました: {json.loads(body).get("error")}')
+        if state == 'done':
+            break
+        if time.perf_counter() > deadline:
+            raise RuntimeError(f'{timeout}秒以内に準備が完了しませんでした: {url}')
+        time.sleep(0.01)
+    images = []
+    while True:
+        status, body = driver.get(f'/get_images?offset={len(images)}&limit=100')
+        data = json.loads(body)
+        images += data['images']
+        if status != 200 or not data['images'] or len(images) >= data['total_pages']:
+            break
+    first_page = None
+    for url_path in images:
+        status, _ = driver.get(url_path)
+        if status != 200:
+            raise RuntimeError(f'{url_path}: {status}')
+        if first_page is None:
+            first_page = time.perf_counter() - start
+    return first_page, images, time.perf_counter() - start
+
+
+def _run_clients(make_driver, urls, concurrency, image_requests, timeout, seed):
+    """
+    concurrency 個のクライアントで urls の巻を分担して開き、その後ランダムなページを image_requests 回要求する。
+    開く時間・変換の速さ・画像の要求の遅延とスループットを返す。
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    drivers = [make_driver() for _ in range(concurrency)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        opened = list(executor.map(lambda i: _open_volume(drivers[i % concurrency], urls[i], timeout), range(len(urls))))
+    open_elapsed = time.perf_counter() - start
+    pages = [url_path for _, images, _ in opened for url_path in images]
+
+    rng = random.Random(seed)
+    plan = [[rng.choice(pages) for _ in range(image_requests // concurrency)] for _ in range(concurrency)]
+
+    def warm(i):
+        latencies = []
+        for url_path in plan[i]:
+            t = time.perf_counter()
+            status, _ = drivers[i].get(url_path)
+            latencies.append(time.perf_counter() - t)
+            if status != 200:
+                raise RuntimeError(f'{url_path}: {status}')
+        return latencies
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = [value for result in executor.map(warm, range(concurrency)) for value in result]
+    warm_elapsed = time.perf_counter() - start
+    return {
+        'concurrency': concurrency,
+        'cold_open_first_page': _latency_summary([first for first, _, _ in opened]),
+        'cold_open_all_pages': _latency_summary([total for _, _, total in opened]),
+        # 巻を開いてから全ページを取得し終えるまでの、全クライアント合計の変換の速さ（遅延変換では /image で変換される）
+        'pages_converted_per_second': round(len(pages) / open_elapsed, 1),
+        'image_requests_per_second': round(len(latencies) / warm_elapsed, 1),
+        'image_latency': _latency_summary(latencies),
+    }
+
+
+def _compare(baseline, current, prefix=''):
+    """2回の結果の数値を比較して、変化を stderr に出力する"""
+    for key, value in current.items():
+        old = baseline.get(key) if isinstance(baseline, dict) else None
+        name = f'{prefix}{key}'
+        if isinstance(value, dict):
+            _compare(old or {}, value, name + '.')
+        elif isinstance(value, (int, float)) and not isinstance(value, bool) and isinstance(old, (int, float)) and old:
+            print(f"{name}: {old} -> {value} ({(value - old) / old:+.1%})", file=sys.stderr)
+
+
+def _open_idle_clients(port, count):
+    """リクエストを送り終えないまま接続を保つ遅いクライアントを count 個開く"""
+    sockets = []
+    for _ in range(count):
+        sock = socket.create_connection(('127.0.0.1', port))
+        sock.sendall(b'GET /job_status/idle HTTP/1.1\r\nHost: 127.0.0.1\r\n')
+        sockets.append(sock)
+    return sockets
+
+
+def _start_uvicorn(application):
+    """uvicorn で ASGI アプリを別スレッドで起動し、(サーバー, ポート) を返す"""
+    import uvicorn
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    server = uvicorn.Server(uvicorn.Config(application, log_level='warning', backlog=4096))
+    threading.Thread(target=server.run, kwargs={'sockets': [sock]}, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    return server, sock.getsockname()[1]
+
+
+def bench_load(args):
+    """
+    合成アーカイブをローカルのHTTPサーバーから配信し、/add から /image までの流れを
+    Flask のテストクライアントと、実際のサーバー（複数のクライアントから同時に要求）で計測する。
+    サーバーは werkzeug のスレッド型WSGIサーバー（wsgi）か、uvicorn で asgi.py を配信するもの（asgi）。
+    """
+    import config
+
+    if args.format == 'cbr' and not (shutil.which('rar') and shutil.which('unrar')):
+        sys.exit('CBRの計測には rar と unrar コマンドが必要です')
+    if args.server == 'asgi':
+        try:
+            import uvicorn # noqa: F401
+        except ImportError:
+            sys.exit('ASGIの計測には uvicorn が必要です')
+    work_dir = tempfile.mkdtemp(prefix='manga_bench_load_')
+    httpd = server = uvicorn_server = None
+    idle = []
+    try:
+        # app の読み込み前に、データベース・キャッシュ・設定を計測用に変える
+        config.DATABASE = os.path.join(work_dir, 'manga.db')
+        config.MANGA_CACHE_DIR = os.path.join(work_dir, 'cache')
+        config.MANGA_CACHE_TEMP_DIR = os.path.join(work_dir, 'temp')
+        config.METRICS_DIR = None
+        config.LAZY_CONVERSION = not args.eager
+        config.CACHE_SIZE_LIMIT_MB = config.ARCHIVE_CACHE_LIMIT_MB = config.EXTRACTED_CACHE_LIMIT_MB = 1024 ** 2 # 削除させない
+        import app as manga_app
+        from werkzeug.serving import make_server, WSGIRequestHandler
+
+        # 巻ごとに別のディレクトリに置き、次の巻の先読みが計測に混ざらないようにする
+        www = os.path.join(work_dir, 'www')
+        phases = {'test_client': args.volumes, args.server: max(args.volumes, args.concurrency)}
+        for phase, count in phases.items():
+            for i in range(count):
+                os.makedirs(os.path.join(www, phase, str(i)))
+                path = os.path.join(www, phase, str(i), f'volume.{args.format}')
+                if args.format == 'cbr':
+                    make_cbr(path, args.pages, (args.width, args.height))
+                else:
+                    make_cbz(path, args.pages, (args.width, args.height))
+        httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(RangeRequestHandler, directory=www))
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        origin = f'http://127.0.0.1:{httpd.server_address[1]}'
+
+        def urls(phase):
+            return [f'{origin}/{phase}/{i}/volume.{args.format}' for i in range(phases[phase])]
+
+        results = {}
+        print("テストクライアントで計測しています...", file=sys.stderr)
+        results['test_client'] = _run_clients(lambda: _TestClientDriver(manga_app.app), urls('test_client'),
+                                              1, args.image_requests, args.timeout, args.seed)
+
+        print(f"{args.server.upper()}サーバーで計測しています（同時 {args.concurrency} クライアント、"
+              f"遅いクライアント {args.idle_clients}）...", file=sys.stderr)
+        if args.server == 'asgi':
+            import asgi
+            uvicorn_server, port = _start_uvicorn(asgi.application)
+        else:
+            WSGIRequestHandler.protocol_version = 'HTTP/1.1' # keep-alive で接続を使い回す
+            server = make_server('127.0.0.1', 0, manga_app.app, threaded=True)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            port = server.server_port
+        idle = _open_idle_clients(port, args.idle_clients)
+        results[args.server] = _run_clients(lambda: _HTTPDriver(f'http://127.0.0.1:{port}'), urls(args.server),
+                                            args.concurrency, args.image_requests, args.timeout, args.seed)
+        # 遅いクライアントを保ったままのスレッド数（スレッド型のサーバーでは接続ごとに1つ増える）
+        results[args.server]['idle_clients'] = len(idle)
+        results[args.server]['threads'] = threading.active_count()
+        results['rss_mb'] = _rss_mb()
+    finally:
+        for sock in idle:
+            sock.close()
+        if uvicorn_server is not None:
+            uvicorn_server.should_exit = True
+        if server is not None:
+            server.shutdown()
+        if httpd is not None:
+            httpd.shutdown()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        'benchmark': 'load',
+        'format': args.format,
+        'conversion': 'eager' if args.eager else 'lazy',
+        'server': args.server,
+        'volumes': args.volumes,
+        'pages': args.pages,
+        'page_size': [args.width, args.height],
+        'results': results,
+    }
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            _compare(json.load(f).get('results', {}), results)
+    print(json.dumps(report, indent=2))
+
+
+def _make_large_page(size, fmt):
+    """大きなスキャンを模したページ（グラデーションと縞模様）を fmt で生成する"""
+    img = Image.linear_gradient('L').resize(size).convert('RGB')
+    step = max(1, size[0] // 64)
+    for x in range(0, size[0], step * 2):
+        img.paste((x % 256, 64, 128), (x, 0, x + step, size[1]))
+    buf = io.BytesIO()
+    img.save(buf, fmt.upper(), **({'quality': 90} if fmt == 'jpeg' else {}))
+    return buf.getvalue()
+
+
+def _legacy_convert_page(source, dest_stem, fmt):
+    """以前の変換方法: メンバー全体を読み込み、元の解像度でRGBにデコードしてから縮小する（比較用）"""
+    import converter
+    from config import PAGE_MAX_SIZE, PAGE_VARIANTS
+    with zipfile.ZipFile(source.archive_path) as z:
+        data = z.read(source.name)
+    img = Image.open(io.BytesIO(data)).convert('RGB')
+    img.thumbnail(PAGE_MAX_SIZE)
+    for variant, size in sorted(PAGE_VARIANTS.items(), key=lambda v: v[1][0] * v[1][1], reverse=True):
+        img.thumbnail(size)
+        converter.save_page(img, converter.variant_stem(dest_stem, variant), fmt)
+
+
+def _vm_hwm_mb():
+    """このプロセスの最大RSS（/proc/self/status の VmHWM）。ru_maxrss と違い、exec 前の親の値を含まない"""
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 1024
+    raise RuntimeError('VmHWM を読み取れません')
+
+
+def _memory_child(args):
+    """
+    （子プロセス）CBZの1ページを変換し、変換で増えた最大RSS（MB）と時間をJSONで出力する。
+    新しいプロセスで実行するため、最大RSSには他の計測の影響が残らない。
+    """
+    import converter
+    cbz, method = args.child
+    with zipfile.ZipFile(cbz) as z:
+        name = z.namelist()[0]
+    source = converter.ZipMember(cbz, name)
+    convert = converter.convert_page if method == 'bounded' else _legacy_convert_page
+    out_dir = tempfile.mkdtemp(prefix='manga_bench_memory_')
+    before = _rss_mb()['current']
+    start = time.perf_counter()
+    error = None
+    try:
+        convert(source, os.path.join(out_dir, '0000'), 'jpeg')
+    except converter.PageTooLarge as e:
+        error = str(e)
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+    elapsed = time.perf_counter() - start
+    print(json.dumps({
+        'peak_mb': round(max(_vm_hwm_mb() - before, 0), 1),
+        'seconds': round(elapsed, 3),
+        'rejected': error,
+    }))
+
+
+def bench_memory(args):
+    """
+    大きなページ（JPEG/PNG）と、展開すると巨大になるページ（展開爆弾）を変換したときの最大RSSを、
+    以前の変換方法（元の解像度でデコード）と現在の方法（縮小デコードと画素数の上限）で比較する。
+    各変換は新しいプロセスで実行する。
+    """
+    if args.child:
+        return _memory_child(args)
+    work_dir = tempfile.mkdtemp(prefix='manga_bench_memory_')
+    results = {}
+    try:
+        pages = {fmt: (lambda fmt=fmt: _make_large_page((args.width, args.height), fmt)) for fmt in args.formats}
+        # 1ビットの無地の画像はPNGにすると数KBだが、RGBに展開すると 画素数×3 バイトになる
+        bomb_size = (args.bomb, args.bomb)
+        pages['bomb'] = lambda: _save_image(Image.new('1', bomb_size), 'PNG')
+        for kind, make in pages.items():
+            cbz = os.path.join(work_dir, f'{kind}.cbz')
+            with zipfile.ZipFile(cbz, 'w', zipfile.ZIP_STORED) as z:
+                z.writestr(f'page.{"jpg" if kind == "jpeg" else "png"}', make())
+            results[kind] = {'archive_mb': round(os.path.getsize(cbz) / 1024 ** 2, 1)}
+            for method in ('legacy', 'bounded'):
+                out = subprocess.run([sys.executable, os.path.abspath(__file__), 'memory', '--child', cbz, method],
+                                     capture_output=True, text=True, check=True)
+                results[kind][method] = json.loads(out.stdout.strip().splitlines()[-1])
+                print(f"{kind:>5} {method:>8}: 最大RSS +{results[kind][method]['peak_mb']}MB "
+                      f"({results[kind][method]['seconds']}秒)", file=sys.stderr)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    print(json.dumps({
+        'benchmark': 'memory',
+        'page_size': [args.width, args.height],
+        'bomb_size': [args.bomb, args.bomb],
+        'results': results,
+    }, indent=2))
+
+
+def _save_image(img, fmt):
+    buf = io.BytesIO()
+    img.save(buf, fmt)
+    return buf.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='マンガビューアーのベンチマーク')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('convert', help='ページ変換のワーカー数によるスケーリング')
+    p.add_argument('--pages', type=int, default=200)
+    p.add_argument('--width', type=int, default=1600)
+    p.add_argument('--height', type=int, default=2400)
+    p.add_argument('--workers', default='1,2,4')
+    p.set_defaults(func=bench_convert)
+
+    p = sub.add_parser('codecs', help='ページ形式ごとのエンコード時間と1ページあたりのバイト数')
+    p.add_argument('--pages', type=int, default=20)
+    p.add_argument('--width', type=int, default=1600)
+    p.add_argument('--height', type=int, default=2400)
+    p.add_argument('--formats', default='png,jpeg,webp,avif')
+    p.set_defaults(func=bench_codecs)
+
+    p = sub.add_parser('rar', help='RAR/CBRの一括展開とストリーミング抽出の比較')
+    p.add_argument('--archive', help='既存のCBR（省略時は rar コマンドで合成する）')
+    p.add_argument('--pages', type=int, default=200)
+    p.add_argument('--width', type=int, default=1600)
+    p.add_argument('--height', type=int, default=2400)
+    p.add_argument('--solid', action='store_true', help='合成CBRをソリッドアーカイブにする')
+    p.add_argument('--workers', type=int, default=None)
+    p.set_defaults(func=bench_rar)
+
+    p = sub.add_parser('db', help='マンガ一覧・1件取得のクエリ速度（接続の使い回しとインデックスの効果）')
+    p.add_argument('--rows', type=int, default=5000)
+    p.add_argument('--list-iterations', type=int, default=50)
+    p.add_argument('--read-iterations', type=int, default=5000)
+    p.set_defaults(func=bench_db)
+
+    p = sub.add_parser('eviction', help='キャッシュ削除ポリシーごとのヒット率と取得バイト数（アクセスログの再生）')
+    p.add_argument('--trace', help='CACHE_TRACE_LOG で記録したアクセスログ（省略時はZipf分布の合成アクセス列）')
+    p.add_argument('--capacity-mb', type=int, default=2000)
+    p.add_argument('--policies', default='lru,lfu,gdsf')
+    p.add_argument('--default-size-mb', type=int, default=60, help='サイズが記録されていない巻のサイズ')
+    p.add_argument('--volumes', type=int, default=500)
+    p.add_argument('--requests', type=int, default=20000)
+    p.add_argument('--skew', type=float, default=0.9, help='Zipf分布の偏り')
+    p.add_argument('--seed', type=int, default=1)
+    p.set_defaults(func=bench_eviction)
+
+    p = sub.add_parser('pack', help='抽出済みページを個別のファイルとページパックで置いた場合の容量と読み出し時間')
+    p.add_argument('--pages', type=int, default=200)
+    p.add_argument('--width', type=int, default=800)
+    p.add_argument('--height', type=int, default=1200)
+    p.add_argument('--reads', type=int, default=5000)
+    p.add_argument('--seed', type=int, default=1)
+    p.set_defaults(func=bench_pack)
+
+    p = sub.add_parser('serve', help='/image のページ配信の遅延（p50/p99）とスループット（send_file とホットページ）')
+    p.add_argument('--pages', type=int, default=100)
+    p.add_argument('--width', type=int, default=800)
+    p.add_argument('--height', type=int, default=1200)
+    p.add_argument('--requests', type=int, default=5000)
+    p.add_argument('--hot-size', type=int, default=512, help='ホットページの数（HOT_PAGE_CACHE_SIZE）')
+    p.add_argument('--seed', type=int, default=1)
+    p.set_defaults(func=bench_serve)
+
+    p = sub.add_parser('load', help='/add から /image までの流れ（テストクライアントと、同時に要求するWSGIサーバー）')
+    p.add_argument('--format', choices=['cbz', 'cbr'], default='cbz')
+    p.add_argument('--volumes', type=int, default=4)
+    p.add_argument('--pages', type=int, default=30)
+    p.add_argument('--width', type=int, default=1600)
+    p.add_argument('--height', type=int, default=2400)
+    p.add_argument('--eager', action='store_true', help='遅延変換を使わず、ダウンロード後にすべてのページを変換する')
+    p.add_argument('--server', choices=['wsgi', 'asgi'], default='wsgi', help='wsgi: werkzeug のスレッド型サーバー, asgi: uvicorn で asgi.py を配信')
+    p.add_argument('--concurrency', type=int, default=4, help='サーバーに同時に要求するクライアントの数')
+    p.add_argument('--idle-clients', type=int, default=0, help='計測中、リクエストを送り終えないまま接続を保つ遅いクライアントの数')
+    p.add_argument('--image-requests', type=int, default=2000, help='準備が済んだ後に要求するページの数')
+    p.add_argument('--timeout', type=int, default=600, help='1巻の準備を待つ秒数')
+    p.add_argument('--baseline', help='以前の結果のJSON。数値の変化を stderr に出力する')
+    p.add_argument('--seed', type=int, default=1)
+    p.set_defaults(func=bench_load)
+
+    p = sub.add_parser('memory', help='大きなページと展開爆弾を変換したときの最大RSS（以前の方法との比較）')
+    p.add_argument('--width', type=int, default=6000)
+    p.add_argument('--height', type=int, default=9000)
+    p.add_argument('--formats', nargs='+', choices=['jpeg', 'png'], default=['jpeg', 'png'])
+    p.add_argument('--bomb', type=int, default=12000, help='展開爆弾のページの一辺の画素数')
+    p.add_argument('--child', nargs=2, metavar=('CBZ', 'METHOD'), help=argparse.SUPPRESS)
+    p.set_defaults(func=bench_memory)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,322 @@
+import os
+import re
+import time
+import logging
+
+import db
+import pagepack
+from config import MANGA_CACHE_DIR
+
+# キャッシュインデックス
+# manga_cache 内の各ハッシュについて、アーカイブと抽出済み画像のバイト数、
+# 最終アクセス時刻を manga.db に記録する。
+# 合計サイズはトリガーで cache_totals に集計されるため、
+# 読み込み時にファイルシステムを走査する必要がない。
+# version はアーカイブのmtimeで、ページのETagの元になる（同じURLでも再ダウンロードで内容が変わりうるため）。
+# hits（キャッシュ済みの巻が開かれた回数）と clock（GDSF の膨張値）は削除ポリシー（eviction.py）が使う。
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS cache_index (
+        hash TEXT PRIMARY KEY,
+        archive_size INTEGER NOT NULL DEFAULT 0,
+        extracted_size INTEGER NOT NULL DEFAULT 0,
+        last_access REAL NOT NULL DEFAULT 0,
+        version REAL
+    );
+    CREATE INDEX IF NOT EXISTS idx_cache_index_last_access ON cache_index (last_access);
+
+    CREATE TABLE IF NOT EXISTS cache_totals (
+        id INTEGER PRIMARY KEY CHECK (id = 0),
+        total_size INTEGER NOT NULL DEFAULT 0
+    );
+    INSERT OR IGNORE INTO cache_totals (id, total_size) VALUES (0, 0);
+
+    CREATE TRIGGER IF NOT EXISTS cache_index_after_insert AFTER INSERT ON cache_index
+    BEGIN
+        UPDATE cache_totals SET total_size = total_size + NEW.archive_size + NEW.extracted_size WHERE id = 0;
+    END;
+    CREATE TRIGGER IF NOT EXISTS cache_index_after_delete AFTER DELETE ON cache_index
+    BEGIN
+        UPDATE cache_totals SET total_size = total_size - OLD.archive_size - OLD.extracted_size WHERE id = 0;
+    END;
+    CREATE TRIGGER IF NOT EXISTS cache_index_after_update AFTER UPDATE OF archive_size, extracted_size ON cache_index
+    BEGIN
+        UPDATE cache_totals
+        SET total_size = total_size + (NEW.archive_size + NEW.extracted_size) - (OLD.archive_size + OLD.extracted_size)
+        WHERE id = 0;
+    END;
+'''
+
+# アーカイブと抽出済み画像の合計を別々に集計するトリガー（スキーマ v6 以降）
+TOTALS_TRIGGERS = [
+    '''
+    CREATE TRIGGER cache_index_after_insert AFTER INSERT ON cache_index
+    BEGIN
+        UPDATE cache_totals
+        SET total_size = total_size + NEW.archive_size + NEW.extracted_size,
+            archive_size = archive_size + NEW.archive_size,
+            extracted_size = extracted_size + NEW.extracted_size
+        WHERE id = 0;
+    END
+    ''',
+    '''
+    CREATE TRIGGER cache_index_after_delete AFTER DELETE ON cache_index
+    BEGIN
+        UPDATE cache_totals
+        SET total_size = total_size - OLD.archive_size - OLD.extracted_size,
+            archive_size = archive_size - OLD.archive_size,
+            extracted_size = extracted_size - OLD.extracted_size
+        WHERE id = 0;
+    END
+    ''',
+    '''
+    CREATE TRIGGER cache_index_after_update AFTER UPDATE OF archive_size, extracted_size ON cache_index
+    BEGIN
+        UPDATE cache_totals
+        SET total_size = total_size + (NEW.archive_size + NEW.extracted_size) - (OLD.archive_size + OLD.extracted_size),
+            archive_size = archive_size + NEW.archive_size - OLD.archive_size,
+            extracted_size = extracted_size + NEW.extracted_size - OLD.extracted_size
+        WHERE id = 0;
+    END
+    ''',
+]
+
+HASH_PATTERN = re.compile(r'([0-9a-fA-F]{32})')
+PARTIAL_PATTERN = re.compile(r'\.part(\.json)?$')
+
+# version のプロセス内キャッシュ（/image のたびにDBを読まないため）
+VERSION_TTL = 60 # 秒
+_versions = {} # {hash: (version, 取得時刻)}
+
+
+def init_schema(db):
+    """キャッシュインデックスのテーブルとトリガーを作成する"""
+    db.executescript(SCHEMA)
+    # 古いスキーマからの移行: version 列を追加する
+    columns = [row[1] for row in db.execute('PRAGMA table_info(cache_index)')]
+    if 'version' not in columns:
+        db.execute('ALTER TABLE cache_index ADD COLUMN version REAL')
+    db.commit()
+
+
+def add_access_stats(db):
+    """削除ポリシー用の列と、アーカイブ・抽出済み画像ごとの合計を追加する（スキーマ v6）"""
+    db.execute('ALTER TABLE cache_index ADD COLUMN hits INTEGER NOT NULL DEFAULT 0')
+    db.execute('ALTER TABLE cache_index ADD COLUMN clock REAL NOT NULL DEFAULT 0')
+    db.execute('ALTER TABLE cache_totals ADD COLUMN archive_size INTEGER NOT NULL DEFAULT 0')
+    db.execute('ALTER TABLE cache_totals ADD COLUMN extracted_size INTEGER NOT NULL DEFAULT 0')
+    db.execute('ALTER TABLE cache_totals ADD COLUMN clock REAL NOT NULL DEFAULT 0')
+    db.execute('''
+        UPDATE cache_totals
+        SET archive_size = (SELECT COALESCE(SUM(archive_size), 0) FROM cache_index),
+            extracted_size = (SELECT COALESCE(SUM(extracted_size), 0) FROM cache_index)
+        WHERE id = 0
+    ''')
+    for name in ('insert', 'delete', 'update'):
+        db.execute(f'DROP TRIGGER IF EXISTS cache_index_after_{name}')
+    for trigger in TOTALS_TRIGGERS:
+        db.execute(trigger)
+
+
+def dir_size(path):
+    """ディレクトリ配下の全ファイルの合計サイズを返す（書き込み時のみ使用）"""
+    size = 0
+    for r, _, files in os.walk(path):
+        for file in files:
+            try:
+                size += os.path.getsize(os.path.join(r, file))
+            except OSError:
+                pass
+    return size
+
+
+def record(manga_hash, archive_size=None, extracted_size=None, version=None):
+    """
+    ハッシュのサイズ情報を登録・更新し、最終アクセス時刻を現在時刻にする。
+    None を渡したサイズ・バージョンは変更しない。
+    """
+    _versions.pop(manga_hash, None)
+    now = time.time()
+    conn = db.get_connection()
+    with conn:
+        # 新しい巻の GDSF の優先度は、現在のクロック（L）から始める
+        conn.execute('''
+            INSERT OR IGNORE INTO cache_index (hash, last_access, clock)
+            VALUES (?, ?, (SELECT clock FROM cache_totals WHERE id = 0))
+        ''', (manga_hash, now))
+        conn.execute('''
+            UPDATE cache_index
+            SET archive_size = COALESCE(?, archive_size),
+                extracted_size = COALESCE(?, extracted_size),
+                version = COALESCE(?, version),
+                last_access = ?
+            WHERE hash = ?
+        ''', (archive_size, extracted_size, version, now, manga_hash))
+
+
+def add_extracted_size(manga_hash, size):
+    """ページを1枚変換したときなどに、抽出済みサイズを加算する"""
+    conn = db.get_connection()
+    with conn:
+        conn.execute('UPDATE cache_index SET extracted_size = extracted_size + ? WHERE hash = ?', (size, manga_hash))
+
+
+def touch(manga_hash, hit=False):
+    """
+    最終アクセス時刻を更新する（インデックスに存在するハッシュのみ）。
+    hit が真の場合（巻が開かれた場合）は、開かれた回数を増やし、GDSF のクロックを現在の値にする。
+    まだダウンロード中でインデックスにない巻は、サイズ 0 の行を作って回数を残す（record() で続けて使う）。
+    """
+    conn = db.get_connection()
+    with conn:
+        if hit:
+            conn.execute('''
+                INSERT INTO cache_index (hash, last_access, hits, clock)
+                VALUES (?, ?, 1, (SELECT clock FROM cache_totals WHERE id = 0))
+                ON CONFLICT (hash) DO UPDATE
+                SET last_access = excluded.last_access, hits = hits + 1, clock = excluded.clock
+            ''', (manga_hash, time.time()))
+        else:
+            conn.execute('UPDATE cache_index SET last_access = ? WHERE hash = ?', (time.time(), manga_hash))
+
+
+def drop_archive(manga_hash):
+    """アーカイブだけを削除したハッシュのアーカイブサイズを 0 にする（抽出済み画像は残る）"""
+    conn = db.get_connection()
+    with conn:
+        conn.execute('UPDATE cache_index SET archive_size = 0 WHERE hash = ?', (manga_hash,))
+
+
+def inflate(value):
+    """GDSF: 削除した巻の優先度までクロック（L）を上げる"""
+    conn = db.get_connection()
+    with conn:
+        conn.execute('UPDATE cache_totals SET clock = MAX(clock, ?) WHERE id = 0', (value,))
+
+
+def version(manga_hash, cached_only=False):
+    """
+    キャッシュ済みアーカイブのバージョン（mtime）を返す。インデックスにない場合は None。
+    プロセス内で VERSION_TTL 秒だけキャッシュする。
+    cached_only の場合はデータベースを読まず、キャッシュにない場合は None を返す（ASGI のイベントループから呼ぶ）。
+    """
+    now = time.time()
+    cached = _versions.get(manga_hash)
+    if cached and now - cached[1] < VERSION_TTL:
+        return cached[0]
+    if cached_only:
+        return None
+    conn = db.get_connection()
+    row = conn.execute('SELECT version FROM cache_index WHERE hash = ?', (manga_hash,)).fetchone()
+    value = row['version'] if row else None
+    if value is not None:
+        _versions[manga_hash] = (value, now)
+    return value
+
+
+def remove(manga_hash):
+    """ハッシュをインデックスから削除する"""
+    _versions.pop(manga_hash, None)
+    conn = db.get_connection()
+    with conn:
+        conn.execute('DELETE FROM cache_index WHERE hash = ?', (manga_hash,))
+
+
+def clear():
+    """インデックスを空にする（キャッシュ全削除時に使用）"""
+    _versions.clear()
+    conn = db.get_connection()
+    with conn:
+        conn.execute('DELETE FROM cache_index')
+        conn.execute('UPDATE cache_totals SET total_size = 0, archive_size = 0, extracted_size = 0, clock = 0 WHERE id = 0')
+
+
+def total_size():
+    """インデックス上のキャッシュ合計サイズ（バイト）を返す"""
+    conn = db.get_connection()
+    row = conn.execute('SELECT total_size FROM cache_totals WHERE id = 0').fetchone()
+    return row['total_size'] if row else 0
+
+
+def size(manga_hash):
+    """ハッシュのキャッシュサイズ（アーカイブ + 抽出済み、バイト）を返す。インデックスにない場合は 0"""
+    conn = db.get_connection()
+    row = conn.execute('SELECT archive_size + extracted_size AS size FROM cache_index WHERE hash = ?', (manga_hash,)).fetchone()
+    return row['size'] if row else 0
+
+
+def totals():
+    """インデックス上の合計サイズ（バイト）を {'total', 'archive', 'extracted'} で返す"""
+    conn = db.get_connection()
+    row = conn.execute('SELECT total_size, archive_size, extracted_size FROM cache_totals WHERE id = 0').fetchone()
+    if row is None:
+        return {'total': 0, 'archive': 0, 'extracted': 0}
+    return {'total': row['total_size'], 'archive': row['archive_size'], 'extracted': row['extracted_size']}
+
+
+def eviction_candidates(policy, exclude=()):
+    """
+    削除ポリシーの順（先に削除するものから）に (hash, archive_size, extracted_size, priority) を返すジェネレーター。
+    exclude のハッシュ（読んでいる巻、ジョブで書き込み中の巻など）は返さない。
+    LRU では last_access のインデックスを使うため、必要な件数だけを読み出す。
+    呼び出し側が削除しながら読み進めるため、スレッドの接続とは別の接続を使う。
+    """
+    conn = db.connect()
+    try:
+        cur = conn.execute(f'''
+            SELECT hash, archive_size, extracted_size, {policy.priority_sql} AS priority
+            FROM cache_index
+            ORDER BY {policy.order_by}
+        ''')
+        for row in cur:
+            if row['hash'] in exclude:
+                continue
+            yield row['hash'], row['archive_size'], row['extracted_size'], row['priority']
+    finally:
+        conn.close()
+
+
+def rebuild():
+    """
+    キャッシュディレクトリを一度だけ走査し、インデックスをディスクの状態に合わせる。
+    クラッシュ後などにインデックスとディスクがずれた場合に使用する。
+    既存の last_access は保持し、新規エントリはファイルの mtime を使用する。
+    アーカイブを削除した巻のバージョンは、ページパックに記録したものを使う。
+    """
+    found = {} # {hash: {'archive_size': int, 'extracted_size': int, 'mtime': float, 'version': float}}
+    for f in os.listdir(MANGA_CACHE_DIR):
+        match = HASH_PATTERN.match(f)
+        if not match:
+            continue
+        full_path = os.path.join(MANGA_CACHE_DIR, f)
+        item = found.setdefault(match.group(1), {'archive_size': 0, 'extracted_size': 0, 'mtime': 0, 'version': None})
+        if os.path.isfile(full_path):
+            item['archive_size'] += os.path.getsize(full_path)
+            item['mtime'] = max(item['mtime'], os.path.getmtime(full_path))
+            if not PARTIAL_PATTERN.search(f): # ダウンロード途中のファイルはバージョンにしない
+                item['version'] = os.path.getmtime(full_path)
+        elif os.path.isdir(full_path):
+            item['extracted_size'] += dir_size(full_path)
+            item['mtime'] = max(item['mtime'], os.path.getmtime(full_path))
+            item['pack_path'] = os.path.join(full_path, pagepack.PACK_NAME)
+    for item in found.values():
+        if item['version'] is None and os.path.isfile(item.get('pack_path', '')):
+            item['version'] = pagepack.archive_version(item['pack_path'])
+
+    _versions.clear()
+    conn = db.get_connection()
+    with conn:
+        # 最終アクセス時刻と、削除ポリシー用の回数・クロックは保持する
+        existing = {row['hash']: row for row in conn.execute('SELECT hash, last_access, hits, clock FROM cache_index')}
+        conn.execute('DELETE FROM cache_index')
+        conn.execute('UPDATE cache_totals SET total_size = 0, archive_size = 0, extracted_size = 0 WHERE id = 0')
+        conn.executemany(
+            'INSERT INTO cache_index (hash, archive_size, extracted_size, last_access, version, hits, clock) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            [(h, item['archive_size'], item['extracted_size'],
+              existing[h]['last_access'] if h in existing else item['mtime'], item['version'],
+              existing[h]['hits'] if h in existing else 0, existing[h]['clock'] if h in existing else 0)
+             for h, item in found.items()]
+        )
+
+    logging.info(f"キャッシュインデックスを再構築しました: {len(found)} 件")
+    return len(found)
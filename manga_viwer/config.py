@@ -9,10 +9,93 @@ DATABASE = os.path.join(BASE_DIR, 'manga.db')
 # キャッシュディレクトリ設定
 MANGA_CACHE_DIR = os.path.join(BASE_DIR, 'manga_cache')
 MANGA_CACHE_TEMP_DIR = os.path.join(BASE_DIR, 'manga_cache_temp')
-CACHE_SIZE_LIMIT_MB = 270  # キャッシュの最大サイズ（MB）
+CACHE_SIZE_LIMIT_MB = 1536  # キャッシュの最大サイズ（MB）
+ARCHIVE_CACHE_LIMIT_MB = 1024  # そのうちアーカイブの最大サイズ（MB）。超えた場合は抽出済みの巻のアーカイブから削除する
+                               # 読んでいる巻と先読みした次の巻のアーカイブ（それぞれ最大 MAX_DOWNLOAD_SIZE_MB）が収まる大きさにする
+EXTRACTED_CACHE_LIMIT_MB = 1024  # そのうち抽出済み画像の最大サイズ（MB）
+CACHE_EVICTION_POLICY = 'lru'  # キャッシュの削除ポリシー（'lru' / 'lfu' / 'gdsf'、eviction.py）
+CACHE_TRACE_LOG = None  # 巻が開かれるたびにアクセスを記録するファイル（benchmark.py eviction で再生できる）。None で記録しない
 
 # リーダー設定
 IMAGES_PER_LOAD = 5        # 一度に読み込む画像の枚数
+MAX_PAGES_PER_REQUEST = 100 # /manga/<hash>/pages の limit の上限
+MANIFEST_CACHE_SIZE = 128  # メモリに保持するページマニフェストの数
+
+# ページ変換設定
+PAGE_MAX_SIZE = (1200, 1600)                # 変換後のページの最大サイズ（幅, 高さ）
+# ページの保存形式（優先順）。/image では Accept ヘッダーを見て、クライアントが対応する最初の形式を返す。
+# 'avif', 'webp', 'jpeg', 'png' から選択（jpeg/png はすべてのクライアントが対応しているものとみなす）
+PAGE_FORMATS = ['webp', 'jpeg']
+PAGE_QUALITY_TIERS = {'low': 60, 'standard': 80, 'high': 90} # 非可逆形式の品質
+PAGE_QUALITY = 'standard'                   # 使用する品質ティア
+# ページのサイズバリアント（名前: 最大サイズ）。1回のデコードからすべてのサイズを作成する。
+# 'full' は必須で、PAGE_MAX_SIZE と同じサイズになる。
+PAGE_VARIANTS = {
+    'thumb': (240, 360),    # サムネイル一覧用
+    'mobile': (720, 1080),  # スマートフォン用
+    'full': PAGE_MAX_SIZE,
+}
+CONVERT_WORKERS = os.cpu_count() or 1       # ページ変換に使うプロセス数（1の場合はプロセスプールを使わない）
+CONVERT_MAX_IN_FLIGHT = CONVERT_WORKERS * 2 # 同時に処理中にできるページ数の上限（メモリ使用量の制限）
+# デコード後の画素数の上限（JPEG は縮小デコード後）。超えるページは変換しない（展開爆弾対策）。
+# JPEG は PAGE_MAX_SIZE の2倍以上を保つ大きさまで縮小してデコードするため、縮小後は最大で PAGE_MAX_SIZE の16倍の画素数になり、
+# この上限で拒否されない。縮小デコードできない PNG などは、元の画素数がこれを超えると拒否する（RGBで約90MB）。
+PAGE_MAX_PIXELS = PAGE_MAX_SIZE[0] * PAGE_MAX_SIZE[1] * 16
+
+# 遅延変換
+# 有効にすると、ダウンロード後はページマニフェスト（メンバー一覧）だけを作成し、
+# 各ページは /image で最初に要求されたときに変換してキャッシュする。
+LAZY_CONVERSION = True
+
+# ページパック（変換済みのページを巻ごとに1つのファイルにまとめる、pagepack.py）
+# 遅延変換ではすべてのページが変換された巻を、キャッシュの予算でアーカイブを削除するときにまとめる。
+PACK_PAGES = False
+PACK_POOL_SIZE = 64        # プロセスごとに mmap したままにするページパックの数
+# 事前変換が成功したら元のアーカイブを削除する（ダイレクトモードの巻は除く）。
+# 削除した巻の別の形式やサイズのページは、保存済みの（非可逆圧縮された）ページから変換するため画質が落ちる。
+DROP_ARCHIVE_AFTER_CONVERSION = False
+
+# ホットページ（最近配信したページの場所を保持し、パスの検証やファイルの有無の確認をせずに返す、hotpages.py）
+HOT_PAGE_CACHE_SIZE = 512  # プロセスごとに保持するページの数。0で無効
+
+# 巻のメタデータ（ページ数・表紙のサムネイルなど、metadata.py）
+# ライブラリの一覧に表紙を表示するため、追加時に先頭の画像だけを読んで生成する。
+COVER_SIZE = (240, 360)    # 表紙のサムネイルの最大サイズ（幅, 高さ）
+COVER_QUALITY = 75         # 表紙のサムネイルの JPEG 品質
+METADATA_WORKERS = 1       # メタデータを生成するスレッド数（プロセスごと）
+METADATA_QUEUE_SIZE = 256  # 生成待ちの巻の上限（超えた分は一覧の表示時に改めて登録される）
+METADATA_BLOCK_KB = 64     # ダウンロード前のZIPから Range で一度に取得する最小のサイズ（KB）
+COVER_MAX_MB = 32          # 表紙にする先頭ページの最大サイズ（MB、圧縮前後とも）。超える巻は表紙なしにする
+                           # ダウンロード前のZIPから Range で取得する合計は、この2倍（先頭ページとセントラルディレクトリ）まで
+METADATA_RETRY_AFTER = 24 * 60 * 60  # 生成に失敗した巻を再試行するまでの秒数
+
+# ページ配信のHTTPキャッシュ
+# ページはハッシュと連番で決まり内容が変わらないため、ブラウザやCDNに長期間キャッシュさせる。
+IMAGE_CACHE_MAX_AGE = 365 * 24 * 60 * 60  # 秒（1年）
+
+# ダイレクトモード（ZIP/CBZのみ）
+# 有効にすると、ページを事前に変換せず、キャッシュ済みアーカイブから直接配信する。
+# PAGE_MAX_SIZE を超えるページや、JPEG/PNG/GIF以外のページのみ配信時に変換する。
+DIRECT_MODE = False
+ZIP_HANDLE_POOL_SIZE = 32  # プロセスごとに開いたままにするZIPハンドルの数
+
+# バックグラウンドジョブ設定（ダウンロードと解凍）
+JOB_WORKERS = 2            # 同時に処理するジョブ数
+JOB_QUEUE_SIZE = 16        # 待機できるジョブの最大数
+JOB_RESULT_TTL = 600       # 終了したジョブの状態を保持する秒数
+JOB_STATUS_MAX_WAIT = 20   # /job_status?wait= で進捗が変わるまで待つ最大秒数（ASGI で配信する場合のみ待つ）
+
+# 一括追加（/add_batch）
+MAX_BATCH_URLS = 1000      # 1回のリクエストで追加できるURLの最大数
+BATCH_PREFETCH_LIMIT = 8   # 1回の一括追加で先読み（ダウンロードと抽出）を登録するジョブの最大数（閲覧用の枠を残す）
+
+# 先読み（読んでいる位置より先のページと、シリーズの次の巻）
+PREFETCH_ENABLED = True
+PREFETCH_PAGES = 10        # 読み込んだページより先に変換しておくページ数（遅延変換時）
+PREFETCH_WORKERS = 1       # 先読みを行うスレッド数
+PREFETCH_QUEUE_SIZE = 64   # 待機できる先読みの最大数（超えた分は捨てる）
+PREFETCH_NEXT_VOLUME_AT = 0.5  # 巻のこの割合まで読んだら、同じディレクトリの次の巻をダウンロードする
+PREFETCH_BUDGET_MB = 300   # 先読みしてまだ開かれていない巻の合計サイズの上限（MB）
 
 # セキュリティ設定
 # !!! 本番環境では、以下の値を環境変数から読み込むなどして安全に設定してください !!!
@@ -25,4 +108,37 @@ FLASK_SECRET_KEY = 'your_super_secret_and_complex_key_here_please_change'
 ALLOWED_DOMAINS = []
 
 # ダウンロードするファイルの最大サイズ（MB） - DoS攻撃対策
-MAX_DOWNLOAD_SIZE_MB = 500 # 500MB
\ No newline at end of file
+MAX_DOWNLOAD_SIZE_MB = 500 # 500MB
+
+# ダウンロードの設定
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024 # 1回に読み書きするバイト数
+DOWNLOAD_SEGMENTS = 4 # Range対応サーバーから並列に取得する区間の数（1で分割しない）
+DOWNLOAD_SEGMENT_MIN_MB = 32 # このサイズ以上のファイルのみ分割してダウンロードする
+DOWNLOAD_RETRIES = 3 # 接続が切れた場合に続きから再開する回数
+DOWNLOAD_STATE_SAVE_MB = 8 # 分割ダウンロードで、区間ごとにこのサイズを受信するたびに進捗（.part.json）を保存する
+
+# 共有HTTPクライアントの設定
+HTTP_POOL_SIZE = 16 # ホストごとに保持するkeep-alive接続の数
+HTTP_MAX_PER_HOST = 4 # 同じホストへの同時リクエスト数の上限（全ジョブ合計）
+HTTP_RETRIES = 3 # 接続エラーや 429/5xx 応答の再試行回数
+HTTP_BACKOFF = 0.5 # 再試行の待ち時間の係数（0.5秒, 1秒, 2秒...）
+
+# データベース接続の設定（接続はスレッドごとに使い回し、WALモードで使用する）
+DB_MMAP_SIZE = 64 * 1024 * 1024 # メモリマップで読み込むバイト数
+DB_CACHE_SIZE_KB = 16 * 1024 # 接続ごとのページキャッシュ（KB）
+DB_CACHED_STATEMENTS = 256 # 接続ごとに保持するプリペアドステートメントの数
+
+# ライブラリ一覧の設定
+LIBRARY_PAGE_SIZE = 60 # /manga_list で一度に返すマンガの数（スクロールで続きを読み込む）
+
+# メトリクス（/metrics、metrics.py）
+# 各プロセスの値をこのディレクトリに書き出し、/metrics で合算する（gunicorn の複数ワーカーに対応）。
+# None の場合はファイルを使わず、リクエストを処理したプロセスの値だけを返す。
+METRICS_DIR = os.path.join(BASE_DIR, 'metrics')
+METRICS_FLUSH_INTERVAL = 5 # 値を書き出す間隔（秒）。/metrics の値はこの分だけ遅れることがある
+
+# ASGI での配信（asgi.py。uvicorn などで asgi:application を起動する）
+# 接続はイベントループで扱い、Flask のルートとファイルの読み出しだけをスレッドで実行する。
+# ページの304と /job_status は Flask のルートを通さずにイベントループで応答を作る（ファイルを開く応答はスレッドで作る）。
+ASGI_THREADS = 8                # Flask のルートとファイルの読み出しに使うスレッド数（同時接続数とは無関係）
+ASGI_CHUNK_SIZE = 256 * 1024    # ファイルの応答を読み出して送る単位（バイト）
@@ -0,0 +1,307 @@
+import io
+import os
+import time
+import zipfile
+import functools
+import contextlib
+import threading
+import multiprocessing
+import logging
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from collections import namedtuple
+
+from PIL import Image, features
+
+import metrics
+
+from config import (
+    CONVERT_WORKERS,
+    CONVERT_MAX_IN_FLIGHT,
+    PAGE_MAX_SIZE,
+    PAGE_MAX_PIXELS,
+    PAGE_FORMATS,
+    PAGE_QUALITY,
+    PAGE_QUALITY_TIERS,
+    PAGE_VARIANTS
+)
+
+# ページ変換ステージ
+# ZIP/RAR の両方から使われ、ページのデコード・リサイズ・エンコードをプロセスプールで並列に実行する。
+# 同時に処理中のページ数を CONVERT_MAX_IN_FLIGHT に制限し、メモリ使用量を一定に保つ。
+# 1ページあたりのメモリも、元の解像度で展開しないことで抑える。JPEG は draft で縮小しながらデコードし、
+# 縮小してからRGBに変換する。デコード後の画素数が PAGE_MAX_PIXELS を超えるページは変換しない（展開爆弾対策）。
+# ZIPのメンバーは ZipMember として渡し、ワーカーがアーカイブから直接ストリームで読む（親プロセスでバイト列にしない）。
+
+_executors = {} # {ワーカー数: ProcessPoolExecutor}
+_executors_lock = threading.Lock()
+
+# 出力形式: {名前: (Pillowの形式名, MIMEタイプ, 拡張子)}
+FORMATS = {
+    'avif': ('AVIF', 'image/avif', 'avif'),
+    'webp': ('WEBP', 'image/webp', 'webp'),
+    'jpeg': ('JPEG', 'image/jpeg', 'jpg'),
+    'png': ('PNG', 'image/png', 'png'),
+}
+# 拡張子から形式名を引くための逆引き表（保存済みページのMIMEタイプ判定に使う）
+FORMAT_BY_EXT = {ext: name for name, (_, _, ext) in FORMATS.items()}
+
+# 縮小してからRGBに変換するモード（それ以外はパレットや透過を正しく扱うため、先にRGBに変換する）
+RESIZE_BEFORE_CONVERT_MODES = ('L', 'RGB', 'CMYK')
+
+# ZIPのメンバー（アーカイブのパスとメンバー名）。ページの source として渡すと、変換するプロセスが直接読み出す
+ZipMember = namedtuple('ZipMember', 'archive_path name')
+
+
+class PageTooLarge(ValueError):
+    """デコード後の画素数が PAGE_MAX_PIXELS を超えるページ"""
+
+
+# ページ変換の段階（decode / resize / encode）ごとの時間。プロセスプールではワーカープロセスが記録する
+PAGE_STAGE_SECONDS = metrics.histogram('manga_page_stage_seconds', 'ページ変換の段階ごとの1ページあたりの時間（秒）', ('stage',))
+
+
+@functools.lru_cache(maxsize=None)
+def available_formats():
+    """PAGE_FORMATS のうち、このPillowでエンコードできる形式を優先順に返す"""
+    formats = []
+    for name in PAGE_FORMATS:
+        if name not in FORMATS:
+            logging.warning(f"未対応のページ形式が設定されています: {name}")
+            continue
+        if name in ('webp', 'avif') and not features.check(name):
+            continue
+        formats.append(name)
+    return tuple(formats) or ('jpeg',)
+
+
+def mime_type(fmt):
+    return FORMATS[fmt][1]
+
+
+def file_ext(fmt):
+    return FORMATS[fmt][2]
+
+
+def encode_options(fmt, quality=None):
+    """形式ごとのエンコードオプション（品質は PAGE_QUALITY_TIERS から選ぶ）"""
+    quality = quality or PAGE_QUALITY_TIERS[PAGE_QUALITY]
+    if fmt == 'webp':
+        return {'quality': quality, 'method': 4}
+    if fmt == 'avif':
+        return {'quality': quality}
+    if fmt == 'jpeg':
+        return {'quality': quality, 'optimize': True, 'progressive': True}
+    return {}
+
+
+def encode_page(img, fmt, fp, quality=None):
+    """画像を指定の形式でファイルまたはバッファに書き出す"""
+    img.save(fp, FORMATS[fmt][0], **encode_options(fmt, quality))
+
+
+def variant_stem(stem, variant):
+    """バリアントのファイル名（拡張子なし）。'full' は連番のみ、それ以外は '<連番>_<バリアント名>'"""
+    return stem if variant == 'full' else f'{stem}_{variant}'
+
+
+def save_page(img, dest_stem, fmt):
+    """
+    画像を指定の形式で '<dest_stem>.<拡張子>' に保存し、保存先のパスを返す。
+    変換中のページが配信されないよう、一時ファイルに書き込んでから置き換える。
+    """
+    dest_path = f'{dest_stem}.{file_ext(fmt)}'
+    # 同じページを複数のスレッド・プロセスが同時に変換しても衝突しないよう、一時ファイル名を分ける
+    tmp_path = f'{dest_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    encode_page(img, fmt, tmp_path)
+    os.replace(tmp_path, dest_path)
+    return dest_path
+
+
+def resize_page(source):
+    """
+    ページをデコードし、PAGE_MAX_SIZE に収まるよう縮小したRGBの画像を返す。
+    source は画像のバイト列、ファイルパス、ZipMember、または開いたファイルオブジェクト。
+    """
+    return fit_page(load_page(source, PAGE_MAX_SIZE), PAGE_MAX_SIZE)
+
+
+@contextlib.contextmanager
+def open_source(source):
+    """
+    ページの source をファイルオブジェクトとして開く（ZipMember はメンバー全体を読み込まずにストリームで開く）。
+    開いたファイルオブジェクト（プールの ZIP ハンドルから開いたメンバーなど）はそのまま使い、閉じない。
+    """
+    if isinstance(source, bytes):
+        yield io.BytesIO(source)
+    elif isinstance(source, ZipMember):
+        with zipfile.ZipFile(source.archive_path) as zip_ref, zip_ref.open(source.name) as fp:
+            yield fp
+    elif hasattr(source, 'read'):
+        yield source
+    else:
+        with open(source, 'rb') as fp:
+            yield fp
+
+
+def check_pixels(img):
+    """デコードする画素数が PAGE_MAX_PIXELS を超える場合は PageTooLarge を送出する（draft の後に呼ぶ）"""
+    if img.width * img.height > PAGE_MAX_PIXELS:
+        raise PageTooLarge(f"ページの画素数が上限を超えています: {img.width}x{img.height}")
+
+
+def load_page(source, size):
+    """
+    ページをデコードして返す（モードは元のまま）。
+    JPEG は size の2倍以上を保つ最小の縮小率（1/2, 1/4, 1/8）でデコードし、元の解像度では展開しない。
+    """
+    with open_source(source) as fp:
+        img = Image.open(fp)
+        img.draft('RGB', (size[0] * 2, size[1] * 2))
+        check_pixels(img)
+        img.load()
+    return img
+
+
+def fit_page(img, size):
+    """デコードした画像を size に収まるよう縮小し、RGBにして返す（RGBへの変換は可能な限り縮小後に行う）"""
+    if img.mode not in RESIZE_BEFORE_CONVERT_MODES:
+        img = img.convert('L' if img.mode == '1' else 'RGB')
+    img.thumbnail(size)
+    return img if img.mode == 'RGB' else img.convert('RGB')
+
+
+def convert_page(source, dest_stem, fmt):
+    """
+    1ページを一度だけデコードし、PAGE_VARIANTS のすべてのサイズを保存する（ワーカープロセスで実行される）。
+    source は画像のバイト列、ファイルパス、ZipMember、または開いたファイルオブジェクト。
+    大きいバリアントから順に縮小していくため、デコードとリサイズの大部分は共有される。
+    {バリアント名: 保存先のパス} を返す。
+    """
+    start = time.perf_counter()
+    img = load_page(source, PAGE_MAX_SIZE)
+    decoded = time.perf_counter()
+    img = fit_page(img, PAGE_MAX_SIZE)
+    resize = time.perf_counter() - decoded
+    encode = 0.0
+    paths = {}
+    for variant, size in sorted(PAGE_VARIANTS.items(), key=lambda v: v[1][0] * v[1][1], reverse=True):
+        t0 = time.perf_counter()
+        img.thumbnail(size)
+        t1 = time.perf_counter()
+        paths[variant] = save_page(img, variant_stem(dest_stem, variant), fmt)
+        resize += t1 - t0
+        encode += time.perf_counter() - t1
+    PAGE_STAGE_SECONDS.observe(decoded - start, 'decode')
+    PAGE_STAGE_SECONDS.observe(resize, 'resize')
+    PAGE_STAGE_SECONDS.observe(encode, 'encode')
+    return paths
+
+
+def transcode_page(source, fmt, size=None):
+    """1ページを変換し、指定の形式のバイト列として返す（ダイレクトモードで使用）"""
+    img = resize_page(source)
+    if size:
+        img.thumbnail(size)
+    buf = io.BytesIO()
+    encode_page(img, fmt, buf)
+    return buf.getvalue()
+
+
+def direct_mime_type(fp):
+    """
+    ページ（開いたファイルオブジェクト）をそのまま配信できる場合はMIMEタイプを返し、変換が必要な場合は None を返す。
+    ヘッダーのみを読むため、画像全体はデコードしない。読んだ後は fp を先頭に戻す。
+    """
+    try:
+        img = Image.open(fp)
+    except Exception:
+        return None
+    finally:
+        fp.seek(0)
+    if img.format not in ('JPEG', 'PNG', 'GIF'):
+        return None
+    if img.width > PAGE_MAX_SIZE[0] or img.height > PAGE_MAX_SIZE[1]:
+        return None
+    return Image.MIME[img.format]
+
+
+def _get_executor(workers):
+    """ワーカー数ごとにプロセスプールを1つだけ作成して使い回す"""
+    with _executors_lock:
+        executor = _executors.get(workers)
+        if executor is None:
+            # fork が使える環境では fork を使い、アプリ本体の再インポートを避ける
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+            executor = ProcessPoolExecutor(max_workers=workers, mp_context=context)
+            _executors[workers] = executor
+        return executor
+
+
+def _discard_executor(workers):
+    """壊れたプロセスプールを破棄し、次回作り直す"""
+    with _executors_lock:
+        executor = _executors.pop(workers, None)
+    if executor is not None:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def convert_pages(pages, extract_to, total, progress=None, workers=None, label='', fmt=None):
+    """
+    ページを並列に変換して extract_to に保存する。
+    pages は (連番, 名前, source) を返すイテラブルで、必要になった時点で読み込まれる。
+    source がバイト列の場合はワーカーに送られるため、ZIPのメンバーは ZipMember で渡す。
+    出力ファイル名は連番から '{i:04d}.<拡張子>' として決まるため、処理順に依存しない。
+    fmt を省略した場合は、優先順位が最も高い形式で保存する。
+    progress が指定された場合は progress(処理済みページ数, 総ページ数) を呼び出す。
+    """
+    workers = workers or CONVERT_WORKERS
+    fmt = fmt or available_formats()[0]
+    done = 0
+
+    if workers <= 1:
+        # 1ワーカーの場合はプロセス間通信のコストを避けて直接変換する
+        for i, name, source in pages:
+            try:
+                convert_page(source, os.path.join(extract_to, f'{i:04d}'), fmt)
+            except Exception as e:
+                logging.warning(f"画像処理エラー ({label}): {name} - {e}", exc_info=True)
+            done += 1
+            if progress:
+                progress(done, total)
+        return
+
+    executor = _get_executor(workers)
+    max_in_flight = max(CONVERT_MAX_IN_FLIGHT, workers)
+    pending = {} # {future: 名前}
+
+    def collect(block):
+        nonlocal done
+        finished, _ = wait(pending, return_when=FIRST_COMPLETED) if block else (
+            [f for f in pending if f.done()], None)
+        for future in finished:
+            name = pending.pop(future)
+            try:
+                future.result()
+            except BrokenProcessPool:
+                _discard_executor(workers)
+                raise
+            except Exception as e:
+                logging.warning(f"画像処理エラー ({label}): {name} - {e}")
+            done += 1
+            if progress:
+                progress(done, total)
+
+    try:
+        for i, name, source in pages:
+            # 処理中のページ数が上限に達したら、どれかが終わるまで待つ
+            while len(pending) >= max_in_flight:
+                collect(block=True)
+            pending[executor.submit(convert_page, source, os.path.join(extract_to, f'{i:04d}'), fmt)] = name
+            collect(block=False)
+        while pending:
+            collect(block=True)
+    finally:
+        for future in pending:
+            future.cancel()
@@ -0,0 +1,168 @@
+import os
+import sqlite3
+import threading
+import logging
+
+from config import DATABASE, DB_MMAP_SIZE, DB_CACHE_SIZE_KB, DB_CACHED_STATEMENTS
+
+# データベース接続とスキーマ移行
+# 接続はスレッドごと（gunicorn のワーカープロセスごと）に1つだけ開いて使い回す。
+# リクエストのたびに接続を開き直すコストを避け、sqlite3 のプリペアドステートメントキャッシュを有効に使う。
+# スキーマは PRAGMA user_version で管理し、MIGRATIONS の未適用分だけを順に適用する。
+
+_local = threading.local()
+
+
+def connect(path=DATABASE):
+    """チューニング済みの新しい接続を開く"""
+    conn = sqlite3.connect(path, timeout=30, cached_statements=DB_CACHED_STATEMENTS)
+    conn.row_factory = sqlite3.Row # カラム名でアクセスできるようにする
+    conn.execute('PRAGMA synchronous = NORMAL') # WALでは NORMAL でもコミット済みのデータは失われない
+    conn.execute(f'PRAGMA mmap_size = {int(DB_MMAP_SIZE)}')
+    conn.execute(f'PRAGMA cache_size = {-int(DB_CACHE_SIZE_KB)}') # 負の値はKB単位
+    conn.execute('PRAGMA temp_store = MEMORY')
+    return conn
+
+
+def get_connection():
+    """
+    現在のスレッドの接続を返す（初回のみ開く）。
+    fork後の子プロセスでは親の接続を使わず、開き直す。
+    """
+    conn = getattr(_local, 'conn', None)
+    if conn is None or _local.pid != os.getpid():
+        conn = connect()
+        _local.conn = conn
+        _local.pid = os.getpid()
+    return conn
+
+
+def release_connection():
+    """リクエストの終了時に呼ぶ。接続は閉じず、コミットされていないトランザクションだけを戻す"""
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and _local.pid == os.getpid() and conn.in_transaction:
+        conn.rollback()
+
+
+def _create_mangas(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS mangas (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            hash TEXT UNIQUE,
+            url TEXT,
+            title TEXT,
+            file_ext TEXT
+        )
+    ''')
+
+
+def _index_title(conn):
+    # /manga_list の ORDER BY title をインデックスで処理する
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_mangas_title ON mangas (title)')
+
+
+def _create_fts(conn):
+    # タイトルとURLの全文検索（外部コンテンツ型のFTS5。mangas の変更はトリガーで反映する）
+    # trigram は空白で区切られない日本語のタイトルでも部分一致できる
+    try:
+        conn.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS mangas_fts USING fts5(
+                title, url, content='mangas', content_rowid='id', tokenize='trigram'
+            )
+        """)
+    except sqlite3.OperationalError as e:
+        logging.warning(f"FTS5（trigram）が使用できないため、検索はLIKEで行います: {e}")
+        return
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS mangas_fts_after_insert AFTER INSERT ON mangas
+        BEGIN
+            INSERT INTO mangas_fts (rowid, title, url) VALUES (NEW.id, NEW.title, NEW.url);
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS mangas_fts_after_delete AFTER DELETE ON mangas
+        BEGIN
+            INSERT INTO mangas_fts (mangas_fts, rowid, title, url) VALUES ('delete', OLD.id, OLD.title, OLD.url);
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS mangas_fts_after_update AFTER UPDATE OF title, url ON mangas
+        BEGIN
+            INSERT INTO mangas_fts (mangas_fts, rowid, title, url) VALUES ('delete', OLD.id, OLD.title, OLD.url);
+            INSERT INTO mangas_fts (rowid, title, url) VALUES (NEW.id, NEW.title, NEW.url);
+        END
+    """)
+    conn.execute("INSERT INTO mangas_fts (mangas_fts) VALUES ('rebuild')") # 既存の行を索引に登録する
+
+
+def _create_cache_index(conn):
+    import cache_index
+    cache_index.init_schema(conn)
+
+
+def _defer_fts(conn):
+    # 一括インポート中は mangas_fts_deferred に行を置き、トリガーによる1行ずつの索引更新を止める。
+    # インポートの最後に 'rebuild' で索引をまとめて作り直し、行を削除する（library.rebuild_fts）
+    conn.execute('CREATE TABLE IF NOT EXISTS mangas_fts_deferred (started_at REAL)')
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'mangas_fts'").fetchone() is None:
+        return
+    enabled = 'WHEN NOT EXISTS (SELECT 1 FROM mangas_fts_deferred)'
+    for name in ('insert', 'delete', 'update'):
+        conn.execute(f'DROP TRIGGER IF EXISTS mangas_fts_after_{name}')
+    conn.execute(f"""
+        CREATE TRIGGER mangas_fts_after_insert AFTER INSERT ON mangas {enabled}
+        BEGIN
+            INSERT INTO mangas_fts (rowid, title, url) VALUES (NEW.id, NEW.title, NEW.url);
+        END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER mangas_fts_after_delete AFTER DELETE ON mangas {enabled}
+        BEGIN
+            INSERT INTO mangas_fts (mangas_fts, rowid, title, url) VALUES ('delete', OLD.id, OLD.title, OLD.url);
+        END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER mangas_fts_after_update AFTER UPDATE OF title, url ON mangas {enabled}
+        BEGIN
+            INSERT INTO mangas_fts (mangas_fts, rowid, title, url) VALUES ('delete', OLD.id, OLD.title, OLD.url);
+            INSERT INTO mangas_fts (rowid, title, url) VALUES (NEW.id, NEW.title, NEW.url);
+        END
+    """)
+
+
+def _add_cache_access_stats(conn):
+    import cache_index
+    cache_index.add_access_stats(conn)
+
+
+def _create_metadata(conn):
+    import metadata
+    metadata.init_schema(conn)
+
+
+# (バージョン, 説明, 適用する関数)。追加のみ行い、既存の項目は変更しない
+MIGRATIONS = [
+    (1, 'mangas テーブル', _create_mangas),
+    (2, 'mangas.title のインデックス', _index_title),
+    (3, 'キャッシュインデックス', _create_cache_index),
+    (4, 'タイトルとURLの全文検索', _create_fts),
+    (5, '一括インポート中の全文検索の索引更新の保留', _defer_fts),
+    (6, 'キャッシュの削除ポリシー用の列とアーカイブ・画像ごとの合計', _add_cache_access_stats),
+    (7, '巻のメタデータ（ページ数・表紙のサムネイル）', _create_metadata),
+]
+
+
+def migrate(conn):
+    """未適用のマイグレーションを順に適用し、適用後のスキーマバージョンを返す"""
+    # WAL はデータベースファイルに記録されるため、一度設定すればすべての接続に効く
+    conn.execute('PRAGMA journal_mode = WAL')
+    current = conn.execute('PRAGMA user_version').fetchone()[0]
+    for version, description, apply in MIGRATIONS:
+        if version <= current:
+            continue
+        with conn:
+            apply(conn)
+            conn.execute(f'PRAGMA user_version = {version}')
+        logging.info(f"データベースを移行しました: v{version} {description}")
+        current = version
+    return current
@@ -0,0 +1,301 @@
+import os
+import json
+import time
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import http_client
+import metrics
+from config import (
+    MAX_DOWNLOAD_SIZE_MB,
+    DOWNLOAD_CHUNK_SIZE,
+    DOWNLOAD_SEGMENTS,
+    DOWNLOAD_SEGMENT_MIN_MB,
+    DOWNLOAD_RETRIES,
+    DOWNLOAD_STATE_SAVE_MB
+)
+
+# アーカイブのダウンロード
+# '<保存先>.part' に書き込み、接続が切れた場合は HTTP Range で続きから再開する。
+# サーバーが Range に対応していて十分に大きいファイルは、複数の区間に分けて並列にダウンロードする。
+# 区間ごとの受信済みバイト数は '<保存先>.part.json' に保存し、プロセスが終了しても続きから再開できるよう、
+# DOWNLOAD_STATE_SAVE_MB ごとに書き直す（保存するのは .part に書き込み済みのバイト数だけ）。
+# 応答の Content-Range が要求した位置から始まることを確認し、期待したバイト数に届かないまま接続が閉じられた場合は
+# （エラーにならずに正常に閉じられた場合も）通信エラーと同じく続きから再開する。
+# 完了後は期待したサイズであることを確認してから、保存先へアトミックに置き換える。
+# リクエストは http_client の共有セッションを通して送る（接続の再利用とホストごとの同時接続数の制限）。
+
+TIMEOUT = 120
+
+MB = 1024 * 1024
+DOWNLOAD_SECONDS = metrics.histogram('manga_download_seconds', 'アーカイブのダウンロードにかかった時間（秒）')
+DOWNLOAD_BYTES = metrics.histogram('manga_download_bytes', 'ダウンロードしたアーカイブのサイズ（バイト）',
+                                   buckets=tuple(n * MB for n in (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2000)))
+DOWNLOAD_FAILURES = metrics.counter('manga_download_failures_total', 'ダウンロードに失敗した回数')
+
+
+class IncompleteDownload(requests.exceptions.RequestException):
+    """期待したバイト数を受け取る前に応答が終わった（通信エラーとして扱い、続きから再開する）"""
+
+
+def download_file(url, save_path, progress=None):
+    """
+    指定されたURLからファイルをダウンロードする。
+    既にファイルが存在する場合はスキップする。
+    progress が指定された場合は progress(ダウンロード済みバイト数, 全体のバイト数) を呼び出す。
+    """
+    if os.path.exists(save_path):
+        logging.info(f"ファイルは既に存在します: {save_path}")
+        return
+
+    start = time.perf_counter()
+    try:
+        _download_with_retries(url, save_path, progress)
+    except Exception:
+        DOWNLOAD_FAILURES.inc()
+        raise
+    DOWNLOAD_SECONDS.observe(time.perf_counter() - start)
+    DOWNLOAD_BYTES.observe(os.path.getsize(save_path))
+
+
+def _download_with_retries(url, save_path, progress):
+    """通信エラーの場合は .part から続きを再開しながらダウンロードし、完了したら保存先に置き換える"""
+    part_path = save_path + '.part'
+    attempt = 0
+    while True:
+        try:
+            total = _download(url, part_path, progress)
+            break
+        except requests.exceptions.HTTPError as e:
+            # HTTPエラー応答は http_client 側で再試行済みのため、ここでは再開しない
+            logging.error(f"ファイルダウンロードエラー: {e} (URL: {url})", exc_info=True)
+            _remove_part(part_path)
+            raise
+        except requests.exceptions.RequestException as e:
+            # 通信エラーは .part を残したまま再試行し、続きから再開する
+            attempt += 1
+            if attempt > DOWNLOAD_RETRIES:
+                logging.error(f"ファイルダウンロードエラー: {e} (URL: {url})", exc_info=True)
+                raise
+            wait = 2 ** (attempt - 1)
+            logging.warning(f"ダウンロードが中断されました。{wait}秒後に再開します ({attempt}/{DOWNLOAD_RETRIES}): {e} (URL: {url})")
+            time.sleep(wait)
+        except Exception as e:
+            logging.error(f"ファイルダウンロード中の予期せぬエラー: {e} (URL: {url})", exc_info=True)
+            _remove_part(part_path)
+            raise
+
+    size = os.path.getsize(part_path)
+    if total is not None and size != total:
+        _remove_part(part_path)
+        logging.error(f"ダウンロードしたファイルのサイズが一致しません: {size} != {total} (URL: {url})")
+        raise Exception(f"ダウンロードしたファイルのサイズが一致しません ({size} / {total} バイト)。")
+
+    os.replace(part_path, save_path)
+    _remove_state(part_path)
+    logging.info(f"ファイルのダウンロードが完了しました: {url} -> {save_path}")
+    http_client.log_stats()
+
+
+def _remove_part(part_path):
+    if os.path.exists(part_path):
+        os.remove(part_path)
+    _remove_state(part_path)
+
+
+def _state_path(part_path):
+    return part_path + '.json'
+
+
+def _remove_state(part_path):
+    if os.path.exists(_state_path(part_path)):
+        os.remove(_state_path(part_path))
+
+
+def _load_state(part_path, url):
+    """分割ダウンロードの進捗を読み込む（別のURLのものや壊れたものは破棄する）"""
+    try:
+        with open(_state_path(part_path), encoding='utf-8') as f:
+            state = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    if state.get('url') != url or not os.path.exists(part_path):
+        _remove_state(part_path)
+        return None
+    return state
+
+
+def _save_state(part_path, state):
+    tmp_path = _state_path(part_path) + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, _state_path(part_path))
+
+
+def _check_size(total):
+    max_bytes = MAX_DOWNLOAD_SIZE_MB * 1024 * 1024
+    if total is not None and total > max_bytes:
+        raise Exception(f"ファイルサイズが{MAX_DOWNLOAD_SIZE_MB}MBを超過しました。")
+
+
+def _probe(url):
+    """HEAD リクエストで (全体のバイト数, Range対応の有無) を調べる。分からない場合は (None, False)"""
+    try:
+        with http_client.request('HEAD', url, timeout=TIMEOUT, allow_redirects=True) as r:
+            r.raise_for_status()
+            length = r.headers.get('Content-Length')
+            ranges_ok = r.headers.get('Accept-Ranges', '').lower() == 'bytes'
+    except requests.exceptions.RequestException:
+        return None, False
+    total = int(length) if length and length.isdigit() else None
+    return total, ranges_ok
+
+
+def _download(url, part_path, progress):
+    """
+    .part への書き込みを開始または再開し、期待される全体のバイト数（不明な場合は None）を返す。
+    """
+    state = _load_state(part_path, url)
+    if state is None and not os.path.exists(part_path):
+        total, ranges_ok = _probe(url)
+        _check_size(total)
+        if (ranges_ok and total and DOWNLOAD_SEGMENTS > 1
+                and total >= DOWNLOAD_SEGMENT_MIN_MB * 1024 * 1024):
+            state = _init_segments(url, part_path, total)
+    if state is not None:
+        return _download_segments(url, part_path, state, progress)
+    return _download_stream(url, part_path, progress)
+
+
+def content_range_total(r):
+    """Content-Range ヘッダー（'bytes 0-99/1234' / 'bytes */1234'）から全体のバイト数を取り出す"""
+    total = r.headers.get('Content-Range', '').rpartition('/')[2]
+    return int(total) if total.isdigit() else None
+
+
+def content_range(r):
+    """206 応答の Content-Range ヘッダー（'bytes 0-99/1234'）から (先頭, 末尾, 全体のバイト数) を取り出す"""
+    unit, _, spec = r.headers.get('Content-Range', '').partition(' ')
+    byte_range, _, total = spec.partition('/')
+    first, _, last = byte_range.partition('-')
+    if unit != 'bytes' or not first.isdigit() or not last.isdigit() or int(last) < int(first):
+        raise Exception(f"サーバーの Content-Range が正しくありません: {r.headers.get('Content-Range')!r}")
+    return int(first), int(last), int(total) if total.isdigit() else None
+
+
+def _download_stream(url, part_path, progress):
+    """1本の接続でダウンロードする。.part が既にあれば Range で続きから再開する"""
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = {'Range': f'bytes={offset}-'} if offset else {}
+
+    with http_client.request('GET', url, stream=True, headers=headers, timeout=TIMEOUT) as r:
+        if offset and r.status_code == 416:
+            # 既に最後までダウンロード済み
+            return content_range_total(r)
+        r.raise_for_status() # HTTPエラーが発生した場合に例外を発生させる
+
+        if r.status_code == 206:
+            first, _, total = content_range(r)
+            if first != offset:
+                raise Exception(f"サーバーが要求と異なる範囲を返しました: {first} バイト目から (要求: {offset} バイト目から)")
+            logging.info(f"ダウンロードを再開します: {offset} バイト目から (URL: {url})")
+        else:
+            # サーバーが Range に対応していない場合は最初からやり直す
+            offset = 0
+            length = r.headers.get('Content-Length')
+            total = int(length) if length and length.isdigit() else None
+        _check_size(total)
+
+        max_bytes = MAX_DOWNLOAD_SIZE_MB * 1024 * 1024
+        downloaded_size = offset
+        with open(part_path, 'ab' if offset else 'wb') as f:
+            for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                downloaded_size += len(chunk)
+                if downloaded_size > max_bytes:
+                    logging.error(f"ファイルサイズが制限を超過しました: {url}")
+                    raise Exception(f"ファイルサイズが{MAX_DOWNLOAD_SIZE_MB}MBを超過しました。")
+                f.write(chunk)
+                if progress:
+                    progress(downloaded_size, total or 0)
+    if total is not None and downloaded_size < total:
+        # 接続が途中で正常に閉じられた場合（urllib3 1.x は Content-Length より短い応答をエラーにしない）
+        raise IncompleteDownload(f"応答が途中で終わりました ({downloaded_size} / {total} バイト)")
+    return total
+
+
+def _init_segments(url, part_path, total):
+    """全体のサイズの .part を確保し、DOWNLOAD_SEGMENTS 個の区間に分割する"""
+    with open(part_path, 'wb') as f:
+        f.truncate(total)
+    step = -(-total // DOWNLOAD_SEGMENTS) # 切り上げ
+    state = {
+        'url': url,
+        'total': total,
+        'segments': [{'start': start, 'end': min(start + step, total) - 1, 'done': 0}
+                     for start in range(0, total, step)],
+    }
+    _save_state(part_path, state)
+    logging.info(f"{len(state['segments'])} 区間に分割してダウンロードします: {total} バイト (URL: {url})")
+    return state
+
+
+def _download_segments(url, part_path, state, progress):
+    """
+    各区間を並列にダウンロードし、.part の該当位置に書き込む。
+    進捗は中断に備えて、区間ごとに DOWNLOAD_STATE_SAVE_MB を受信するたびと、終了時に保存する。
+    """
+    lock = threading.Lock()
+    total = state['total']
+    save_every = DOWNLOAD_STATE_SAVE_MB * MB
+
+    def report():
+        if progress:
+            progress(sum(seg['done'] for seg in state['segments']), total)
+
+    def fetch(seg):
+        length = seg['end'] - seg['start'] + 1
+        saved = seg['done']
+        # サーバーは要求より短い範囲を返すことがあるため、区間の終わりまで要求を繰り返す
+        while seg['done'] < length:
+            offset = seg['start'] + seg['done']
+            headers = {'Range': f"bytes={offset}-{seg['end']}"}
+            with http_client.request('GET', url, stream=True, headers=headers, timeout=TIMEOUT) as r:
+                r.raise_for_status()
+                if r.status_code != 206:
+                    raise Exception("サーバーが分割ダウンロード（Range）に対応していません。")
+                first, last, range_total = content_range(r)
+                if first != offset or last > seg['end'] or range_total not in (None, total):
+                    raise Exception(f"サーバーが要求と異なる範囲を返しました: {r.headers.get('Content-Range')} (要求: {headers['Range']}/{total})")
+                received = 0
+                with open(part_path, 'r+b') as f:
+                    f.seek(offset)
+                    for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        chunk = chunk[:last - offset + 1 - received]
+                        f.write(chunk)
+                        f.flush() # 保存する進捗には、ファイルに書き込んだバイトだけを数える
+                        received += len(chunk)
+                        with lock:
+                            seg['done'] += len(chunk)
+                            report()
+                            if seg['done'] - saved >= save_every:
+                                _save_state(part_path, state)
+                                saved = seg['done']
+                        if received > last - offset:
+                            break
+            if received <= last - offset:
+                raise IncompleteDownload(f"区間の応答が途中で終わりました ({offset + received} / {last + 1} バイト目)")
+
+    try:
+        with ThreadPoolExecutor(max_workers=len(state['segments'])) as executor:
+            for future in [executor.submit(fetch, seg) for seg in state['segments']]:
+                future.result()
+    finally:
+        _save_state(part_path, state)
+    # .part は最初に全体のサイズで確保しているため、ファイルのサイズではなく各区間の受信済みバイト数で確認する
+    missing = [seg for seg in state['segments'] if seg['done'] != seg['end'] - seg['start'] + 1]
+    if missing:
+        raise IncompleteDownload(f"受信していない区間があります: {len(missing)} 区間")
+    return total
@@ -0,0 +1,142 @@
+import time
+
+# キャッシュの削除ポリシー
+# manage_cache_size は、予算を超えたときに policy.order_by の順（先頭ほど先に削除）で巻を削除する。
+# 各ポリシーは cache_index の列（last_access, hits, clock, archive_size, extracted_size）に対する
+# SQLの式と、同じ順序を Python で計算する priority() の両方を持ち、シミュレーターでも同じ規則を使う。
+# hits は巻が開かれた回数（ダウンロードを始めた最初の1回を含む）、clock は GDSF の膨張値 L（最後に開かれた時点の値）。
+
+
+class EvictionPolicy:
+    name = ''
+    priority_sql = 'last_access' # 小さいほど先に削除する
+    inflates = False # 削除した巻の優先度をクロック（L）に反映するか（GDSF）
+
+    @property
+    def order_by(self):
+        # 優先度が同じ場合は、最後に開かれたのが古い順
+        return f'{self.priority_sql}, last_access'
+
+    def priority(self, entry):
+        """priority_sql と同じ値を、属性 last_access / hits / clock / size を持つ entry から計算する"""
+        raise NotImplementedError
+
+    def key(self, entry):
+        return self.priority(entry), entry.last_access
+
+
+class LRU(EvictionPolicy):
+    """最後に開かれたのが古い巻から削除する"""
+    name = 'lru'
+    priority_sql = 'last_access'
+
+    def priority(self, entry):
+        return entry.last_access
+
+
+class LFU(EvictionPolicy):
+    """開かれた回数が少ない巻から削除する（同じ回数なら LRU）"""
+    name = 'lfu'
+    priority_sql = 'hits'
+
+    def priority(self, entry):
+        return entry.hits
+
+
+class GDSF(EvictionPolicy):
+    """
+    GreedyDual-Size-Frequency: 優先度 H = L + (回数 + 1) / サイズ が小さい巻から削除する。
+    回数は巻が開かれた回数で、プリフェッチしてまだ開かれていない巻は 0 のため1を足す
+    （足さないと、未読の巻はサイズに関係なくすべて H = L になる）。
+    大きくてあまり開かれない巻ほど先に削除され、削除した巻の H で L が上がるため、
+    長い間開かれていない巻も最終的には削除される。
+    """
+    name = 'gdsf'
+    priority_sql = 'clock + (hits + 1) * 1048576.0 / MAX(archive_size + extracted_size, 1)'
+    inflates = True
+
+    def priority(self, entry):
+        return entry.clock + (entry.hits + 1) * 1048576.0 / max(entry.size, 1)
+
+
+POLICIES = {policy.name: policy for policy in (LRU(), LFU(), GDSF())}
+
+
+def get_policy(name):
+    try:
+        return POLICIES[name]
+    except KeyError:
+        raise ValueError(f"不明なキャッシュ削除ポリシーです: {name}（{', '.join(POLICIES)} のいずれか）")
+
+
+# --- アクセスの記録と再生（シミュレーター） ---
+
+def append_trace(path, manga_hash, size):
+    """巻が開かれたことを '時刻<TAB>ハッシュ<TAB>サイズ' の1行としてアクセスログに追記する"""
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(f'{time.time():.3f}\t{manga_hash}\t{size}\n')
+
+
+def read_trace(path, default_size=0):
+    """
+    アクセスログを [(ハッシュ, サイズ)] として読み込む。
+    初めて開かれた時点ではサイズが分からない（ダウンロード前）ため、同じ巻の最大のサイズを使う。
+    一度もサイズが記録されていない巻は default_size とする。
+    """
+    accesses = []
+    sizes = {}
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) != 3:
+                continue
+            manga_hash, size = parts[1], int(parts[2])
+            accesses.append(manga_hash)
+            sizes[manga_hash] = max(sizes.get(manga_hash, 0), size)
+    return [(h, sizes[h] or default_size) for h in accesses]
+
+
+class _Entry:
+    __slots__ = ('size', 'hits', 'clock', 'last_access')
+
+    def __init__(self, size, clock, last_access):
+        self.size = size
+        self.hits = 0
+        self.clock = clock
+        self.last_access = last_access
+
+
+def simulate(trace, policy, capacity):
+    """
+    アクセスの列 [(ハッシュ, サイズ)] を容量 capacity バイトのキャッシュで再生し、
+    {'requests', 'hits', 'hit_ratio', 'bytes_fetched'} を返す。
+    manage_cache_size と同じく、開いた巻は削除せず、それ以外をポリシーの順に削除する。
+    """
+    entries = {}
+    used = 0
+    clock = 0.0
+    hits = 0
+    bytes_fetched = 0
+    for t, (manga_hash, size) in enumerate(trace):
+        entry = entries.get(manga_hash)
+        if entry is None:
+            bytes_fetched += size
+            entry = entries[manga_hash] = _Entry(size, clock, t)
+            used += size
+        else:
+            hits += 1
+            entry.clock = clock
+        entry.hits += 1 # touch(hit=True) と同じく、最初に開いた回も数える
+        entry.last_access = t
+        while used > capacity and len(entries) > 1:
+            victim_hash, victim = min(((h, e) for h, e in entries.items() if h != manga_hash), key=lambda item: policy.key(item[1]))
+            if policy.inflates:
+                clock = max(clock, policy.priority(victim))
+            used -= victim.size
+            del entries[victim_hash]
+    return {
+        'requests': len(trace),
+        'hits': hits,
+        'hit_ratio': round(hits / len(trace), 4) if trace else 0,
+        'bytes_fetched': bytes_fetched,
+    }
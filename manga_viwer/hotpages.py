@@ -0,0 +1,60 @@
+import threading
+from collections import OrderedDict
+
+# ホットページ
+# 最近配信したページの場所（ページのファイル、またはページパック内の範囲。pagepack.PageLocation）を保持し、
+# 2回目以降はパスの検証、ファイルの有無の確認、パックの索引の参照をせずに返す。
+# 内容は保持せず、配信は send_file と同じく wsgi.file_wrapper を通すため、gunicorn では os.sendfile で送信する。
+# キーには ETag（アーカイブのバージョンと変換設定から決まる）を含めるため、巻が作り直されると別のキーになる。
+# ファイルが削除されたか、パックが作り直された場合は、開くときに分かるため、呼び出し側が discard() で外す。
+# 状態はプロセスごとに持つ。
+
+
+class HotPages:
+    """(パス, バリアント, 形式, ETag) からページの場所へのLRU"""
+
+    def __init__(self, size):
+        self._size = size
+        self._pages = OrderedDict() # {キー: PageLocation}
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0}
+
+    @property
+    def enabled(self):
+        return self._size > 0
+
+    def get(self, key):
+        """保持しているページの場所（ない場合は None）"""
+        with self._lock:
+            location = self._pages.get(key)
+            if location is None:
+                self.stats['misses'] += 1
+                return None
+            self._pages.move_to_end(key)
+            self.stats['hits'] += 1
+            return location
+
+    def put(self, key, location):
+        """ページの場所を保持する"""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._pages[key] = location
+            self._pages.move_to_end(key)
+            while len(self._pages) > self._size:
+                self._pages.popitem(last=False)
+
+    def discard(self, key):
+        """開けなくなったページを外す"""
+        with self._lock:
+            self._pages.pop(key, None)
+
+    def invalidate(self, prefix):
+        """パスが prefix で始まるページを外す（キャッシュ削除時）"""
+        with self._lock:
+            for key in [key for key in self._pages if key[0].startswith(prefix)]:
+                del self._pages[key]
+
+    def clear(self):
+        with self._lock:
+            self._pages.clear()
@@ -0,0 +1,103 @@
+import threading
+import logging
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from config import HTTP_POOL_SIZE, HTTP_MAX_PER_HOST, HTTP_RETRIES, HTTP_BACKOFF
+
+# 共有HTTPクライアント
+# プロセス全体で1つの requests.Session を使い、同じホストへの接続（TLSハンドシェイク）を再利用する。
+# ホストごとの同時リクエスト数を HTTP_MAX_PER_HOST に制限し、
+# 接続エラーや 429/5xx 応答は指数バックオフで再試行する（Retry-After ヘッダーを尊重する）。
+
+HEADERS = {'User-Agent': 'MangaViewer/1.0'}
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+_session = None
+_session_lock = threading.Lock()
+_host_slots = {} # {ホスト: BoundedSemaphore}
+_host_slots_lock = threading.Lock()
+
+
+def get_session():
+    """プロセス共通のセッションを返す（初回呼び出し時に作成する）"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            retry = Retry(
+                total=HTTP_RETRIES,
+                backoff_factor=HTTP_BACKOFF,
+                status_forcelist=RETRY_STATUSES,
+                allowed_methods=frozenset(['HEAD', 'GET']),
+                respect_retry_after_header=True,
+                raise_on_status=False, # 再試行しても失敗した応答は raise_for_status() で扱う
+            )
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+            session = requests.Session()
+            session.headers.update(HEADERS)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+        return _session
+
+
+def _host_slot(url):
+    host = urlparse(url).netloc.lower()
+    with _host_slots_lock:
+        slot = _host_slots.get(host)
+        if slot is None:
+            slot = _host_slots[host] = threading.BoundedSemaphore(HTTP_MAX_PER_HOST)
+        return slot
+
+
+@contextmanager
+def request(method, url, **kwargs):
+    """
+    共有セッションでリクエストを送り、応答を返すコンテキストマネージャー。
+    ホストごとの同時リクエスト数を制限するため、ストリーミングの本文を読み終えるまで枠を保持する。
+    """
+    slot = _host_slot(url)
+    slot.acquire()
+    try:
+        with get_session().request(method, url, **kwargs) as r:
+            yield r
+    finally:
+        slot.release()
+
+
+def stats():
+    """
+    接続プールの統計を返す。
+    requests は送信したリクエスト数、connections は新たに確立した接続数で、
+    その差が再利用された接続の数になる。
+    """
+    hosts = {}
+    with _session_lock:
+        session = _session
+    if session is not None:
+        for adapter in set(session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                item = hosts.setdefault(f'{pool.scheme}://{pool.host}:{pool.port}', {'requests': 0, 'connections': 0})
+                item['requests'] += pool.num_requests
+                item['connections'] += pool.num_connections
+    total_requests = sum(h['requests'] for h in hosts.values())
+    total_connections = sum(h['connections'] for h in hosts.values())
+    return {
+        'requests': total_requests,
+        'connections': total_connections,
+        'reused': total_requests - total_connections,
+        'hosts': hosts,
+    }
+
+
+def log_stats():
+    s = stats()
+    logging.info(f"HTTP接続: リクエスト {s['requests']} 件, 新規接続 {s['connections']} 件, 再利用 {s['reused']} 件")
@@ -0,0 +1,140 @@
+import time
+import queue
+import threading
+import logging
+
+# バックグラウンドジョブ
+# ダウンロードと解凍をリクエスト処理から切り離し、ワーカースレッドで実行する。
+# ジョブIDはマンガのハッシュで、同じハッシュへの重複リクエストは既存のジョブにまとめられる。
+
+
+class JobQueueFull(Exception):
+    """ジョブキューが満杯で新しいジョブを受け付けられない"""
+
+
+class Job:
+    """1つのマンガのダウンロード/解凍ジョブと、その進捗"""
+
+    def __init__(self, job_id):
+        self.id = job_id
+        self.state = 'queued' # queued -> downloading -> extracting -> done / error
+        self.bytes_downloaded = 0
+        self.total_bytes = 0
+        self.pages_done = 0
+        self.total_pages = 0
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.phase_started = None
+        self.finished = None
+        self._lock = threading.Lock()
+
+    @property
+    def active(self):
+        return self.finished is None
+
+    def set_state(self, state):
+        with self._lock:
+            self.state = state
+            self.phase_started = time.time()
+
+    def download_progress(self, downloaded, total):
+        """download_file から呼ばれる進捗コールバック"""
+        with self._lock:
+            self.bytes_downloaded = downloaded
+            self.total_bytes = total or 0
+
+    def extract_progress(self, done, total):
+        """extract_zip / extract_rar から呼ばれる進捗コールバック"""
+        with self._lock:
+            self.pages_done = done
+            self.total_pages = total
+
+    def eta(self):
+        """現在のフェーズの残り時間（秒）を推定する。推定できない場合は None"""
+        if self.phase_started is None:
+            return None
+        elapsed = time.time() - self.phase_started
+        if self.state == 'downloading' and self.total_bytes and self.bytes_downloaded:
+            return elapsed * (self.total_bytes - self.bytes_downloaded) / self.bytes_downloaded
+        if self.state == 'extracting' and self.total_pages and self.pages_done:
+            return elapsed * (self.total_pages - self.pages_done) / self.pages_done
+        return None
+
+    def to_dict(self):
+        with self._lock:
+            data = {
+                'job_id': self.id,
+                'state': self.state,
+                'bytes_downloaded': self.bytes_downloaded,
+                'total_bytes': self.total_bytes,
+                'pages_done': self.pages_done,
+                'total_pages': self.total_pages,
+                'error': self.error,
+            }
+        eta = self.eta()
+        data['eta_seconds'] = round(eta, 1) if eta is not None else None
+        return data
+
+
+class JobQueue:
+    """上限付きキューとワーカースレッドのプール"""
+
+    def __init__(self, workers, max_queue, result_ttl=600):
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._jobs = {} # {job_id: Job}
+        self._lock = threading.Lock()
+        self._result_ttl = result_ttl
+        for i in range(workers):
+            threading.Thread(target=self._worker, name=f'manga-job-{i}', daemon=True).start()
+
+    def submit(self, job_id, func):
+        """
+        ジョブを登録する。同じIDのジョブが実行中なら、それを返す（重複リクエストの統合）。
+        func(job) はワーカースレッドで実行される。
+        キューが満杯の場合は JobQueueFull を送出する。
+        """
+        with self._lock:
+            self._prune()
+            job = self._jobs.get(job_id)
+            if job is not None and job.active:
+                return job
+            job = Job(job_id)
+            try:
+                self._queue.put_nowait((job, func))
+            except queue.Full:
+                raise JobQueueFull(f"ジョブキューが満杯です: {job_id}")
+            self._jobs[job_id] = job
+            logging.info(f"ジョブを登録しました: {job_id}")
+            return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def active_ids(self):
+        """待機中または実行中のジョブのID"""
+        with self._lock:
+            return {job_id for job_id, job in self._jobs.items() if job.active}
+
+    def _prune(self):
+        """終了から一定時間経過したジョブを破棄する"""
+        now = time.time()
+        for job_id in [j for j, job in self._jobs.items() if job.finished and now - job.finished > self._result_ttl]:
+            del self._jobs[job_id]
+
+    def _worker(self):
+        while True:
+            job, func = self._queue.get()
+            job.started = time.time()
+            try:
+                func(job)
+                job.set_state('done')
+                logging.info(f"ジョブが完了しました: {job.id} ({time.time() - job.started:.1f}秒)")
+            except Exception as e:
+                job.error = str(e)
+                job.set_state('error')
+                logging.error(f"ジョブが失敗しました: {job.id} - {e}", exc_info=True)
+            finally:
+                job.finished = time.time()
+                self._queue.task_done()
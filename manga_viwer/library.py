@@ -0,0 +1,252 @@
+import os
+import re
+import time
+import hashlib
+import logging
+from urllib.parse import urlparse, unquote
+
+from config import LIBRARY_PAGE_SIZE, ALLOWED_DOMAINS
+
+# マンガライブラリの一覧と検索
+# 一覧はタイトル順のキーセットページング（(title, id) より後ろの行を LIMIT 件）で返すため、
+# ライブラリの件数やページの位置によらず、title インデックスを必要な分だけ読む。
+# 検索は mangas_fts（FTS5 trigram）でタイトルとURLを部分一致検索し、追加順（id）でページングする。
+# URLからハッシュ・タイトル・拡張子を求める規則と登録処理は、/add と一括インポートで共有する。
+
+FTS_TABLE = 'mangas_fts'
+FTS_MIN_TERM = 3 # trigram は3文字未満の語を検索できないため、短い語は LIKE で絞り込む
+FTS_AUTOMERGE = 4 # FTS5 の automerge の既定値（作り直しの後に戻す）
+COLUMNS = 'm.id, m.hash, m.url, m.title, m.file_ext'
+
+SUPPORTED_EXTS = ['zip', 'cbz', 'rar', 'cbr']
+INVALID_TITLE_CHARS = re.compile(r'[\\/:\*?"<>|]')
+
+UPSERT_SQL = '''
+    INSERT INTO mangas (hash, url, title, file_ext) VALUES (?, ?, ?, ?)
+    ON CONFLICT (hash) DO UPDATE SET title = excluded.title, file_ext = excluded.file_ext
+    WHERE title IS NOT excluded.title OR file_ext IS NOT excluded.file_ext
+'''
+
+
+def is_valid_url(url, parsed=None):
+    """
+    URLが有効で、許可されたドメインに属するかどうかを検証する。
+    parsed に urlparse(url) の結果を渡すと、解析し直さずに使う。
+    """
+    try:
+        result = parsed or urlparse(url)
+        # スキームがHTTP/HTTPSであり、ネットロケーションが存在するか
+        if not all([result.scheme in ['http', 'https'], result.netloc]):
+            logging.warning(f"無効なURLスキームまたはネットロケーション: {url}")
+            return False
+
+        domain = result.netloc
+        # 許可されたドメインリストが設定されており、ドメインがリストにない場合
+        if ALLOWED_DOMAINS and domain not in ALLOWED_DOMAINS:
+            logging.warning(f"許可されていないドメインからのURL: {url} (ドメイン: {domain})")
+            return False
+        return True
+    except Exception as e:
+        logging.error(f"URL検証エラー: {e} (URL: {url})", exc_info=True)
+        return False
+
+
+def derive_entry(url, parsed=None):
+    """
+    URLから (ハッシュ, タイトル, 拡張子) を求める。
+    ハッシュはURLのMD5で、キャッシュのファイル名にも使われる。
+    parsed に urlparse(url) の結果を渡すと、解析し直さずに使う。
+    """
+    # URLから一意のハッシュを生成
+    manga_hash = hashlib.md5(url.encode()).hexdigest()
+
+    # ファイル名と拡張子を安全に抽出
+    # werkzeug.utils.secure_filename を使用するのがより堅牢ですが、
+    # ここでは basename と splitext で簡単なサニタイズを行います。
+    # 完全にパストラバーサルを防ぐには、外部からのファイル名を信用しないことが重要です。
+    title_raw = os.path.splitext(os.path.basename(unquote((parsed or urlparse(url)).path)))[0]
+    # タイトルからパス区切り文字や無効な文字を削除
+    title = INVALID_TITLE_CHARS.sub('', title_raw)
+    if not title: # タイトルが空になる場合に対応
+        title = manga_hash[:8] # ハッシュの一部をタイトルとして使用
+
+    ext = os.path.splitext(url)[1][1:].lower() # 拡張子から'.'を除去
+    return manga_hash, title, ext
+
+
+def parse_entry(url):
+    """
+    is_valid_url と derive_entry をURLの解析1回で行う（一括登録用）。
+    有効なURLなら (ハッシュ, タイトル, 拡張子)、無効なら None を返す。
+    """
+    try:
+        parsed = urlparse(url)
+    except ValueError as e:
+        logging.warning(f"無効なURL: {url} ({e})")
+        return None
+    if not is_valid_url(url, parsed):
+        return None
+    return derive_entry(url, parsed)
+
+
+def upsert_mangas(conn, entries):
+    """
+    (ハッシュ, URL, タイトル, 拡張子) のリストを mangas にまとめて登録する（コミットは呼び出し側で行う）。
+    既存のハッシュはタイトルと拡張子が変わった場合のみ更新する（全文検索の索引を無駄に更新しない）。
+    追加または更新した行数を返す（変更のない既存の行は数えない）。
+    """
+    return conn.executemany(UPSERT_SQL, entries).rowcount
+
+
+def add_batch(conn, urls):
+    """
+    URLのリストを検証して、新しいものだけを1つのトランザクションで mangas に追加する。
+    URLごとに {'url', 'status', 'hash', 'title', 'ext'} を入力と同じ順で返す。
+    status は added / exists（登録済み）/ duplicate（リスト内で重複）/ invalid / unsupported のいずれか。
+    """
+    results = []
+    seen = {}
+    for url in urls:
+        url = (url or '').strip()
+        result = {'url': url, 'status': 'invalid', 'hash': None, 'title': None, 'ext': None}
+        results.append(result)
+        entry = parse_entry(url) if url else None
+        if entry is None:
+            continue
+        manga_hash, title, ext = entry
+        result.update(hash=manga_hash, title=title, ext=ext)
+        if ext not in SUPPORTED_EXTS:
+            result['status'] = 'unsupported'
+        elif manga_hash in seen:
+            result['status'] = 'duplicate'
+        else:
+            result['status'] = 'added'
+            seen[manga_hash] = result
+
+    hashes = list(seen)
+    with conn:
+        # 登録済みのハッシュを IN でまとめて調べる（SQLite の変数の上限を超えないよう分割）
+        for i in range(0, len(hashes), 500):
+            chunk = hashes[i:i + 500]
+            placeholders = ','.join('?' * len(chunk))
+            for row in conn.execute(f'SELECT hash FROM mangas WHERE hash IN ({placeholders})', chunk):
+                seen.pop(row['hash'])['status'] = 'exists'
+        conn.executemany('INSERT INTO mangas (hash, url, title, file_ext) VALUES (?, ?, ?, ?) ON CONFLICT (hash) DO NOTHING',
+                         [(r['hash'], r['url'], r['title'], r['ext']) for r in seen.values()])
+    return results
+
+
+def _natural_key(title):
+    """'第2巻' が '第10巻' より前に来るよう、数字の部分を数値として比較するキー"""
+    return [(0, int(part), '') if part.isdigit() else (1, 0, part.lower()) for part in re.split(r'(\d+)', title)]
+
+
+def next_volume(conn, manga_hash):
+    """
+    同じシリーズの次の巻を返す（見つからない場合は None）。
+    URLのディレクトリが同じ巻をシリーズとみなし、タイトルの自然順（数字は数値として比較）で並べる。
+    """
+    row = conn.execute('SELECT url, title FROM mangas WHERE hash = ?', (manga_hash,)).fetchone()
+    if row is None or '/' not in row['url']:
+        return None
+    prefix = row['url'].rsplit('/', 1)[0] + '/'
+    siblings = [r for r in conn.execute(
+        f"SELECT {COLUMNS} FROM mangas m WHERE m.url LIKE ? ESCAPE '\\'", (_like_pattern(prefix)[1:],)
+    ) if '/' not in r['url'][len(prefix):]]
+    current = (_natural_key(row['title']), row['url'])
+    later = [r for r in siblings if (_natural_key(r['title']), r['url']) > current]
+    return min(later, key=lambda r: (_natural_key(r['title']), r['url']), default=None)
+
+
+def has_fts(conn):
+    """全文検索のテーブルがあるかどうか（FTS5 が使えない SQLite ではマイグレーションで作成されない）"""
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (FTS_TABLE,)).fetchone() is not None
+
+
+def defer_fts(conn):
+    """
+    全文検索の索引の更新を保留する（一括インポートの開始時に呼ぶ）。
+    保留中の行の追加・変更はトリガーで索引に反映されず、rebuild_fts でまとめて反映する。
+    """
+    if has_fts(conn):
+        with conn:
+            conn.execute('INSERT INTO mangas_fts_deferred (started_at) VALUES (?)', (time.time(),))
+
+
+def fts_deferred(conn):
+    """索引の更新が保留されたままかどうか（インポートが途中で終了した場合も含む）"""
+    return conn.execute('SELECT 1 FROM mangas_fts_deferred LIMIT 1').fetchone() is not None
+
+
+def rebuild_fts(conn):
+    """
+    全文検索の索引を mangas から作り直し、更新の保留を解除する。
+    作り直しの途中ではセグメントを統合せず（automerge 0）、最後に 'optimize' で1回だけ統合する。
+    書き込みのたびに統合を繰り返すより速く（100万行で約3割）、索引も1つのセグメントになる。
+    """
+    if not has_fts(conn):
+        return
+    with conn:
+        conn.execute(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}, rank) VALUES ('automerge', 0)")
+        conn.execute(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('rebuild')")
+        conn.execute(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('optimize')")
+        conn.execute(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}, rank) VALUES ('automerge', ?)", (FTS_AUTOMERGE,))
+        conn.execute('DELETE FROM mangas_fts_deferred')
+
+
+def _like_pattern(term):
+    return '%' + re.sub(r'([\\%_])', r'\\\1', term) + '%'
+
+
+def list_page(conn, after_title=None, after_id=None, limit=LIBRARY_PAGE_SIZE):
+    """
+    タイトル順の一覧を1ページ分返す。
+    (行のリスト, 次のページのカーソル {'after_title', 'after_id'} または None) を返す。
+    """
+    if after_id is None:
+        rows = conn.execute(f'SELECT {COLUMNS} FROM mangas m ORDER BY m.title, m.id LIMIT ?', (limit + 1,)).fetchall()
+    else:
+        rows = conn.execute(f'''
+            SELECT {COLUMNS} FROM mangas m
+            WHERE (m.title, m.id) > (?, ?)
+            ORDER BY m.title, m.id LIMIT ?
+        ''', (after_title or '', after_id, limit + 1)).fetchall()
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, {'after_title': rows[-1]['title'], 'after_id': rows[-1]['id']}
+
+
+def search_page(conn, query, after_id=None, limit=LIBRARY_PAGE_SIZE):
+    """
+    タイトルとURLをスペース区切りの語ですべて含む行を、追加順に1ページ分返す。
+    (行のリスト, 次のページのカーソル {'after_id'} または None) を返す。
+    """
+    terms = query.split()
+    where = []
+    params = []
+    fts_terms = [t for t in terms if len(t) >= FTS_MIN_TERM] if has_fts(conn) else []
+    if fts_terms:
+        # FTS5 の索引を rowid 順に読み、必要な件数に達した時点で止める（一致件数によらず速い）
+        sql = f'SELECT {COLUMNS} FROM {FTS_TABLE} f JOIN mangas m ON m.id = f.rowid'
+        # 各語をフレーズとして引用し、FTS5 の演算子として解釈されないようにする
+        where.append(f'{FTS_TABLE} MATCH ?')
+        params.append(' AND '.join('"' + t.replace('"', '""') + '"' for t in fts_terms))
+        order = 'f.rowid'
+    else:
+        sql = f'SELECT {COLUMNS} FROM mangas m'
+        order = 'm.id'
+    for term in terms:
+        if term not in fts_terms:
+            where.append("(m.title LIKE ? ESCAPE '\\' OR m.url LIKE ? ESCAPE '\\')")
+            params += [_like_pattern(term)] * 2
+    if after_id is not None:
+        where.append(f'{order} > ?')
+        params.append(after_id)
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    rows = conn.execute(f'{sql} ORDER BY {order} LIMIT ?', params + [limit + 1]).fetchall()
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, {'after_id': rows[-1]['id']}
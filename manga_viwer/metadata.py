@@ -0,0 +1,258 @@
+import io
+import os
+import time
+import zipfile
+import logging
+
+from PIL import Image
+
+import http_client
+from archive import zip_image_members, rar_image_members, read_member, MemberTooLarge
+from downloader import content_range_total, TIMEOUT
+from converter import check_pixels, open_source
+from config import COVER_SIZE, COVER_QUALITY, COVER_MAX_MB, METADATA_BLOCK_KB, METADATA_RETRY_AFTER
+
+# 巻のメタデータ（ページ数・表紙の寸法・アーカイブのサイズ・表紙のサムネイル）
+# ライブラリの一覧で表紙を表示するため、巻ごとに一度だけ生成して manga_metadata に保存する。
+# アーカイブ全体は読まず、先頭の画像メンバーだけを読む。
+# ダウンロード前のZIP/CBZは HTTP Range でセントラルディレクトリと先頭のメンバーの範囲だけを取得する
+# （通常は2回のリクエストで済む）。RAR/CBR は unrar がファイルを必要とするため、ダウンロード後に生成する。
+# 生成に失敗した巻は error を記録し、METADATA_RETRY_AFTER 秒が経つまで再試行しない。
+# メンバーのサイズはアーカイブ（URLの先）が決めるため、先頭ページが COVER_MAX_MB を超える巻は表紙なしにし、
+# 先頭ページはバイト列に読み込まずにストリームでデコードする。Range で取得する合計も COVER_MAX_MB の2倍までにする。
+
+COVER_MAX_BYTES = COVER_MAX_MB * 1024 * 1024
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS manga_metadata (
+        hash TEXT PRIMARY KEY,
+        page_count INTEGER,
+        cover_width INTEGER,
+        cover_height INTEGER,
+        archive_size INTEGER,
+        cover BLOB,
+        error TEXT,
+        updated_at REAL NOT NULL
+    );
+    CREATE TRIGGER IF NOT EXISTS manga_metadata_after_manga_delete AFTER DELETE ON mangas
+    BEGIN
+        DELETE FROM manga_metadata WHERE hash = OLD.hash;
+    END;
+'''
+
+COVER_MIME = 'image/jpeg'
+# 一覧の描画に使う列（表紙の画像は /cover で別に読む）
+SUMMARY_COLUMNS = 'hash, page_count, cover_width, cover_height, archive_size, cover IS NOT NULL AS has_cover, error, updated_at'
+
+
+class RangeNotSupported(Exception):
+    """サーバーが Range リクエストに対応していない"""
+
+
+def init_schema(conn):
+    """メタデータのテーブルと、巻の削除に合わせて行を消すトリガーを作成する"""
+    conn.executescript(SCHEMA)
+
+
+class RemoteFile(io.RawIOBase):
+    """
+    HTTP Range で必要な範囲だけを読み出す、読み取り専用のシーク可能なファイル。
+    zipfile に渡してセントラルディレクトリとメンバーを読むために使う。
+    取得した範囲はメモリに保持し、少なくとも block バイトずつ取得して小さな読み出しのたびにリクエストしない。
+    取得した合計が max_bytes を超える読み出しは ValueError にする（メモリに保持する量の上限）。
+    """
+
+    def __init__(self, url, block=METADATA_BLOCK_KB * 1024, max_bytes=COVER_MAX_BYTES * 2):
+        self.url = url
+        self.block = block
+        self.max_bytes = max_bytes
+        self.fetched = 0
+        self.requests = 0
+        self._ranges = [] # [(開始位置, バイト列)]
+        self._pos = 0
+        # 末尾のブロックを取得して全体のサイズを知る（ZIPの終端レコードとセントラルディレクトリはここにある）
+        with self._get(f'bytes=-{block}') as r:
+            r.raise_for_status()
+            if r.status_code == 206:
+                self.size = content_range_total(r)
+            else:
+                # Range に対応していないサーバーでも、ブロックより小さいファイルならそのまま使う
+                length = r.headers.get('Content-Length')
+                if not (length and length.isdigit() and int(length) <= block):
+                    raise RangeNotSupported(f"サーバーが Range に対応していません: {url}")
+                self.size = int(length)
+            data = self._read_body(r, block)
+        if self.size is None:
+            raise RangeNotSupported(f"Content-Range から全体のサイズが分かりません: {url}")
+        self._ranges.append((self.size - len(data), data))
+
+    def _get(self, byte_range):
+        self.requests += 1
+        return http_client.request('GET', self.url, headers={'Range': byte_range}, stream=True, timeout=TIMEOUT)
+
+    def _read_body(self, r, length):
+        """応答の本文を最大 length バイトまで読む（要求した範囲より長い本文は読まない）"""
+        data = bytearray()
+        for chunk in r.iter_content(METADATA_BLOCK_KB * 1024):
+            data += chunk[:length - len(data)]
+            if len(data) >= length:
+                break
+        self.fetched += len(data)
+        return bytes(data)
+
+    def _read_range(self, start, end):
+        for offset, data in self._ranges:
+            if offset <= start and end <= offset + len(data):
+                return data[start - offset:end - offset]
+        fetch_end = min(max(end, start + self.block), self.size)
+        if self.fetched + fetch_end - start > self.max_bytes:
+            raise ValueError(f"メタデータの生成で取得するサイズが上限（{self.max_bytes} バイト）を超えます: {self.url}")
+        with self._get(f'bytes={start}-{fetch_end - 1}') as r:
+            r.raise_for_status()
+            if r.status_code != 206:
+                raise RangeNotSupported(f"サーバーが Range に対応していません: {self.url}")
+            data = self._read_body(r, fetch_end - start)
+        self._ranges.append((start, data))
+        return data[:end - start]
+
+    def preload(self, start, end):
+        """これから読む範囲 [start, end) を1回のリクエストでまとめて取得しておく"""
+        start, end = max(start, 0), min(end, self.size)
+        if start < end:
+            self._read_range(start, end)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise OSError(f"負の位置にはシークできません: {offset}") # zipfile は OSError を前提にする
+        self._pos = offset
+        return self._pos
+
+    def readinto(self, b):
+        end = min(self._pos + len(b), self.size)
+        if end <= self._pos:
+            return 0
+        data = self._read_range(self._pos, end)
+        b[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+
+def make_cover(source):
+    """
+    先頭ページの画像（バイト列、または開いたファイルオブジェクト）から (幅, 高さ, サムネイルのJPEG) を返す。
+    JPEG は draft で縮小しながらデコードし、元の大きさの画像を展開しない（それ以外は PAGE_MAX_PIXELS まで）。
+    """
+    with open_source(source) as fp, Image.open(fp) as img:
+        width, height = img.size
+        img.draft('RGB', (COVER_SIZE[0] * 2, COVER_SIZE[1] * 2))
+        check_pixels(img)
+        img = img.convert('RGB')
+        img.thumbnail(COVER_SIZE)
+        buf = io.BytesIO()
+        img.save(buf, 'JPEG', quality=COVER_QUALITY, optimize=True)
+    return width, height, buf.getvalue()
+
+
+def _zip_metadata(fileobj, preload=None):
+    """(ページ数, make_cover の結果) を返す。ページがないか、先頭ページが COVER_MAX_MB を超える場合、表紙は None"""
+    with zipfile.ZipFile(fileobj) as zip_ref:
+        members = zip_image_members(zip_ref)
+        if not members:
+            return 0, None
+        info = zip_ref.getinfo(members[0][1])
+        if max(info.compress_size, info.file_size) > COVER_MAX_BYTES:
+            logging.warning(f"先頭ページが大きすぎるため、表紙を生成しません: {info.filename} ({info.file_size} バイト)")
+            return len(members), None
+        if preload:
+            # ローカルヘッダー（30バイト + 名前 + 拡張フィールド）とデータをまとめて取得する
+            preload(info.header_offset, info.header_offset + 30 + len(info.orig_filename.encode()) + 1024 + info.compress_size)
+        with zip_ref.open(info) as fp:
+            return len(members), make_cover(fp)
+
+
+def generate(url, ext, archive_path=None):
+    """
+    巻のメタデータを生成して返す。archive_path（ダウンロード済みのアーカイブ）があればそれを読み、
+    なければ url から Range で必要な範囲だけを取得する（ZIP/CBZのみ）。
+    ページのない巻は表紙を None とする。
+    """
+    remote = None
+    if archive_path is not None:
+        size = os.path.getsize(archive_path)
+        if ext in ['zip', 'cbz']:
+            page_count, cover = _zip_metadata(archive_path)
+        elif ext in ['rar', 'cbr']:
+            members = rar_image_members(archive_path)
+            page_count = len(members)
+            cover = None
+            if members:
+                try:
+                    cover = make_cover(read_member(archive_path, ext, members[0][1], limit=COVER_MAX_BYTES))
+                except MemberTooLarge as e:
+                    logging.warning(f"先頭ページが大きすぎるため、表紙を生成しません: {e}")
+        else:
+            raise ValueError(f"未対応のファイル形式です: {ext}")
+    elif ext in ['zip', 'cbz']:
+        remote = RemoteFile(url)
+        size = remote.size
+        page_count, cover = _zip_metadata(remote, remote.preload)
+    else:
+        raise RangeNotSupported(f"{ext.upper()} はダウンロード後にメタデータを生成します")
+
+    meta = {'page_count': page_count, 'archive_size': size, 'cover_width': None, 'cover_height': None, 'cover': None}
+    if cover is not None:
+        meta['cover_width'], meta['cover_height'], meta['cover'] = cover
+    if remote is not None:
+        logging.info(f"メタデータを生成しました: {url} ({page_count} ページ, リクエスト {remote.requests} 回)")
+    return meta
+
+
+def save(conn, manga_hash, meta=None, error=None):
+    """メタデータ（または生成に失敗した理由）を保存する"""
+    meta = meta or {}
+    with conn:
+        conn.execute('''
+            INSERT OR REPLACE INTO manga_metadata
+                (hash, page_count, cover_width, cover_height, archive_size, cover, error, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (manga_hash, meta.get('page_count'), meta.get('cover_width'), meta.get('cover_height'),
+              meta.get('archive_size'), meta.get('cover'), error, time.time()))
+
+
+def summaries(conn, hashes):
+    """ハッシュのリストについて {ハッシュ: 一覧用のメタデータ} を返す（表紙の画像は含まない）"""
+    result = {}
+    hashes = list(hashes)
+    for i in range(0, len(hashes), 500):
+        chunk = hashes[i:i + 500]
+        placeholders = ','.join('?' * len(chunk))
+        for row in conn.execute(f'SELECT {SUMMARY_COLUMNS} FROM manga_metadata WHERE hash IN ({placeholders})', chunk):
+            result[row['hash']] = row
+    return result
+
+
+def cover(conn, manga_hash):
+    """(表紙のJPEG, 更新時刻) を返す。生成されていない場合は None"""
+    row = conn.execute('SELECT cover, updated_at FROM manga_metadata WHERE hash = ? AND cover IS NOT NULL',
+                       (manga_hash,)).fetchone()
+    return (row['cover'], row['updated_at']) if row else None
+
+
+def needs_generation(summary):
+    """未生成、または失敗してから METADATA_RETRY_AFTER 秒が経ったかどうか"""
+    if summary is None:
+        return True
+    return summary['error'] is not None and time.time() - summary['updated_at'] > METADATA_RETRY_AFTER
@@ -0,0 +1,277 @@
+import os
+import json
+import time
+import uuid
+import atexit
+import fcntl
+import bisect
+import threading
+import logging
+
+from config import METRICS_DIR, METRICS_FLUSH_INTERVAL
+
+# メトリクス（Prometheus のテキスト形式で /metrics に出力する）
+# 記録はプロセス内のカウンターとヒストグラムを更新するだけで、ログの出力やファイルへの書き込みは行わない。
+# 各プロセス（gunicorn のワーカーや変換のプロセスプール）は METRICS_FLUSH_INTERVAL 秒ごとに
+# 自分の値を METRICS_DIR/<pid>-<識別子>.json に書き出し、/metrics はすべてのファイルを合算して返す。
+# 終了したプロセスのファイルは retired.json に合算してから削除するため、カウンターは減らない。
+# fork した子プロセスは親の値を引き継がず、0から記録する（os.register_at_fork）。
+# METRICS_DIR が None の場合はファイルを使わず、/metrics を処理したプロセスの値だけを返す。
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+RETIRED_NAME = 'retired.json'
+LOCK_NAME = '.lock'
+
+_metrics = {} # {名前: Counter / Histogram}（定義順）
+_lock = threading.Lock()
+_state = {'file': None, 'flusher': None, 'dirty': False}
+
+
+class Counter:
+    """単調に増えるカウンター。ラベルの値ごとに集計する"""
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {} # {ラベルの値のタプル: 値}
+
+    def inc(self, *labels, amount=1):
+        with _lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+            _state['dirty'] = True
+        _ensure_flusher()
+
+    def snapshot(self):
+        return [[list(labels), value] for labels, value in self.values.items()]
+
+    def reset(self):
+        self.values = {}
+
+
+class Histogram:
+    """値の分布（バケットごとの件数・合計・件数）。ラベルの値ごとに集計する"""
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self.values = {} # {ラベルの値のタプル: [バケットごとの件数..., +Inf の件数, 合計]}
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with _lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            entry[index] += 1
+            entry[-1] += value
+            _state['dirty'] = True
+        _ensure_flusher()
+
+    def time(self, *labels):
+        """with ブロックの経過時間を記録するコンテキストマネージャー"""
+        return _Timer(self, labels)
+
+    def snapshot(self):
+        return [[list(labels), list(entry)] for labels, entry in self.values.items()]
+
+    def reset(self):
+        self.values = {}
+
+
+class _Timer:
+    __slots__ = ('histogram', 'labels', 'start')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+
+def counter(name, help, labels=()):
+    return _register(Counter(name, help, labels))
+
+
+def histogram(name, help, labels=(), buckets=DEFAULT_BUCKETS):
+    return _register(Histogram(name, help, labels, buckets))
+
+
+def _register(metric):
+    with _lock:
+        existing = _metrics.get(metric.name)
+        if existing is not None:
+            return existing # 同じモジュールが二度読み込まれた場合（benchmark.py など）
+        _metrics[metric.name] = metric
+    return metric
+
+
+# --- プロセス間の集計 ---
+
+def _snapshot():
+    with _lock:
+        _state['dirty'] = False
+        return {name: metric.snapshot() for name, metric in _metrics.items() if metric.values}
+
+
+def _write_json(path, data):
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, separators=(',', ':'))
+    os.replace(tmp_path, path)
+
+
+def flush():
+    """このプロセスの値をファイルに書き出す"""
+    if METRICS_DIR is None:
+        return
+    if _state['file'] is None:
+        _state['file'] = os.path.join(METRICS_DIR, f'{os.getpid()}-{uuid.uuid4().hex[:8]}.json')
+    try:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        _write_json(_state['file'], _snapshot())
+    except OSError as e:
+        logging.warning(f"メトリクスを書き出せません: {e}")
+
+
+def _flusher():
+    while True:
+        time.sleep(METRICS_FLUSH_INTERVAL)
+        if _state['dirty']:
+            flush()
+
+
+def _ensure_flusher():
+    if _state['flusher'] is None and METRICS_DIR is not None:
+        with _lock:
+            if _state['flusher'] is not None:
+                return
+            _state['flusher'] = threading.Thread(target=_flusher, name='metrics-flusher', daemon=True)
+        _state['flusher'].start()
+
+
+def _after_fork():
+    # 子プロセスは親の値を引き継がない（親のファイルに二重に数えないよう、別のファイルに書く）
+    global _lock
+    _lock = threading.Lock()
+    for metric in _metrics.values():
+        metric.reset()
+    _state.update(file=None, flusher=None, dirty=False)
+
+
+os.register_at_fork(after_in_child=_after_fork)
+atexit.register(lambda: _state['dirty'] and flush())
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _load(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _add(totals, snapshot):
+    """スナップショットの値を {名前: {ラベルの値のタプル: 値}} に加算する"""
+    for name, items in snapshot.items():
+        metric = totals.setdefault(name, {})
+        for labels, value in items:
+            key = tuple(labels)
+            if isinstance(value, list):
+                current = metric.get(key)
+                metric[key] = value if current is None or len(current) != len(value) else [a + b for a, b in zip(current, value)]
+            else:
+                metric[key] = metric.get(key, 0) + value
+
+
+def collect():
+    """
+    すべてのプロセスの値を合算して返す。
+    終了したプロセスのファイルは retired.json に合算して削除する（ロックを取って1つのプロセスだけが行う）。
+    """
+    if METRICS_DIR is None:
+        totals = {}
+        _add(totals, _snapshot())
+        return totals
+    flush()
+    totals = {}
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    with open(os.path.join(METRICS_DIR, LOCK_NAME), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        retired_path = os.path.join(METRICS_DIR, RETIRED_NAME)
+        retired = {}
+        _add(retired, _load(retired_path))
+        changed = False
+        for name in os.listdir(METRICS_DIR):
+            if not name.endswith('.json') or name == RETIRED_NAME:
+                continue
+            path = os.path.join(METRICS_DIR, name)
+            snapshot = _load(path)
+            pid = name.split('-', 1)[0]
+            if pid.isdigit() and not _pid_alive(int(pid)):
+                _add(retired, snapshot)
+                os.remove(path)
+                changed = True
+            else:
+                _add(totals, snapshot)
+        if changed:
+            _write_json(retired_path, {name: [[list(k), v] for k, v in items.items()] for name, items in retired.items()})
+    for name, items in retired.items():
+        _add(totals, {name: [[list(k), v] for k, v in items.items()]})
+    return totals
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+def render(gauges=()):
+    """
+    Prometheus のテキスト形式で返す。
+    gauges は (名前, 説明, ラベル名のタプル, {ラベルの値のタプル: 値}) のリストで、出力時に計算した値を追加する。
+    """
+    totals = collect()
+    lines = []
+    for name, metric in list(_metrics.items()):
+        lines.append(f'# HELP {name} {metric.help}')
+        lines.append(f'# TYPE {name} {metric.kind}')
+        for labels, value in sorted(totals.get(name, {}).items()):
+            if metric.kind == 'counter':
+                lines.append(f'{name}{_format_labels(metric.labels, labels)} {value}')
+                continue
+            cumulative = 0
+            for bound, count in zip(metric.buckets + (float('inf'),), value[:-1]):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{name}_bucket{_format_labels(metric.labels, labels, [("le", le)])} {cumulative}')
+            lines.append(f'{name}_sum{_format_labels(metric.labels, labels)} {value[-1]}')
+            lines.append(f'{name}_count{_format_labels(metric.labels, labels)} {cumulative}')
+    for name, help, label_names, values in gauges:
+        lines.append(f'# HELP {name} {help}')
+        lines.append(f'# TYPE {name} gauge')
+        for labels, value in sorted(values.items()):
+            lines.append(f'{name}{_format_labels(label_names, labels)} {value}')
+    return '\n'.join(lines) + '\n'
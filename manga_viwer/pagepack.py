@@ -0,0 +1,226 @@
+import os
+import mmap
+import json
+import struct
+import threading
+import logging
+from collections import OrderedDict, namedtuple
+
+from config import PACK_POOL_SIZE
+
+# ページパック
+# 抽出済みのページ（連番[_バリアント].拡張子 の小さなファイル）を巻ごとに1つのファイルにまとめる。
+# ファイルの構成: [ページのデータ...][索引JSON][索引の長さ（8バイト、リトルエンディアン）][MAGIC]
+# 索引の files は {ファイル名: [オフセット, 長さ]}、archive_version はまとめたときのアーカイブのバージョン（mtime）で、
+# アーカイブを削除した巻でもキャッシュインデックスを作り直したときにページのETagが変わらないようにする。
+# 1巻あたり開いたままのファイル（索引を読む mmap）は1つで済み、
+# ページごとの inode も不要になる。配信時はパックをページの範囲に限ったファイルとして開いて返すため、
+# send_file と同じく wsgi.file_wrapper を通り、gunicorn では os.sendfile でその範囲だけを送信する。
+
+PACK_NAME = 'pages.pack'
+MAGIC = b'MVPK'
+TRAILER = struct.Struct('<Q4s')
+
+# パック内のページの場所。stamp はパックの (mtime_ns, inode) で、パックが作り直されるとオフセットが変わるため、
+# 開くときに照合する。stamp が None の場合は、path がページのファイルそのもの（パックにまとめていないページ）
+PageLocation = namedtuple('PageLocation', 'path stamp offset length')
+
+
+def write_pack(extract_path, names, archive_version=None):
+    """
+    抽出ディレクトリ内のファイル names を1つのパックにまとめ、パックのパスを返す。
+    既にパックがある場合は、その内容（names と同じ名前のものを除く）も新しいパックに含める。
+    archive_version が None の場合は、既存のパックに記録されたバージョンを引き継ぐ。
+    元のファイルは削除しない（呼び出し側が、置き換えが完了してから削除する）。
+    """
+    pack_path = os.path.join(extract_path, PACK_NAME)
+    tmp_path = f'{pack_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    names = set(names)
+    old_mm, old_header = _load(pack_path) if os.path.isfile(pack_path) else (None, {'files': {}})
+    old_index = old_header['files']
+    if archive_version is None:
+        archive_version = old_header.get('archive_version')
+    index = {}
+    try:
+        with open(tmp_path, 'wb') as out:
+            for name in sorted(names | set(old_index)):
+                if name in names:
+                    with open(os.path.join(extract_path, name), 'rb') as f:
+                        data = f.read()
+                else:
+                    offset, length = old_index[name]
+                    data = old_mm[offset:offset + length]
+                index[name] = [out.tell(), len(data)]
+                out.write(data)
+            header = {'version': 1, 'files': index, 'archive_version': archive_version}
+            encoded = json.dumps(header, separators=(',', ':')).encode()
+            out.write(encoded)
+            out.write(TRAILER.pack(len(encoded), MAGIC))
+        os.replace(tmp_path, pack_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    finally:
+        if old_mm is not None:
+            old_mm.close()
+    return pack_path
+
+
+def _load(pack_path):
+    """パックを mmap し、(mmap, 索引JSON) を返す。形式が正しくない場合は ValueError を送出する"""
+    with open(pack_path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) # mmap は閉じたファイルとは独立に有効
+    if len(mm) < TRAILER.size:
+        raise ValueError(f"ページパックが短すぎます: {pack_path}")
+    length, magic = TRAILER.unpack(mm[-TRAILER.size:])
+    if magic != MAGIC or length > len(mm) - TRAILER.size:
+        raise ValueError(f"ページパックの形式が正しくありません: {pack_path}")
+    start = len(mm) - TRAILER.size - length
+    return mm, json.loads(mm[start:start + length])
+
+
+def archive_version(pack_path):
+    """パックに記録したアーカイブのバージョン。記録がないか、パックを読めない場合は None"""
+    try:
+        mm, header = _load(pack_path)
+    except (OSError, ValueError):
+        return None
+    mm.close()
+    return header.get('archive_version')
+
+
+class PageSlice:
+    """
+    パック内の1ページだけを読むファイルオブジェクト（wsgi.file_wrapper に渡す）。
+    ファイルの位置をページの先頭に合わせてあるため、gunicorn は fileno() と Content-Length から
+    os.sendfile でページを送信する。sendfile を使わないサーバー向けに、read() はページの終わりで止まり、
+    seek()/tell() はページの先頭からの位置を扱う（Range リクエスト用）。
+    """
+
+    def __init__(self, file, offset, length):
+        self._file = file
+        self._offset = offset
+        self.length = length
+        file.seek(offset)
+
+    def fileno(self):
+        return self._file.fileno()
+
+    def read(self, size=-1):
+        remaining = max(self._offset + self.length - self._file.tell(), 0)
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        return self._file.read(size)
+
+    def seekable(self):
+        return True
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            pos += self.tell()
+        elif whence == os.SEEK_END:
+            pos += self.length
+        return self._file.seek(self._offset + min(max(pos, 0), self.length)) - self._offset
+
+    def tell(self):
+        return self._file.tell() - self._offset
+
+    def close(self):
+        self._file.close()
+
+
+def open_page(location):
+    """パック内のページを PageSlice として開く。パックが削除されたか、作り直された場合は None"""
+    try:
+        f = open(location.path, 'rb', buffering=0)
+    except FileNotFoundError:
+        return None
+    st = os.fstat(f.fileno())
+    if (st.st_mtime_ns, st.st_ino) != location.stamp:
+        f.close()
+        return None
+    return PageSlice(f, location.offset, location.length)
+
+
+class PackPool:
+    """
+    mmap したページパックと索引を、抽出ディレクトリごとに保持するLRUプール。
+    パックの mtime と inode を確認し、作り直された場合は開き直す。
+    プールから外した mmap は閉じず、読み出し中のスレッドがなくなった時点で解放される。
+    """
+
+    def __init__(self, size):
+        self._size = size
+        self._packs = OrderedDict() # {抽出ディレクトリ: ((mtime_ns, inode), mmap, 索引)}
+        self._lock = threading.Lock()
+
+    def _get(self, extract_path):
+        pack_path = os.path.join(extract_path, PACK_NAME)
+        try:
+            st = os.stat(pack_path)
+        except FileNotFoundError:
+            self.invalidate(extract_path)
+            return None
+        stamp = (st.st_mtime_ns, st.st_ino)
+        with self._lock:
+            entry = self._packs.get(extract_path)
+            if entry is not None and entry[0] == stamp:
+                self._packs.move_to_end(extract_path)
+                return entry
+        try:
+            mm, header = _load(pack_path)
+        except (OSError, ValueError) as e:
+            logging.warning(f"ページパックを読み込めません: {pack_path} - {e}")
+            return None
+        entry = (stamp, mm, header['files'])
+        with self._lock:
+            self._packs[extract_path] = entry
+            self._packs.move_to_end(extract_path)
+            while len(self._packs) > self._size:
+                self._packs.popitem(last=False)
+        return entry
+
+    def names(self, extract_path):
+        """パック内のファイル名の一覧（パックがない場合は空）"""
+        entry = self._get(extract_path)
+        return list(entry[2]) if entry else []
+
+    def contains(self, extract_path, name):
+        """パックにファイルがあるかどうか"""
+        entry = self._get(extract_path)
+        return entry is not None and name in entry[2]
+
+    def read(self, extract_path, name):
+        """パックからファイルの内容を読み出す。パックやファイルがない場合は None"""
+        entry = self._get(extract_path)
+        if entry is None:
+            return None
+        location = entry[2].get(name)
+        if location is None:
+            return None
+        offset, length = location
+        return entry[1][offset:offset + length]
+
+    def locate(self, extract_path, name):
+        """パック内のファイルの場所（PageLocation）。パックやファイルがない場合は None"""
+        entry = self._get(extract_path)
+        if entry is None:
+            return None
+        location = entry[2].get(name)
+        if location is None:
+            return None
+        offset, length = location
+        return PageLocation(os.path.join(extract_path, PACK_NAME), entry[0], offset, length)
+
+    def invalidate(self, extract_path):
+        """キャッシュ削除時などにプールから外す"""
+        with self._lock:
+            self._packs.pop(extract_path, None)
+
+    def clear(self):
+        with self._lock:
+            self._packs.clear()
+
+
+pack_pool = PackPool(PACK_POOL_SIZE)
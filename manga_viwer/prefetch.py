@@ -0,0 +1,81 @@
+import queue
+import threading
+import logging
+from collections import OrderedDict
+
+# 先読み
+# 読んでいる位置より先のページの変換や、シリーズの次の巻のダウンロードをバックグラウンドで行う。
+# 先読みは閲覧を速くするためのもので、キューが満杯の場合や同じ内容が登録済みの場合は捨てる。
+# 状態はプロセスごとに持つ（gunicorn のワーカーごとに独立して動く）。
+
+
+class Prefetcher:
+    """重複を除いた上限付きキューと、先読み専用のワーカースレッド（閲覧用のジョブキューとは別）"""
+
+    def __init__(self, workers, max_pending):
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._pending = set() # 登録済みで未完了のキー
+        self._lock = threading.Lock()
+        self._volumes = set() # 先読みしたが、まだ開かれていない巻のハッシュ
+        self._done = OrderedDict() # done() で完了を記録したキー（古いものから忘れる）
+        self.stats = {'submitted': 0, 'dropped': 0, 'done': 0, 'failed': 0}
+        for i in range(workers):
+            threading.Thread(target=self._worker, name=f'manga-prefetch-{i}', daemon=True).start()
+
+    def submit(self, key, func):
+        """
+        func() をバックグラウンドで実行する。同じキーが登録済み、またはキューが満杯の場合は捨てる。
+        登録した場合は True を返す。
+        """
+        with self._lock:
+            if key in self._pending:
+                return False
+            try:
+                self._queue.put_nowait((key, func))
+            except queue.Full:
+                self.stats['dropped'] += 1
+                return False
+            self._pending.add(key)
+            self.stats['submitted'] += 1
+            return True
+
+    def done(self, key, limit=1024):
+        """一度だけ行えばよい先読みの完了を記録する（直近 limit 件のキーを覚えておく）"""
+        with self._lock:
+            self._done[key] = True
+            while len(self._done) > limit:
+                self._done.popitem(last=False)
+
+    def is_done(self, key):
+        """done() で完了を記録したキーかどうか"""
+        with self._lock:
+            return key in self._done
+
+    def add_volume(self, manga_hash):
+        """次の巻として先読みした巻を記録する"""
+        with self._lock:
+            self._volumes.add(manga_hash)
+
+    def volume_opened(self, manga_hash):
+        """巻が開かれたら、先読みの予算から外す"""
+        with self._lock:
+            self._volumes.discard(manga_hash)
+
+    def unread_volumes(self):
+        """先読みしたが、まだ開かれていない巻のハッシュ"""
+        with self._lock:
+            return set(self._volumes)
+
+    def _worker(self):
+        while True:
+            key, func = self._queue.get()
+            try:
+                func()
+                self.stats['done'] += 1
+            except Exception as e:
+                self.stats['failed'] += 1
+                logging.warning(f"先読みに失敗しました: {key} - {e}", exc_info=True)
+            finally:
+                with self._lock:
+                    self._pending.discard(key)
+                self._queue.task_done()
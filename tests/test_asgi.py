@@ -0,0 +1,178 @@
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+MANGA_VIWER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'manga_viwer')
+
+# ASGI のアダプター（asgi.application）を、ASGI サーバーを使わずに asyncio から直接呼ぶ。
+# app は読み込み時に config の設定を取り込むため、test_image.py と同じく子プロセスで一時ディレクトリのキャッシュを作り、
+# 一連のリクエストの結果を JSON で出力する:
+#   {名前: {'status', 'headers': {...}, 'chunks': 本文の送信回数, 'body': 本文の16進, 'executor': 'loop' / 'thread', 'elapsed'}}
+CHILD = '''
+import os, sys, json, time, asyncio, threading
+sys.path.insert(0, sys.argv[1])
+work_dir = sys.argv[2]
+import config
+config.METRICS_DIR = None
+config.DATABASE = os.path.join(work_dir, 'manga.db')
+config.MANGA_CACHE_DIR = os.path.join(work_dir, 'cache')
+config.MANGA_CACHE_TEMP_DIR = os.path.join(work_dir, 'cache_temp')
+import app, asgi, cache_index, converter
+from PIL import Image
+
+asgi.ASGI_CHUNK_SIZE = 1000 # ページを複数のチャンクで送る
+source = os.path.join(work_dir, 'source.png')
+Image.effect_noise((400, 600), 60).convert('RGB').save(source)
+manga_hash = '1' * 32
+extract_path = os.path.join(config.MANGA_CACHE_DIR, manga_hash + '_extracted')
+os.makedirs(extract_path)
+converter.convert_page(source, os.path.join(extract_path, '0000'), 'jpeg')
+with app.app.app_context():
+    cache_index.record(manga_hash, archive_size=0, extracted_size=cache_index.dir_size(extract_path), version=100.0)
+page_url = f'/image/{manga_hash}_extracted/0000'
+results = {}
+
+
+def executors():
+    return dict(asgi.ASGI_REQUESTS.values)
+
+
+async def call(name, path, method='GET', query='', headers=(), body=(b'',), disconnect=False):
+    messages = [{'type': 'http.request', 'body': chunk, 'more_body': i < len(body) - 1} for i, chunk in enumerate(body)]
+    if disconnect:
+        messages = [{'type': 'http.disconnect'}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {'type': 'http', 'http_version': '1.1', 'method': method, 'scheme': 'http', 'path': path,
+             'root_path': '', 'query_string': query.encode(), 'server': ('testserver', 80), 'client': ('127.0.0.1', 5000),
+             'headers': [(k.lower().encode(), v.encode()) for k, v in (('Accept', 'image/jpeg'),) + tuple(headers)]}
+    before = executors()
+    started = time.perf_counter()
+    await asgi.application(scope, receive, send)
+    elapsed = time.perf_counter() - started
+    after = executors()
+    result = {'messages': len(sent), 'elapsed': elapsed,
+              'executor': next((k for k in after if after[k] != before.get(k, 0)), (None,))[0]}
+    if sent:
+        result.update(status=sent[0]['status'],
+                      headers={k.decode(): v.decode() for k, v in sent[0]['headers']},
+                      chunks=sum(1 for m in sent[1:] if m['body']),
+                      body=b''.join(m['body'] for m in sent[1:]).hex(),
+                      last=not sent[-1]['more_body'])
+    results[name] = result
+
+
+def slow_job(job):
+    job.set_state('extracting')
+    job.extract_progress(0, 10)
+    threading.Timer(0.3, job.extract_progress, (1, 10)).start()
+    release.wait(5)
+
+
+async def main():
+    await call('page', page_url)
+    etag = results['page']['headers']['etag']
+    await call('not_modified', page_url, headers=[('If-None-Match', etag)])
+    await call('range', page_url, headers=[('Range', 'bytes=10-109')])
+    await call('unknown_job', '/job_status/nope', query='wait=3')
+    app.job_queue.submit('slow', slow_job)
+    await asyncio.sleep(0.1)
+    await call('job_wait', '/job_status/slow', query='wait=5&state=extracting&pages_done=0')
+    payload = json.dumps({'urls': ['https://example.com/s/vol1.cbz']}).encode()
+    await call('post', '/add_batch', method='POST', headers=[('Content-Type', 'application/json')],
+               body=(payload[:10], payload[10:]))
+    await call('disconnect', '/add_batch', method='POST', disconnect=True)
+    await call('not_found', '/no_such_route')
+
+release = threading.Event()
+asyncio.run(main())
+release.set()
+
+environ = asgi.build_environ({
+    'type': 'http', 'http_version': '1.1', 'method': 'GET', 'path': '/manga/reader', 'root_path': '/manga',
+    'query_string': b'a=1', 'headers': [(b'accept', b'image/webp'), (b'accept', b'image/jpeg'),
+                                        (b'cookie', b'a=1'), (b'cookie', b'b=2'), (b'content-type', b'text/plain')],
+}, b'')
+results['environ'] = {k: environ[k] for k in ('SCRIPT_NAME', 'PATH_INFO', 'QUERY_STRING', 'HTTP_ACCEPT', 'HTTP_COOKIE',
+                                              'CONTENT_TYPE', 'SERVER_NAME')}
+print(json.dumps(results))
+'''
+
+
+class ASGIApplicationTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        work_dir = tempfile.mkdtemp(prefix='manga_test_asgi_')
+        try:
+            out = subprocess.run([sys.executable, '-c', CHILD, MANGA_VIWER, work_dir],
+                                 capture_output=True, text=True, check=True)
+        finally:
+            shutil.rmtree(work_dir, True)
+        cls.results = json.loads(out.stdout.strip().splitlines()[-1])
+
+    def test_page_in_chunks(self):
+        # ファイルの応答はスレッドで作り、ASGI_CHUNK_SIZE ずつ送る
+        page = self.results['page']
+        self.assertEqual((page['status'], page['executor']), (200, 'thread'))
+        body = bytes.fromhex(page['body'])
+        self.assertEqual(int(page['headers']['content-length']), len(body))
+        self.assertEqual(page['chunks'], -(-len(body) // 1000))
+        self.assertTrue(page['last'])
+        self.assertTrue(body.startswith(b'\xff\xd8'))
+
+    def test_not_modified_on_loop(self):
+        # ETagがプロセス内にあるページの304は、スレッドを使わずにイベントループで返す
+        response = self.results['not_modified']
+        self.assertEqual((response['status'], response['executor']), (304, 'loop'))
+        self.assertEqual(response['body'], '')
+        self.assertEqual(response['headers']['etag'], self.results['page']['headers']['etag'])
+
+    def test_range_in_thread(self):
+        response = self.results['range']
+        self.assertEqual((response['status'], response['executor']), (206, 'thread'))
+        self.assertEqual(bytes.fromhex(response['body']), bytes.fromhex(self.results['page']['body'])[10:110])
+
+    def test_job_status_wait(self):
+        # 存在しないジョブは待たずに返し、実行中のジョブは進捗が変わった時点で返す
+        unknown = self.results['unknown_job']
+        self.assertEqual((unknown['status'], unknown['executor']), (404, 'loop'))
+        self.assertLess(unknown['elapsed'], 1)
+        waited = self.results['job_wait']
+        self.assertEqual((waited['status'], waited['executor']), (200, 'loop'))
+        self.assertEqual(json.loads(bytes.fromhex(waited['body']))['pages_done'], 1)
+        self.assertGreater(waited['elapsed'], 0.1)
+        self.assertLess(waited['elapsed'], 3)
+
+    def test_request_body(self):
+        # 複数のメッセージに分かれ、Content-Length のない本文（chunked）もまとめて Flask に渡す
+        response = self.results['post']
+        self.assertEqual((response['status'], response['executor']), (200, 'thread'))
+        self.assertEqual([r['status'] for r in json.loads(bytes.fromhex(response['body']))['results']], ['added'])
+
+    def test_disconnect(self):
+        self.assertEqual(self.results['disconnect']['messages'], 0)
+
+    def test_not_found(self):
+        self.assertEqual(self.results['not_found']['status'], 404)
+
+    def test_build_environ(self):
+        environ = self.results['environ']
+        self.assertEqual((environ['SCRIPT_NAME'], environ['PATH_INFO'], environ['QUERY_STRING']), ('/manga', '/reader', 'a=1'))
+        self.assertEqual(environ['HTTP_ACCEPT'], 'image/webp,image/jpeg') # 同じ名前のヘッダーはまとめる
+        self.assertEqual(environ['HTTP_COOKIE'], 'a=1; b=2')
+        self.assertEqual((environ['CONTENT_TYPE'], environ['SERVER_NAME']), ('text/plain', 'localhost'))
+
+
+if __name__ == '__main__':
+    unittest.main()
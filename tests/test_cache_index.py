@@ -0,0 +1,143 @@
+import os
+import sys
+import shutil
+import sqlite3
+import functools
+import tempfile
+import unittest
+from unittest import mock
+
+# manga_viwer のモジュールは `from config import ...` のように直接読み込む構成のため、パスに加える
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'manga_viwer'))
+
+import config # noqa: E402
+config.METRICS_DIR = None # 試験中のメトリクスをファイルに書き出さない
+import db # noqa: E402
+import cache_index # noqa: E402
+
+HASH_A = 'a' * 32
+HASH_B = 'b' * 32
+
+
+class CacheIndexTestCase(unittest.TestCase):
+    """一時ディレクトリのデータベースとキャッシュディレクトリを cache_index に使わせる"""
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='manga_test_cache_index_')
+        self.addCleanup(shutil.rmtree, self.work_dir, True)
+        self.cache_dir = os.path.join(self.work_dir, 'cache')
+        os.makedirs(self.cache_dir)
+        path = os.path.join(self.work_dir, 'manga.db')
+        self.conn = db.connect(path)
+        self.addCleanup(self.conn.close)
+        for patcher in (mock.patch.object(db, 'get_connection', return_value=self.conn),
+                        mock.patch.object(db, 'connect', functools.partial(db.connect, path)),
+                        mock.patch.object(cache_index, 'MANGA_CACHE_DIR', self.cache_dir)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(cache_index._versions.clear)
+
+    def assertTotals(self, archive, extracted):
+        self.assertEqual(cache_index.totals(), {'total': archive + extracted, 'archive': archive, 'extracted': extracted})
+        # トリガーで集計した合計は、行の合計と一致する
+        row = self.conn.execute('SELECT COALESCE(SUM(archive_size), 0), COALESCE(SUM(extracted_size), 0) FROM cache_index').fetchone()
+        self.assertEqual(tuple(row), (archive, extracted))
+
+    def write(self, name, size):
+        path = os.path.join(self.cache_dir, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(b'\0' * size)
+        return path
+
+
+class TotalsTest(CacheIndexTestCase):
+
+    def setUp(self):
+        super().setUp()
+        db.migrate(self.conn)
+
+    def test_triggers(self):
+        cache_index.record(HASH_A, archive_size=100, version=1.0)
+        cache_index.record(HASH_B, archive_size=40, extracted_size=10)
+        self.assertTotals(140, 10)
+        cache_index.add_extracted_size(HASH_A, 30)
+        cache_index.record(HASH_B, extracted_size=25) # None のサイズは変更しない
+        self.assertTotals(140, 55)
+        cache_index.drop_archive(HASH_A)
+        self.assertTotals(40, 55)
+        self.assertEqual(cache_index.size(HASH_A), 30)
+        cache_index.remove(HASH_B)
+        self.assertTotals(0, 30)
+        self.assertEqual(cache_index.total_size(), 30)
+        cache_index.clear()
+        self.assertTotals(0, 0)
+
+    def test_touch_does_not_change_totals(self):
+        cache_index.record(HASH_A, archive_size=100)
+        cache_index.touch(HASH_A, hit=True)
+        cache_index.touch(HASH_B) # インデックスにない巻は何もしない
+        self.assertTotals(100, 0)
+        self.assertEqual(self.conn.execute('SELECT COUNT(*) FROM cache_index').fetchone()[0], 1)
+
+    def test_version(self):
+        self.assertIsNone(cache_index.version(HASH_A))
+        cache_index.record(HASH_A, archive_size=1, version=5.0)
+        self.assertIsNone(cache_index.version(HASH_A, cached_only=True)) # まだメモリにない
+        self.assertEqual(cache_index.version(HASH_A), 5.0)
+        self.assertEqual(cache_index.version(HASH_A, cached_only=True), 5.0)
+        cache_index.record(HASH_A, version=6.0) # 更新するとメモリのキャッシュを破棄する
+        self.assertEqual(cache_index.version(HASH_A), 6.0)
+
+    def test_rebuild(self):
+        # 既存の行の最終アクセス時刻と回数は保持し、ディスクにない巻の行は削除する
+        cache_index.record(HASH_A, archive_size=1)
+        cache_index.record(HASH_B, archive_size=1)
+        with self.conn:
+            self.conn.execute('UPDATE cache_index SET last_access = 123, hits = 4 WHERE hash = ?', (HASH_A,))
+        archive = self.write(f'{HASH_A}.cbz', 300)
+        self.write(f'{HASH_A}_extracted/0000.jpg', 50)
+        self.write(f'{HASH_A}_extracted/0001.jpg', 70)
+        partial = 'c' * 32
+        self.write(f'{partial}.zip.part', 20)
+        self.write('unrelated.txt', 1000)
+
+        self.assertEqual(cache_index.rebuild(), 2)
+        self.assertTotals(320, 120)
+        row = self.conn.execute('SELECT * FROM cache_index WHERE hash = ?', (HASH_A,)).fetchone()
+        self.assertEqual((row['last_access'], row['hits'], row['version']), (123, 4, os.path.getmtime(archive)))
+        self.assertIsNone(cache_index.version(partial)) # ダウンロード途中のファイルはバージョンにしない
+        self.assertEqual(cache_index.size(HASH_B), 0)
+
+
+class MigrationTest(CacheIndexTestCase):
+
+    def test_access_stats_migration(self):
+        # v5 までのデータベースに行がある状態から移行すると、アーカイブ・抽出済み画像ごとの合計を集計する
+        with mock.patch.object(db, 'MIGRATIONS', db.MIGRATIONS[:5]):
+            self.assertEqual(db.migrate(self.conn), 5)
+        with self.conn:
+            self.conn.execute("INSERT INTO cache_index (hash, archive_size, extracted_size) VALUES (?, 100, 20)", (HASH_A,))
+            self.conn.execute("INSERT INTO cache_index (hash, archive_size, extracted_size) VALUES (?, 0, 5)", (HASH_B,))
+        self.assertEqual(self.conn.execute('SELECT total_size FROM cache_totals').fetchone()[0], 125)
+
+        self.assertEqual(db.migrate(self.conn), db.MIGRATIONS[-1][0])
+        self.assertTotals(100, 25)
+        self.assertEqual(cache_index.total_size(), 125)
+        row = self.conn.execute('SELECT hits, clock FROM cache_index WHERE hash = ?', (HASH_A,)).fetchone()
+        self.assertEqual(tuple(row), (0, 0))
+        # 新しいトリガーも両方の合計を更新する
+        cache_index.add_extracted_size(HASH_B, 10)
+        self.assertTotals(100, 35)
+
+    def test_migrate_is_idempotent(self):
+        version = db.migrate(self.conn)
+        self.assertEqual(db.migrate(self.conn), version)
+        self.assertEqual(self.conn.execute('PRAGMA user_version').fetchone()[0], version)
+        with self.assertRaises(sqlite3.IntegrityError): # 合計の行は1つだけ
+            with self.conn:
+                self.conn.execute('INSERT INTO cache_totals (id) VALUES (1)')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,202 @@
+import os
+import json
+import sys
+import shutil
+import tempfile
+import threading
+import unittest
+import http.server
+from unittest import mock
+
+# manga_viwer のモジュールは `from config import ...` のように直接読み込む構成のため、パスに加える
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'manga_viwer'))
+
+import config # noqa: E402
+config.METRICS_DIR = None # 試験中のメトリクスをファイルに書き出さない
+import downloader # noqa: E402
+
+DATA = bytes(range(256)) * 4096 # 1MB
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    """
+    ダウンロードの試験用の HTTP サーバー。server の属性で応答を変える:
+      ranges: Range に対応する（HEAD で Accept-Ranges: bytes を返す）
+      max_range: 206 で返す範囲の最大バイト数（要求より短い範囲を返すサーバー）
+      wrong_start: 206 で常に先頭から返す（要求と異なる範囲を返すサーバー）
+      drops: GET ごとに、このバイト数を送った時点で接続を閉じる（None は最後まで送る）。
+             206 は Content-Length を付けないため、クライアントからは正常に閉じられたように見える
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(DATA)))
+        if self.server.ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.ranges_requested.append(self.headers.get('Range'))
+            drop = server.drops.pop(0) if server.drops else None
+        requested = self.headers.get('Range')
+        if requested and server.ranges:
+            first, _, last = requested[len('bytes='):].partition('-')
+            start = int(first)
+            end = int(last) if last else len(DATA) - 1
+            if server.max_range:
+                end = min(end, start + server.max_range - 1)
+            if server.wrong_start:
+                start = 0
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{len(DATA)}')
+            if drop is None:
+                self.send_header('Content-Length', str(end - start + 1))
+        else:
+            start, end = 0, len(DATA) - 1
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(DATA)))
+        body = DATA[start:end + 1]
+        if drop is not None:
+            body = body[:drop]
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class DownloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='manga_test_download_')
+        self.save_path = os.path.join(self.work_dir, 'volume.cbz')
+        self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.lock = threading.Lock()
+        self.httpd.ranges = True
+        self.httpd.max_range = None
+        self.httpd.wrong_start = False
+        self.httpd.drops = []
+        self.httpd.ranges_requested = []
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self.httpd.server_address[1]}/volume.cbz'
+        # 再開までの待ち時間を省き、切断する位置（drops）が読み書きの単位の境界になるようにする
+        for patcher in (mock.patch.object(downloader.time, 'sleep'),
+                        mock.patch.object(downloader, 'DOWNLOAD_CHUNK_SIZE', 100_000)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def segmented(self):
+        """1MB のファイルも DOWNLOAD_SEGMENTS 個の区間に分けてダウンロードする"""
+        patcher = mock.patch.object(downloader, 'DOWNLOAD_SEGMENT_MIN_MB', 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def assertDownloaded(self):
+        with open(self.save_path, 'rb') as f:
+            self.assertEqual(f.read(), DATA)
+        self.assertFalse(os.path.exists(self.save_path + '.part'))
+        self.assertFalse(os.path.exists(self.save_path + '.part.json'))
+
+    def test_stream(self):
+        downloader.download_file(self.url, self.save_path)
+        self.assertDownloaded()
+
+    def test_stream_resumes_after_short_body(self):
+        # 1回目は途中で切断、2回目（Range での再開）は Content-Length なしで途中で正常に閉じる
+        self.httpd.drops = [300_000, 200_000]
+        downloader.download_file(self.url, self.save_path)
+        self.assertDownloaded()
+        self.assertEqual(self.httpd.ranges_requested, [None, 'bytes=300000-', 'bytes=500000-'])
+
+    def test_stream_rejects_wrong_range(self):
+        self.httpd.drops = [300_000]
+        self.httpd.wrong_start = True
+        with self.assertRaises(Exception):
+            downloader.download_file(self.url, self.save_path)
+        self.assertFalse(os.path.exists(self.save_path))
+        self.assertFalse(os.path.exists(self.save_path + '.part'))
+
+    def test_segments(self):
+        self.segmented()
+        downloader.download_file(self.url, self.save_path)
+        self.assertDownloaded()
+        self.assertEqual(len(self.httpd.ranges_requested), downloader.DOWNLOAD_SEGMENTS)
+
+    def test_segments_with_short_ranges(self):
+        # サーバーが要求より短い範囲を返しても、区間の終わりまで要求を続ける
+        self.segmented()
+        self.httpd.max_range = 64 * 1024
+        downloader.download_file(self.url, self.save_path)
+        self.assertDownloaded()
+        self.assertEqual(len(self.httpd.ranges_requested), len(DATA) // self.httpd.max_range)
+
+    def test_segments_resume_after_short_body(self):
+        # 区間の応答が途中で正常に閉じられた場合は、受信済みの位置から再開する
+        self.segmented()
+        self.httpd.drops = [10_000]
+        downloader.download_file(self.url, self.save_path)
+        self.assertDownloaded()
+        starts = {int(r[len('bytes='):].partition('-')[0]) for r in self.httpd.ranges_requested}
+        step = len(DATA) // downloader.DOWNLOAD_SEGMENTS
+        self.assertEqual(len(self.httpd.ranges_requested), downloader.DOWNLOAD_SEGMENTS + 1)
+        self.assertEqual(len([start for start in range(0, len(DATA), step) if start + 10_000 in starts]), 1)
+
+    def test_segments_save_state_periodically(self):
+        # ダウンロード中に保存した進捗（.part.json）だけが残っても、.part のその範囲は受信済みで、続きから再開できる
+        self.segmented()
+        snapshots = []
+        save_state = downloader._save_state
+
+        def save_and_copy(part_path, state):
+            save_state(part_path, state)
+            with open(part_path, 'rb') as f:
+                snapshots.append((json.loads(json.dumps(state)), f.read()))
+
+        # 区間（256KB）ごとに、100KB ずつ受信して 200KB を超えた時点で1回保存する
+        with mock.patch.object(downloader, 'DOWNLOAD_STATE_SAVE_MB', 0.2), \
+                mock.patch.object(downloader, '_save_state', save_and_copy):
+            downloader.download_file(self.url, self.save_path)
+        self.assertDownloaded()
+        # 区間の分割時、区間ごとの途中、終了時
+        self.assertEqual(len(snapshots), 1 + downloader.DOWNLOAD_SEGMENTS + 1)
+
+        state, data = snapshots[downloader.DOWNLOAD_SEGMENTS] # すべての区間の途中で保存した後に中断した場合
+        for seg in state['segments']:
+            self.assertEqual(data[seg['start']:seg['start'] + seg['done']], DATA[seg['start']:seg['start'] + seg['done']])
+        self.assertEqual(len([seg for seg in state['segments'] if 0 < seg['done']]), downloader.DOWNLOAD_SEGMENTS)
+
+        os.remove(self.save_path)
+        part_path = self.save_path + '.part'
+        with open(part_path, 'wb') as f:
+            f.write(data)
+        with open(part_path + '.json', 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+        self.httpd.ranges_requested = []
+        downloader.download_file(self.url, self.save_path)
+        self.assertDownloaded()
+        self.assertEqual(sorted(self.httpd.ranges_requested),
+                         sorted(f"bytes={seg['start'] + seg['done']}-{seg['end']}" for seg in state['segments']
+                                if seg['done'] <= seg['end'] - seg['start']))
+
+    def test_segments_reject_wrong_range(self):
+        self.segmented()
+        self.httpd.wrong_start = True
+        with self.assertRaises(Exception):
+            downloader.download_file(self.url, self.save_path)
+        self.assertFalse(os.path.exists(self.save_path))
+        self.assertFalse(os.path.exists(self.save_path + '.part'))
+
+
+if __name__ == '__main__':
+    unittest.main()
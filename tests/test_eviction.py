@@ -0,0 +1,102 @@
+import os
+import sys
+import shutil
+import functools
+import tempfile
+import unittest
+from unittest import mock
+
+# manga_viwer のモジュールは `from config import ...` のように直接読み込む構成のため、パスに加える
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'manga_viwer'))
+
+import config # noqa: E402
+config.METRICS_DIR = None # 試験中のメトリクスをファイルに書き出さない
+import db # noqa: E402
+import cache_index # noqa: E402
+import eviction # noqa: E402
+
+MB = 1024 * 1024
+
+
+class EvictionCandidatesTest(unittest.TestCase):
+    """一時ディレクトリのデータベースで、cache_index の削除候補の順を確かめる"""
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='manga_test_eviction_')
+        self.addCleanup(shutil.rmtree, self.work_dir, True)
+        path = os.path.join(self.work_dir, 'manga.db')
+        self.conn = db.connect(path)
+        self.addCleanup(self.conn.close)
+        db.migrate(self.conn)
+        # cache_index はスレッドの接続と、削除候補用の新しい接続の両方を使う
+        for patcher in (mock.patch.object(db, 'get_connection', return_value=self.conn),
+                        mock.patch.object(db, 'connect', functools.partial(db.connect, path))):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(cache_index._versions.clear)
+
+    def add(self, manga_hash, size, last_access, hits=0, clock=0.0):
+        cache_index.record(manga_hash, archive_size=size, extracted_size=0)
+        with self.conn:
+            self.conn.execute('UPDATE cache_index SET last_access = ?, hits = ?, clock = ? WHERE hash = ?',
+                              (last_access, hits, clock, manga_hash))
+
+    def candidates(self, name, exclude=()):
+        return [row[0] for row in cache_index.eviction_candidates(eviction.get_policy(name), exclude)]
+
+    def add_volumes(self):
+        #           サイズ      最終アクセス 回数
+        self.add('a', 10 * MB, 300, hits=1)
+        self.add('b', 1 * MB,  100, hits=5)
+        self.add('c', 50 * MB, 200, hits=5)
+        self.add('d', 1 * MB,  400, hits=1)
+
+    def test_lru(self):
+        self.add_volumes()
+        self.assertEqual(self.candidates('lru'), ['b', 'c', 'a', 'd'])
+
+    def test_lfu(self):
+        # 回数が同じ巻は、最後に開かれたのが古い順
+        self.add_volumes()
+        self.assertEqual(self.candidates('lfu'), ['a', 'd', 'b', 'c'])
+
+    def test_gdsf(self):
+        # H = L + (回数 + 1) / サイズ（MB）: a = 0.2, b = 6, c = 0.12, d = 2
+        self.add_volumes()
+        self.assertEqual(self.candidates('gdsf'), ['c', 'a', 'd', 'b'])
+        priorities = {row[0]: row[3] for row in cache_index.eviction_candidates(eviction.get_policy('gdsf'))}
+        self.assertAlmostEqual(priorities['a'], 0.2)
+
+    def test_gdsf_clock(self):
+        # 削除した巻の優先度までクロックが上がると、後から開いた巻は古い巻より後に削除される
+        self.add_volumes()
+        cache_index.inflate(10.0)
+        cache_index.touch('c', hit=True)
+        self.assertEqual(self.candidates('gdsf'), ['a', 'd', 'b', 'c'])
+
+    def test_exclude(self):
+        self.add_volumes()
+        self.assertEqual(self.candidates('lru', exclude={'b', 'a'}), ['c', 'd'])
+        self.assertEqual(self.candidates('gdsf', exclude={'c'}), ['a', 'd', 'b'])
+
+    def test_first_open_counts(self):
+        # ダウンロード中に開いた巻はインデックスにまだないが、開いた回数は残り、record() で引き継ぐ
+        cache_index.touch('e', hit=True)
+        cache_index.record('e', archive_size=2 * MB, extracted_size=0)
+        cache_index.touch('e', hit=True)
+        row = self.conn.execute('SELECT hits, archive_size FROM cache_index WHERE hash = ?', ('e',)).fetchone()
+        self.assertEqual((row['hits'], row['archive_size']), (2, 2 * MB))
+        # 開かずにプリフェッチした巻は 0 回のまま
+        cache_index.record('f', archive_size=2 * MB, extracted_size=0)
+        cache_index.touch('f')
+        self.assertEqual(self.conn.execute("SELECT hits FROM cache_index WHERE hash = 'f'").fetchone()[0], 0)
+
+    def test_simulate(self):
+        # シミュレーターも同じ規則で削除する: 容量 2 巻分で、LFU は何度も開いた x を残し、LRU は削除する
+        trace = [('x', MB), ('x', MB), ('y', MB), ('z', MB), ('x', MB)]
+        self.assertEqual(eviction.simulate(trace, eviction.get_policy('lfu'), 2 * MB)['hits'], 2)
+        self.assertEqual(eviction.simulate(trace, eviction.get_policy('lru'), 2 * MB)['hits'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,166 @@
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+MANGA_VIWER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'manga_viwer')
+
+# app は読み込み時に config の設定（データベース・キャッシュディレクトリ）を取り込み、データベースを初期化する。
+# 他のテストで読み込んだモジュールの設定を使わないよう、子プロセスで一時ディレクトリのキャッシュを作り、
+# 一連のリクエストの応答を JSON で出力する:
+#   {名前: {'status', 'headers': {...}, 'body': 本文の16進}}
+# 'files' は個別のファイルとして保存したページ、'pack' はページパックにまとめたページ。
+CHILD = '''
+import os, sys, json
+sys.path.insert(0, sys.argv[1])
+work_dir = sys.argv[2]
+import config
+config.METRICS_DIR = None
+config.DATABASE = os.path.join(work_dir, 'manga.db')
+config.MANGA_CACHE_DIR = os.path.join(work_dir, 'cache')
+config.MANGA_CACHE_TEMP_DIR = os.path.join(work_dir, 'cache_temp')
+import app, cache_index, converter
+from PIL import Image
+
+source = os.path.join(work_dir, 'source.png')
+Image.linear_gradient('L').resize((400, 600)).convert('RGB').save(source)
+volumes = {'files': '1' * 32, 'pack': '2' * 32}
+with app.app.app_context():
+    for manga_hash in volumes.values():
+        extract_path = os.path.join(config.MANGA_CACHE_DIR, manga_hash + '_extracted')
+        os.makedirs(extract_path)
+        converter.convert_page(source, os.path.join(extract_path, '0000'), 'jpeg')
+        cache_index.record(manga_hash, archive_size=0, extracted_size=cache_index.dir_size(extract_path), version=100.0)
+    app.pack_volume(volumes['pack'])
+
+client = app.app.test_client()
+results = {}
+
+def get(name, url, **headers):
+    headers.setdefault('Accept', 'image/jpeg')
+    response = client.get(url, headers=headers)
+    results[name] = {'status': response.status_code, 'headers': dict(response.headers), 'body': response.get_data().hex()}
+    return response
+
+def cached(name, url, **headers):
+    # ASGI のイベントループで返す応答（プロセス内のETagだけで判定する）
+    with app.app.test_request_context(url, headers=headers):
+        response = app.serve_cached_page(url[len('/image/'):])
+        results[name] = response and {'status': response.status_code, 'headers': dict(response.headers), 'body': ''}
+
+for kind, manga_hash in volumes.items():
+    url = f'/image/{manga_hash}_extracted/0000'
+    etag = get(f'{kind}_full', url).headers['ETag'].strip('"')
+    get(f'{kind}_not_modified', url, **{'If-None-Match': f'"{etag}"'})
+    get(f'{kind}_other_etag', url, **{'If-None-Match': '"other"'})
+    get(f'{kind}_range', url, Range='bytes=10-109')
+    get(f'{kind}_suffix_range', url, Range='bytes=-10')
+    get(f'{kind}_if_range', url, Range='bytes=10-109', **{'If-Range': f'"{etag}"'})
+    get(f'{kind}_if_range_stale', url, Range='bytes=10-109', **{'If-Range': '"other"'})
+    get(f'{kind}_unsatisfiable', url, Range='bytes=100000000-')
+    get(f'{kind}_variant', url + '?variant=thumb')
+    cached(f'{kind}_cached_not_modified', url, **{'If-None-Match': f'"{etag}"', 'Accept': 'image/jpeg'})
+    cached(f'{kind}_cached_full', url, Accept='image/jpeg')
+
+# 再ダウンロードでアーカイブのバージョンが変わると、古いETagは一致しない
+with app.app.app_context():
+    cache_index.record(volumes['files'], version=200.0)
+etag = results['files_full']['headers']['ETag']
+get('files_new_version', f'/image/{volumes["files"]}_extracted/0000', **{'If-None-Match': etag})
+print(json.dumps(results))
+'''
+
+
+class ServeImageTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        work_dir = tempfile.mkdtemp(prefix='manga_test_image_')
+        try:
+            out = subprocess.run([sys.executable, '-c', CHILD, MANGA_VIWER, work_dir],
+                                 capture_output=True, text=True, check=True)
+        finally:
+            shutil.rmtree(work_dir, True)
+        cls.results = json.loads(out.stdout.strip().splitlines()[-1])
+
+    def response(self, kind, name):
+        return self.results[f'{kind}_{name}']
+
+    def body(self, kind, name):
+        return bytes.fromhex(self.response(kind, name)['body'])
+
+    def test_full_response_headers(self):
+        for kind in ('files', 'pack'):
+            with self.subTest(kind):
+                response = self.response(kind, 'full')
+                self.assertEqual(response['status'], 200)
+                self.assertEqual(response['headers']['Content-Type'], 'image/jpeg')
+                self.assertIn('immutable', response['headers']['Cache-Control'])
+                self.assertEqual(response['headers']['Accept-Ranges'], 'bytes')
+                self.assertEqual(response['headers']['Vary'], 'Accept, Sec-CH-Width, Sec-CH-Viewport-Width, Sec-CH-DPR')
+                self.assertTrue(self.body(kind, 'full').startswith(b'\xff\xd8'))
+
+    def test_pack_serves_same_page(self):
+        # ページパックは個別のファイルと同じ内容を返す（ETagはハッシュが異なるため別の値）
+        files, pack = (self.response(kind, 'full')['headers']['ETag'] for kind in ('files', 'pack'))
+        self.assertNotEqual(files, pack)
+        self.assertEqual(self.body('files', 'full'), self.body('pack', 'full'))
+
+    def test_not_modified(self):
+        for kind in ('files', 'pack'):
+            with self.subTest(kind):
+                response = self.response(kind, 'not_modified')
+                self.assertEqual(response['status'], 304)
+                self.assertEqual(response['body'], '')
+                self.assertEqual(response['headers']['ETag'], self.response(kind, 'full')['headers']['ETag'])
+                self.assertIn('immutable', response['headers']['Cache-Control'])
+                self.assertIn('Accept', response['headers']['Vary'])
+                self.assertEqual(self.response(kind, 'other_etag')['status'], 200)
+
+    def test_range(self):
+        for kind in ('files', 'pack'):
+            with self.subTest(kind):
+                full = self.body(kind, 'full')
+                response = self.response(kind, 'range')
+                self.assertEqual(response['status'], 206)
+                self.assertEqual(response['headers']['Content-Range'], f'bytes 10-109/{len(full)}')
+                self.assertEqual(self.body(kind, 'range'), full[10:110])
+                self.assertEqual(self.body(kind, 'suffix_range'), full[-10:])
+                self.assertEqual(self.response(kind, 'unsatisfiable')['status'], 416)
+
+    def test_if_range(self):
+        # If-Range が一致すれば範囲を、一致しなければ全体を返す
+        for kind in ('files', 'pack'):
+            with self.subTest(kind):
+                self.assertEqual(self.response(kind, 'if_range')['status'], 206)
+                self.assertEqual(self.response(kind, 'if_range_stale')['status'], 200)
+                self.assertEqual(self.body(kind, 'if_range_stale'), self.body(kind, 'full'))
+
+    def test_variant_query(self):
+        # クエリでサイズを指定した応答はクライアントヒントに依存しない
+        for kind in ('files', 'pack'):
+            with self.subTest(kind):
+                response = self.response(kind, 'variant')
+                self.assertEqual(response['status'], 200)
+                self.assertEqual(response['headers']['Vary'], 'Accept')
+                self.assertNotEqual(response['headers']['ETag'], self.response(kind, 'full')['headers']['ETag'])
+                self.assertLess(len(self.body(kind, 'variant')), len(self.body(kind, 'full')))
+
+    def test_cached_not_modified(self):
+        # イベントループでは、ETagが一致する304だけを返し、それ以外はスレッドの serve_image に任せる
+        for kind in ('files', 'pack'):
+            with self.subTest(kind):
+                self.assertEqual(self.response(kind, 'cached_not_modified')['status'], 304)
+                self.assertIsNone(self.response(kind, 'cached_full'))
+
+    def test_new_version_invalidates_etag(self):
+        response = self.results['files_new_version']
+        self.assertEqual(response['status'], 200)
+        self.assertNotEqual(response['headers']['ETag'], self.response('files', 'full')['headers']['ETag'])
+
+
+if __name__ == '__main__':
+    unittest.main()
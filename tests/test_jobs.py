@@ -0,0 +1,113 @@
+import os
+import sys
+import time
+import threading
+import unittest
+
+# manga_viwer のモジュールは `from config import ...` のように直接読み込む構成のため、パスに加える
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'manga_viwer'))
+
+import config # noqa: E402
+config.METRICS_DIR = None # 試験中のメトリクスをファイルに書き出さない
+from jobs import JobQueue, JobQueueFull # noqa: E402
+
+
+def wait_finished(job, timeout=5):
+    deadline = time.time() + timeout
+    while job.active and time.time() < deadline:
+        time.sleep(0.01)
+    return not job.active
+
+
+class JobQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        # ワーカーを止めておくジョブ。テストの終わりに必ず解放する
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+
+    def blocking(self, calls):
+        def func(job):
+            calls.append(job.id)
+            job.set_state('downloading')
+            self.release.wait(5)
+        return func
+
+    def test_coalesces_active_job(self):
+        # 同じIDの実行中・待機中のジョブにまとめ、関数は1回だけ実行する
+        jobs = JobQueue(1, 4)
+        calls = []
+        first = jobs.submit('a', self.blocking(calls))
+        self.assertIs(jobs.submit('a', self.blocking(calls)), first)
+        queued = jobs.submit('b', self.blocking(calls))
+        self.assertIs(jobs.submit('b', self.blocking(calls)), queued)
+        self.assertEqual(jobs.active_ids(), {'a', 'b'})
+        self.release.set()
+        self.assertTrue(wait_finished(first) and wait_finished(queued))
+        self.assertEqual(calls, ['a', 'b'])
+        self.assertEqual((first.state, queued.state), ('done', 'done'))
+        self.assertEqual(jobs.active_ids(), set())
+
+    def test_resubmit_after_finish(self):
+        # 終了したジョブは結合せず、新しいジョブとして実行する
+        jobs = JobQueue(1, 4)
+        calls = []
+        self.release.set()
+        first = jobs.submit('a', self.blocking(calls))
+        self.assertTrue(wait_finished(first))
+        second = jobs.submit('a', self.blocking(calls))
+        self.assertIsNot(second, first)
+        self.assertTrue(wait_finished(second))
+        self.assertEqual(calls, ['a', 'a'])
+        self.assertIs(jobs.get('a'), second)
+
+    def test_queue_full(self):
+        jobs = JobQueue(1, 1)
+        calls = []
+        running = jobs.submit('a', self.blocking(calls))
+        deadline = time.time() + 5
+        while running.started is None and time.time() < deadline: # ワーカーがキューから取り出すまで待つ
+            time.sleep(0.01)
+        jobs.submit('b', self.blocking(calls))
+        with self.assertRaises(JobQueueFull):
+            jobs.submit('c', self.blocking(calls))
+        self.assertIsNone(jobs.get('c'))
+        # 満杯でも、既存のジョブへの重複リクエストはまとめられる
+        self.assertIs(jobs.submit('a', self.blocking(calls)), running)
+
+    def test_error(self):
+        jobs = JobQueue(1, 4)
+
+        def fail(job):
+            raise OSError('接続できません')
+        job = jobs.submit('a', fail)
+        self.assertTrue(wait_finished(job))
+        self.assertEqual(job.to_dict()['state'], 'error')
+        self.assertEqual(job.to_dict()['error'], '接続できません')
+
+    def test_prunes_finished_jobs(self):
+        jobs = JobQueue(1, 4, result_ttl=0)
+        job = jobs.submit('a', lambda job: None)
+        self.assertTrue(wait_finished(job))
+        time.sleep(0.01)
+        jobs.submit('b', lambda job: None) # 登録のたびに、保持期間を過ぎたジョブを破棄する
+        self.assertIsNone(jobs.get('a'))
+
+    def test_progress(self):
+        jobs = JobQueue(1, 4)
+        started = threading.Event()
+
+        def func(job):
+            job.set_state('downloading')
+            job.download_progress(25, 100)
+            started.set()
+            self.release.wait(5)
+        job = jobs.submit('a', func)
+        self.assertTrue(started.wait(5))
+        data = job.to_dict()
+        self.assertEqual((data['state'], data['bytes_downloaded'], data['total_bytes']), ('downloading', 25, 100))
+        self.assertIsNotNone(data['eta_seconds'])
+
+
+if __name__ == '__main__':
+    unittest.main()
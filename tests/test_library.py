@@ -0,0 +1,167 @@
+import os
+import sys
+import json
+import shutil
+import subprocess
+import tempfile
+import unittest
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# manga_viwer のモジュールは `from config import ...` のように直接読み込む構成のため、パスに加える
+sys.path.insert(0, os.path.join(ROOT, 'manga_viwer'))
+
+import config # noqa: E402
+config.METRICS_DIR = None # 試験中のメトリクスをファイルに書き出さない
+import db # noqa: E402
+import library # noqa: E402
+
+
+class LibraryTestCase(unittest.TestCase):
+    """一時ディレクトリのデータベースに最新のスキーマを作成する"""
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='manga_test_library_')
+        self.addCleanup(shutil.rmtree, self.work_dir, True)
+        self.conn = db.connect(os.path.join(self.work_dir, 'manga.db'))
+        self.addCleanup(self.conn.close)
+        db.migrate(self.conn)
+
+    def add(self, *urls):
+        with self.conn:
+            library.upsert_mangas(self.conn, [(h, url, title, ext) for url in urls for h, title, ext in [library.derive_entry(url)]])
+
+
+class PaginationTest(LibraryTestCase):
+
+    def setUp(self):
+        super().setUp()
+        if not library.has_fts(self.conn):
+            self.skipTest('FTS5（trigram）が使用できない SQLite')
+        # 同じタイトルの巻（別のディレクトリ）を含め、追加順とタイトル順が一致しないようにする
+        self.add(*[f'https://example.com/{series}/{title}.cbz'
+                   for series in ('one', 'two') for title in ('gamma', 'alpha', 'delta', 'beta', 'alpha_extra')])
+
+    def walk(self, page, **kwargs):
+        """カーソルをたどってすべてのページを読み、(行の (title, id) のリスト, ページ数) を返す"""
+        rows, pages, cursor = [], 0, {}
+        while True:
+            batch, cursor = page(self.conn, **kwargs, **(cursor or {}), limit=3)
+            rows += [(r['title'], r['id']) for r in batch]
+            pages += 1
+            if cursor is None:
+                return rows, pages
+
+    def test_list_page_keyset(self):
+        rows, pages = self.walk(library.list_page)
+        expected = [(r['title'], r['id']) for r in self.conn.execute('SELECT title, id FROM mangas ORDER BY title, id')]
+        self.assertEqual(rows, expected)
+        self.assertEqual(pages, 4) # 10行を3行ずつ
+        self.assertEqual([title for title, _ in rows[:2]], ['alpha', 'alpha']) # 同じタイトルは id で並ぶ
+
+    def test_search_page_fts(self):
+        rows, _ = self.walk(library.search_page, query='alpha')
+        self.assertEqual([title for title, _ in rows], ['alpha', 'alpha_extra', 'alpha', 'alpha_extra'])
+        self.assertEqual([i for _, i in rows], sorted(i for _, i in rows)) # 追加順
+
+    def test_search_page_all_terms(self):
+        # 3文字以上の語は FTS5、短い語は LIKE で絞り込み、すべての語を含む行だけを返す
+        rows, _ = self.walk(library.search_page, query='two alpha xt')
+        self.assertEqual([title for title, _ in rows], ['alpha_extra'])
+        rows, _ = self.walk(library.search_page, query='ALPHA one')
+        self.assertEqual(len(rows), 2)
+
+    def test_search_page_quotes_fts_syntax(self):
+        # FTS5 の演算子や引用符は語として扱い、構文エラーにしない
+        self.assertEqual(library.search_page(self.conn, 'alpha OR "beta')[0], [])
+        self.assertEqual(library.search_page(self.conn, '100%_')[0], [])
+
+    def test_search_follows_updates(self):
+        with self.conn:
+            self.conn.execute("UPDATE mangas SET title = 'renamed' WHERE title = 'gamma'")
+            self.conn.execute("DELETE FROM mangas WHERE title = 'delta'")
+        self.assertEqual(len(library.search_page(self.conn, 'renamed')[0]), 2)
+        # URLは変わらないため、元のタイトルを含むURLでは見つかる（索引のタイトルは新しいもの）
+        self.assertEqual([r['title'] for r in library.search_page(self.conn, 'gamma')[0]], ['renamed', 'renamed'])
+        self.assertEqual(library.search_page(self.conn, 'delta')[0], [])
+
+    def test_deferred_fts_rebuild(self):
+        # 一括インポート中は索引を更新せず、最後にまとめて作り直す
+        library.defer_fts(self.conn)
+        self.add('https://example.com/three/epsilon.cbz')
+        self.assertTrue(library.fts_deferred(self.conn))
+        self.assertEqual(library.search_page(self.conn, 'epsilon')[0], [])
+        library.rebuild_fts(self.conn)
+        self.assertFalse(library.fts_deferred(self.conn))
+        self.assertEqual(len(library.search_page(self.conn, 'epsilon')[0]), 1)
+        # 作り直しの後は、行ごとの索引の更新に戻る
+        self.add('https://example.com/three/zeta.cbz')
+        self.assertEqual(len(library.search_page(self.conn, 'zeta')[0]), 1)
+        automerge = self.conn.execute("SELECT v FROM mangas_fts_config WHERE k = 'automerge'").fetchone()
+        self.assertEqual(automerge[0], library.FTS_AUTOMERGE)
+
+
+class AddBatchTest(LibraryTestCase):
+
+    def test_statuses(self):
+        self.add('https://example.com/s/old.cbz')
+        urls = [
+            'https://example.com/s/vol1.cbz',
+            ' https://example.com/s/vol2.zip ', # 前後の空白は除く
+            'https://example.com/s/vol1.cbz',   # リスト内で重複
+            'https://example.com/s/old.cbz',    # 登録済み
+            'https://example.com/s/notes.pdf',  # 未対応の形式
+            'ftp://example.com/s/vol3.cbz',     # 未対応のスキーム
+            '',
+            None,
+        ]
+        results = library.add_batch(self.conn, urls)
+        self.assertEqual([r['status'] for r in results],
+                         ['added', 'added', 'duplicate', 'exists', 'unsupported', 'invalid', 'invalid', 'invalid'])
+        self.assertEqual(results[1]['url'], 'https://example.com/s/vol2.zip')
+        self.assertEqual((results[0]['title'], results[0]['ext']), ('vol1', 'cbz'))
+        self.assertEqual(results[0]['hash'], library.derive_entry('https://example.com/s/vol1.cbz')[0])
+        stored = {r['url'] for r in self.conn.execute('SELECT url FROM mangas')}
+        self.assertEqual(stored, {'https://example.com/s/old.cbz', 'https://example.com/s/vol1.cbz',
+                                  'https://example.com/s/vol2.zip'})
+
+    def test_allowed_domains(self):
+        with mock.patch.object(library, 'ALLOWED_DOMAINS', ['trusted.example']):
+            results = library.add_batch(self.conn, ['https://trusted.example/a.cbz', 'https://other.example/b.cbz'])
+        self.assertEqual([r['status'] for r in results], ['added', 'invalid'])
+
+    def test_matches_single_add(self):
+        # 一括追加と /add は同じ規則でハッシュ・タイトル・拡張子を求める（タイトルの無効な文字は除く）
+        url = 'https://example.com/s/%E7%AC%AC1%E5%B7%BB%3A%22x%22.CBZ'
+        result, = library.add_batch(self.conn, [url])
+        self.assertEqual((result['hash'], result['title'], result['ext']), library.derive_entry(url))
+        self.assertEqual((result['title'], result['ext']), ('第1巻x', 'cbz'))
+
+
+class ImportTest(LibraryTestCase):
+
+    def test_import_script(self):
+        # manga_comic_urls_sqlite.py は /add と同じ規則で登録し、最後に検索の索引を作り直す
+        self.add('https://example.com/s/old.cbz')
+        source = os.path.join(self.work_dir, 'urls.ndjson')
+        with open(source, 'w', encoding='utf-8') as f:
+            for item in ({'url': 'https://example.com/s/vol1.cbz'}, {'url': 'https://example.com/s/old.cbz'},
+                         {'url': 'https://example.com/s/notes.pdf'}, {'url': 'ftp://example.com/s/vol2.cbz'},
+                         'https://example.com/s/vol3.zip'):
+                f.write(json.dumps(item) + '\n')
+        out = subprocess.run([sys.executable, os.path.join(ROOT, 'manga_comic_urls_sqlite.py'), source,
+                              '--db', os.path.join(self.work_dir, 'manga.db')],
+                             capture_output=True, text=True, check=True, cwd=self.work_dir)
+        self.assertIn('2 件を', out.stdout)
+        self.assertIn('変更なし 1 行, 無効 2 行', out.stdout)
+        rows = {r['url']: (r['hash'], r['title'], r['file_ext']) for r in self.conn.execute('SELECT * FROM mangas')}
+        self.assertEqual(len(rows), 3)
+        url = 'https://example.com/s/vol3.zip'
+        self.assertEqual(rows[url], library.derive_entry(url))
+        self.assertFalse(library.fts_deferred(self.conn))
+        if library.has_fts(self.conn):
+            self.assertEqual([r['url'] for r in library.search_page(self.conn, 'vol3')[0]], [url])
+
+
+if __name__ == '__main__':
+    unittest.main()
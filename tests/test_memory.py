@@ -0,0 +1,128 @@
+import io
+import os
+import sys
+import json
+import shutil
+import zipfile
+import tempfile
+import unittest
+import subprocess
+
+from PIL import Image
+
+MANGA_VIWER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'manga_viwer')
+
+PAGE_SIZE = (6000, 9000) # 大きなスキャン（RGBで約155MB）
+PEAK_LIMIT_MB = 150      # 縮小デコードしたページの変換で増えてよい最大RSS
+REJECT_LIMIT_MB = 30     # 画素数の上限で拒否したページで増えてよい最大RSS
+
+# 子プロセスで1ページを変換し、変換の前のRSSから増えた最大RSS（VmHWM）をJSONで出力する。
+# 新しいプロセスで実行するため、最大RSSにはテストの他の処理（ページの生成など）の影響が残らない。
+#   convert <cbz> <出力先>: 事前変換・遅延変換と同じ convert_page で、ZIPのメンバーを変換する
+#   direct <cbz> <作業ディレクトリ>: ダイレクトモードの /image/<hash>/direct/0 で配信する
+CHILD = '''
+import os, sys, json
+sys.path.insert(0, sys.argv[1])
+import config
+config.METRICS_DIR = None
+
+def status(key):
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(key + ':'):
+                return int(line.split()[1]) / 1024
+
+mode, cbz, work_dir = sys.argv[2:5]
+if mode == 'convert':
+    import zipfile, converter
+    with zipfile.ZipFile(cbz) as z:
+        source = converter.ZipMember(cbz, z.namelist()[0])
+    before = status('VmRSS')
+    try:
+        converter.convert_page(source, os.path.join(work_dir, '0000'), 'jpeg')
+        result = 'converted'
+    except converter.PageTooLarge:
+        result = 'rejected'
+else:
+    import shutil
+    config.DATABASE = os.path.join(work_dir, 'manga.db')
+    config.MANGA_CACHE_DIR = os.path.join(work_dir, 'cache')
+    config.MANGA_CACHE_TEMP_DIR = os.path.join(work_dir, 'cache_temp')
+    config.DIRECT_MODE = True
+    import app, cache_index
+    manga_hash = '0' * 32
+    archive_path = os.path.join(config.MANGA_CACHE_DIR, manga_hash + '.cbz')
+    shutil.copy(cbz, archive_path)
+    with app.app.app_context():
+        with app.get_connection() as conn:
+            conn.execute("INSERT INTO mangas (hash, url, title, file_ext) VALUES (?, 'http://example.com/a.cbz', 'a', 'cbz')",
+                         (manga_hash,))
+        cache_index.record(manga_hash, archive_size=os.path.getsize(archive_path), version=os.path.getmtime(archive_path))
+    client = app.app.test_client()
+    before = status('VmRSS')
+    response = client.get(f'/image/{manga_hash}/direct/0', headers={'Accept': 'image/webp'})
+    result = 'converted' if response.status_code == 200 and response.data else f'status {response.status_code}'
+print(json.dumps({'result': result, 'peak_mb': status('VmHWM') - before}))
+'''
+
+
+def make_cbz(path, page):
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED) as z:
+        z.writestr(f'page.{page[1]}', page[0])
+
+
+def large_page(fmt):
+    """大きなスキャンを模したページ（グラデーションと縞模様）を (バイト列, 拡張子) で返す"""
+    img = Image.linear_gradient('L').resize(PAGE_SIZE).convert('RGB')
+    step = PAGE_SIZE[0] // 64
+    for x in range(0, PAGE_SIZE[0], step * 2):
+        img.paste((x % 256, 64, 128), (x, 0, x + step, PAGE_SIZE[1]))
+    buf = io.BytesIO()
+    img.save(buf, fmt, **({'quality': 90} if fmt == 'JPEG' else {}))
+    return buf.getvalue(), 'jpg' if fmt == 'JPEG' else 'png'
+
+
+@unittest.skipUnless(os.path.exists('/proc/self/status'), '最大RSSは /proc/self/status の VmHWM で測る')
+class PeakMemoryTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.pages = {'jpeg': large_page('JPEG'), 'png': large_page('PNG')}
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='manga_test_memory_')
+        self.addCleanup(shutil.rmtree, self.work_dir, True)
+
+    def run_child(self, mode, page):
+        cbz = os.path.join(self.work_dir, 'volume.cbz')
+        make_cbz(cbz, self.pages[page])
+        out = subprocess.run([sys.executable, '-c', CHILD, MANGA_VIWER, mode, cbz, self.work_dir],
+                             capture_output=True, text=True, check=True)
+        return json.loads(out.stdout.strip().splitlines()[-1])
+
+    def test_convert_large_jpeg(self):
+        # JPEG は縮小しながらデコードするため、元の解像度のRGB（約155MB）を展開しない
+        stats = self.run_child('convert', 'jpeg')
+        self.assertEqual(stats['result'], 'converted')
+        self.assertLess(stats['peak_mb'], PEAK_LIMIT_MB)
+
+    def test_convert_rejects_large_png(self):
+        # 縮小デコードできない PNG は、PAGE_MAX_PIXELS を超えるとデコードせずに拒否する
+        stats = self.run_child('convert', 'png')
+        self.assertEqual(stats['result'], 'rejected')
+        self.assertLess(stats['peak_mb'], REJECT_LIMIT_MB)
+
+    def test_direct_mode_large_jpeg(self):
+        # PAGE_MAX_SIZE を超えるページは配信時に変換する。メンバーはバイト列に読み込まずにストリームでデコードする
+        stats = self.run_child('direct', 'jpeg')
+        self.assertEqual(stats['result'], 'converted')
+        self.assertLess(stats['peak_mb'], PEAK_LIMIT_MB)
+
+    def test_direct_mode_rejects_large_png(self):
+        stats = self.run_child('direct', 'png')
+        self.assertEqual(stats['result'], 'status 404')
+        self.assertLess(stats['peak_mb'], REJECT_LIMIT_MB)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+import subprocess
+from unittest import mock
+
+MANGA_VIWER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'manga_viwer')
+# manga_viwer のモジュールは `from config import ...` のように直接読み込む構成のため、パスに加える
+sys.path.insert(0, MANGA_VIWER)
+
+import config # noqa: E402
+config.METRICS_DIR = None # 試験中のメトリクスをファイルに書き出さない
+import metrics # noqa: E402
+
+# 別のプロセス（終了したワーカー）として値を記録し、終了時にファイルへ書き出す
+CHILD = '''
+import sys
+sys.path.insert(0, sys.argv[1])
+import config
+config.METRICS_DIR = sys.argv[2]
+import metrics
+requests = metrics.counter('test_requests_total', '', ('route',))
+latency = metrics.histogram('test_latency_seconds', '', ('route',), buckets=(0.1, 1))
+requests.inc('page', amount=3)
+latency.observe(0.5, 'page')
+'''
+
+
+class MetricsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # テストで登録したメトリクスとプロセスの状態は、終了後に元に戻す
+        for patcher in (mock.patch.dict(metrics._metrics, clear=True),
+                        mock.patch.dict(metrics._state, {'file': None, 'flusher': 'test', 'dirty': False})):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.requests = metrics.counter('test_requests_total', 'リクエスト数', ('route',))
+        self.latency = metrics.histogram('test_latency_seconds', '処理時間', ('route',), buckets=(0.1, 1))
+
+
+class RenderTest(MetricsTestCase):
+
+    def test_counter_and_histogram(self):
+        self.requests.inc('page')
+        self.requests.inc('page', amount=2)
+        self.requests.inc('say "hi"\n')
+        for value in (0.05, 0.1, 0.5, 5):
+            self.latency.observe(value, 'page')
+        text = metrics.render([('test_bytes', 'サイズ', ('kind',), {('archive',): 10})])
+        self.assertIn('# TYPE test_requests_total counter\n', text)
+        self.assertIn('test_requests_total{route="page"} 3\n', text)
+        self.assertIn('test_requests_total{route="say \\"hi\\"\\n"} 1\n', text)
+        # バケットは累積（上限ちょうどの値はそのバケットに入る）
+        self.assertIn('test_latency_seconds_bucket{route="page",le="0.1"} 2\n', text)
+        self.assertIn('test_latency_seconds_bucket{route="page",le="1"} 3\n', text)
+        self.assertIn('test_latency_seconds_bucket{route="page",le="+Inf"} 4\n', text)
+        self.assertIn('test_latency_seconds_sum{route="page"} 5.65\n', text)
+        self.assertIn('test_latency_seconds_count{route="page"} 4\n', text)
+        self.assertIn('# TYPE test_bytes gauge\ntest_bytes{kind="archive"} 10\n', text)
+
+    def test_register_twice(self):
+        # 同じ名前のメトリクスは、二度目の登録でも同じオブジェクトを返す
+        self.assertIs(metrics.counter('test_requests_total', ''), self.requests)
+
+    def test_timer(self):
+        with self.latency.time('page'):
+            pass
+        self.assertEqual(self.latency.values[('page',)][0], 1)
+
+
+class CollectTest(MetricsTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.metrics_dir = tempfile.mkdtemp(prefix='manga_test_metrics_')
+        self.addCleanup(shutil.rmtree, self.metrics_dir, True)
+        patcher = mock.patch.object(metrics, 'METRICS_DIR', self.metrics_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_worker(self):
+        subprocess.run([sys.executable, '-c', CHILD, MANGA_VIWER, self.metrics_dir], check=True)
+
+    def test_sums_processes(self):
+        self.requests.inc('page')
+        self.latency.observe(2, 'page')
+        # 実行中の別のワーカー（このテストの親プロセス）のファイル
+        with open(os.path.join(self.metrics_dir, f'{os.getppid()}-live.json'), 'w') as f:
+            json.dump({'test_requests_total': [[['page'], 10]]}, f)
+        self.run_worker()
+        self.run_worker()
+
+        totals = metrics.collect()
+        self.assertEqual(totals['test_requests_total'][('page',)], 1 + 10 + 3 + 3)
+        self.assertEqual(totals['test_latency_seconds'][('page',)], [0, 2, 1, 3.0])
+        # 終了したワーカーのファイルは retired.json にまとめて削除し、次の集計でも数えるのは一度だけ
+        names = sorted(os.listdir(self.metrics_dir))
+        self.assertIn(metrics.RETIRED_NAME, names)
+        self.assertEqual(len([n for n in names if n.endswith('.json')]), 3) # このプロセス、実行中のワーカー、retired
+        self.assertEqual(metrics.collect(), totals)
+
+    def test_ignores_broken_files(self):
+        with open(os.path.join(self.metrics_dir, f'{os.getppid()}-broken.json'), 'w') as f:
+            f.write('{')
+        self.requests.inc('page')
+        self.assertEqual(metrics.collect()['test_requests_total'], {('page',): 1})
+
+    def test_fork_starts_from_zero(self):
+        # fork した子プロセスは親の値を引き継がない（親のファイルの値と二重に数えない）
+        self.requests.inc('page', amount=5)
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0 if self.requests.values == {} and metrics._state['file'] is None else 1)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+        self.assertEqual(self.requests.values, {('page',): 5})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+# manga_viwer のモジュールは `from config import ...` のように直接読み込む構成のため、パスに加える
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'manga_viwer'))
+
+import config # noqa: E402
+config.METRICS_DIR = None # 試験中のメトリクスをファイルに書き出さない
+import db # noqa: E402
+import cache_index # noqa: E402
+import pagepack # noqa: E402
+
+PAGES = {'0000.jpg': b'first page' * 10, '0000_thumb.jpg': b'thumb', '0001.jpg': b'second page' * 20}
+
+
+class PagePackTest(unittest.TestCase):
+
+    def setUp(self):
+        self.extract_path = tempfile.mkdtemp(prefix='manga_test_pagepack_')
+        self.addCleanup(shutil.rmtree, self.extract_path, True)
+        self.pool = pagepack.PackPool(2)
+
+    def write(self, pages):
+        for name, data in pages.items():
+            with open(os.path.join(self.extract_path, name), 'wb') as f:
+                f.write(data)
+        return list(pages)
+
+    def test_round_trip(self):
+        pack_path = pagepack.write_pack(self.extract_path, self.write(PAGES), 123.5)
+        self.assertEqual(pack_path, os.path.join(self.extract_path, pagepack.PACK_NAME))
+        self.assertEqual(sorted(self.pool.names(self.extract_path)), sorted(PAGES))
+        for name, data in PAGES.items():
+            self.assertEqual(self.pool.read(self.extract_path, name), data)
+        self.assertTrue(self.pool.contains(self.extract_path, '0001.jpg'))
+        self.assertIsNone(self.pool.read(self.extract_path, '0002.jpg'))
+        self.assertEqual(pagepack.archive_version(pack_path), 123.5)
+        # 元のファイルは呼び出し側が削除する
+        self.assertTrue(os.path.isfile(os.path.join(self.extract_path, '0000.jpg')))
+
+    def test_merge_keeps_pages_and_version(self):
+        pagepack.write_pack(self.extract_path, self.write(PAGES), 123.5)
+        for name in PAGES:
+            os.remove(os.path.join(self.extract_path, name))
+        # 後から変換したページと、置き換えたページを同じパックにまとめ直す
+        pack_path = pagepack.write_pack(self.extract_path, self.write({'0000.jpg': b'replaced', '0002.webp': b'new'}))
+        self.assertEqual(self.pool.read(self.extract_path, '0000.jpg'), b'replaced')
+        self.assertEqual(self.pool.read(self.extract_path, '0001.jpg'), PAGES['0001.jpg'])
+        self.assertEqual(self.pool.read(self.extract_path, '0002.webp'), b'new')
+        self.assertEqual(pagepack.archive_version(pack_path), 123.5) # None はバージョンを引き継ぐ
+        self.assertEqual([n for n in os.listdir(self.extract_path) if n.endswith('.tmp')], [])
+
+    def test_page_slice(self):
+        pagepack.write_pack(self.extract_path, self.write(PAGES))
+        location = self.pool.locate(self.extract_path, '0001.jpg')
+        data = PAGES['0001.jpg']
+        page = pagepack.open_page(location)
+        self.addCleanup(page.close)
+        self.assertEqual(page.length, len(data))
+        self.assertEqual(page.read(5), data[:5])
+        self.assertEqual(page.read(), data[5:]) # ページの終わりで止まる
+        self.assertEqual(page.read(), b'')
+        self.assertEqual(page.seek(-4, os.SEEK_END), len(data) - 4)
+        self.assertEqual(page.read(100), data[-4:])
+        page.seek(3)
+        self.assertEqual((page.tell(), page.read(2)), (3, data[3:5]))
+
+    def test_rewritten_pack(self):
+        # パックが作り直されると、古い場所は開けず、プールは新しいパックを読み込む
+        pagepack.write_pack(self.extract_path, self.write(PAGES))
+        location = self.pool.locate(self.extract_path, '0001.jpg')
+        os.remove(os.path.join(self.extract_path, pagepack.PACK_NAME))
+        self.assertIsNone(pagepack.open_page(location))
+        self.assertIsNone(self.pool.locate(self.extract_path, '0001.jpg'))
+        pagepack.write_pack(self.extract_path, self.write({'0001.jpg': b'again'}))
+        self.assertIsNone(pagepack.open_page(location))
+        self.assertEqual(self.pool.read(self.extract_path, '0001.jpg'), b'again')
+
+    def test_invalid_pack(self):
+        with open(os.path.join(self.extract_path, pagepack.PACK_NAME), 'wb') as f:
+            f.write(b'not a pack' * 10)
+        with self.assertLogs(level='WARNING'):
+            self.assertIsNone(self.pool.read(self.extract_path, '0000.jpg'))
+        self.assertIsNone(pagepack.archive_version(os.path.join(self.extract_path, pagepack.PACK_NAME)))
+
+
+class RebuildFromPackTest(unittest.TestCase):
+
+    def test_rebuild_uses_pack_version(self):
+        # アーカイブを削除した巻は、インデックスを作り直してもパックに記録したバージョン（ETagの元）を使う
+        work_dir = tempfile.mkdtemp(prefix='manga_test_pagepack_')
+        self.addCleanup(shutil.rmtree, work_dir, True)
+        path = os.path.join(work_dir, 'manga.db')
+        conn = db.connect(path)
+        self.addCleanup(conn.close)
+        db.migrate(conn)
+        for patcher in (mock.patch.object(db, 'get_connection', return_value=conn),
+                        mock.patch.object(cache_index, 'MANGA_CACHE_DIR', work_dir)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(cache_index._versions.clear)
+
+        extract_path = os.path.join(work_dir, 'd' * 32 + '_extracted')
+        os.makedirs(extract_path)
+        with open(os.path.join(extract_path, '0000.jpg'), 'wb') as f:
+            f.write(b'page')
+        pagepack.write_pack(extract_path, ['0000.jpg'], 42.0)
+        os.remove(os.path.join(extract_path, '0000.jpg'))
+        self.assertEqual(cache_index.rebuild(), 1)
+        self.assertEqual(cache_index.version('d' * 32), 42.0)
+
+
+if __name__ == '__main__':
+    unittest.main()